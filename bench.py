@@ -0,0 +1,619 @@
+"""Офлайн-бенчмарк конвейера бота: handle_url → handle_callback → _send_file
+
+Ни YouTube, ни Telegram не нужны:
+- локальный HTTP-сервер раздаёт синтетические DASH-потоки (видео без звука
+  нескольких качеств + m4a-аудио), с поддержкой Range и ограничением скорости;
+- фейковый экстрактор yt-dlp отвечает на ссылки youtube.com/watch?v=... и
+  указывает на этот сервер;
+- фейковый клиент Pyrogram записывает отправки и правки, имитирует скорость
+  загрузки в Telegram и FloodWait.
+
+Отчёт: задач в минуту, p50/p95/p99 по этапам и доли кэш-хитов.
+Нужен ffmpeg (как и самому боту).
+
+Пример:
+    python bench.py --users 20 --jobs-per-user 3 --videos 10
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from pyrogram.errors import FloodWait
+import yt_dlp
+from yt_dlp.extractor.common import InfoExtractor
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ═══════════════════════════════════════════════════════════════
+#                      СИНТЕТИЧЕСКИЕ МЕДИА
+# ═══════════════════════════════════════════════════════════════
+
+# Качество -> (разрешение, битрейт видео в кбит/с)
+VIDEO_VARIANTS = {
+    360: ("640x360", 600),
+    720: ("1280x720", 1500),
+    1080: ("1920x1080", 3000),
+}
+AUDIO_BITRATE = 128
+
+
+def generate_media(media_dir: str, duration: int) -> dict:
+    """Генерация синтетических потоков через ffmpeg; возвращает имя файла -> размер"""
+    jobs = {
+        "audio.m4a": [
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+            "-c:a", "aac", "-b:a", f"{AUDIO_BITRATE}k", "-vn",
+        ],
+    }
+    for height, (size, bitrate) in VIDEO_VARIANTS.items():
+        jobs[f"video{height}.mp4"] = [
+            "-f", "lavfi", "-i", f"testsrc=size={size}:rate=25:duration={duration}",
+            "-c:v", "mpeg4", "-b:v", f"{bitrate}k", "-an",
+        ]
+
+    sizes = {}
+    for name, args in jobs.items():
+        path = os.path.join(media_dir, name)
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args, path],
+            check=True,
+        )
+        sizes[name] = os.path.getsize(path)
+    return sizes
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ЛОКАЛЬНЫЙ МЕДИА-СЕРВЕР
+# ═══════════════════════════════════════════════════════════════
+
+class MediaServer:
+    """HTTP-сервер с поддержкой Range и ограничением скорости на соединение"""
+
+    CHUNK = 64 * 1024
+
+    def __init__(self, media_dir: str, bytes_per_sec: float):
+        self.media_dir = media_dir
+        self.bytes_per_sec = bytes_per_sec
+        self.bytes_sent = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self._serve(body=False)
+
+            def do_GET(self):
+                self._serve(body=True)
+
+            def _serve(self, body: bool):
+                path = os.path.join(server.media_dir, os.path.basename(self.path.split("?")[0]))
+                if not os.path.isfile(path):
+                    self.send_error(404)
+                    return
+                size = os.path.getsize(path)
+                start, end = 0, size - 1
+                match = re.match(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                    else:
+                        start = max(0, size - int(match.group(2)))
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(end - start + 1))
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+                with server._lock:
+                    server.requests += 1
+                if not body:
+                    return
+
+                with open(path, "rb") as f:
+                    f.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        chunk = f.read(min(server.CHUNK, remaining))
+                        if not chunk:
+                            break
+                        try:
+                            self.wfile.write(chunk)
+                        except (BrokenPipeError, ConnectionResetError):
+                            return
+                        remaining -= len(chunk)
+                        with server._lock:
+                            server.bytes_sent += len(chunk)
+                        if server.bytes_per_sec:
+                            time.sleep(len(chunk) / server.bytes_per_sec)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="bench-media", daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ФЕЙКОВЫЙ ЭКСТРАКТОР YT-DLP
+# ═══════════════════════════════════════════════════════════════
+
+class BenchYoutubeIE(InfoExtractor):
+    """Отвечает на youtube.com/watch?v=ID форматами с локального сервера"""
+
+    IE_NAME = "bench:youtube"
+    _VALID_URL = r"https?://(?:www\.)?youtube\.com/watch\?v=(?P<id>[0-9A-Za-z_-]{11})"
+
+    # Задаются в run_benchmark()
+    base_url = ""
+    sizes = {}
+    duration = 0
+    latency = 0.0
+    extractions = 0
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        BenchYoutubeIE.extractions += 1
+        time.sleep(self.latency)
+
+        formats = [{
+            "format_id": "140",
+            "url": f"{self.base_url}/audio.m4a",
+            "ext": "m4a",
+            "vcodec": "none",
+            "acodec": "mp4a.40.2",
+            "abr": AUDIO_BITRATE,
+            "filesize": self.sizes["audio.m4a"],
+        }]
+        for format_id, height in zip(("134", "136", "137"), VIDEO_VARIANTS):
+            size, bitrate = VIDEO_VARIANTS[height]
+            width = int(size.split("x")[0])
+            formats.append({
+                "format_id": format_id,
+                "url": f"{self.base_url}/video{height}.mp4",
+                "ext": "mp4",
+                "vcodec": "mp4v.20.9",
+                "acodec": "none",
+                "width": width,
+                "height": height,
+                "tbr": bitrate,
+                "filesize": self.sizes[f"video{height}.mp4"],
+            })
+
+        return {
+            "id": video_id,
+            "title": f"Bench {video_id}",
+            "duration": self.duration,
+            "channel": "bench",
+            "view_count": 1000,
+            "formats": formats,
+        }
+
+
+class BenchYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL, в котором фейковый экстрактор проверяется раньше настоящих"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        ie = BenchYoutubeIE()
+        self.add_info_extractor(ie)
+        self._ies = {ie.ie_key(): self._ies.pop(ie.ie_key()), **self._ies}
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ФЕЙКОВЫЙ КЛИЕНТ PYROGRAM
+# ═══════════════════════════════════════════════════════════════
+
+_message_ids = itertools.count(1)
+
+
+class FakeMessage:
+    """Сообщение: записывает правки, иногда отвечает FloodWait"""
+
+    def __init__(self, client: "FakeClient", chat_id: int, text: str = "", user_id: int = 0):
+        self._client = client
+        self.id = next(_message_ids)
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=user_id or chat_id)
+        self.text = text
+        self.command = text.split() if text.startswith("/") else None
+        self.video = None
+        self.audio = None
+        self.document = None
+
+    async def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        self._client.replies += 1
+        reply = FakeMessage(self._client, self.chat.id, text)
+        self._client.last_reply[self.chat.id] = reply
+        return reply
+
+    async def edit_text(self, text: str, **kwargs):
+        await asyncio.sleep(self._client.rtt)
+        # Клавиатуру выбора качества не роняем: иначе сценарий оборвётся раньше загрузки
+        if "reply_markup" not in kwargs and random.random() < self._client.flood_rate:
+            self._client.flood_waits += 1
+            raise FloodWait(value=self._client.flood_wait)
+        self._client.edits += 1
+        self.text = text
+
+    async def delete(self):
+        self._client.deletes += 1
+
+
+class FakeCallbackQuery:
+    def __init__(self, data: str, user_id: int, message: FakeMessage):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = message
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class FakeClient:
+    """Клиент: отправка по пути имитирует загрузку, по file_id — мгновенна"""
+
+    UPLOAD_CHUNK = 512 * 1024
+
+    def __init__(self, upload_bytes_per_sec: float, flood_rate: float, flood_wait: int, rtt: float):
+        self.upload_bytes_per_sec = upload_bytes_per_sec
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.rtt = rtt
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.file_id_sends = 0
+        self.edits = 0
+        self.replies = 0
+        self.deletes = 0
+        self.flood_waits = 0
+        self.last_reply = {}
+        self.delivered = {}
+        self._file_ids = itertools.count(1)
+
+    async def _send(self, kind: str, chat_id: int, media: str, progress=None, progress_args=()):
+        msg = FakeMessage(self, chat_id)
+        if os.path.isfile(str(media)):
+            size = os.path.getsize(media)
+            sent = 0
+            while sent < size:
+                chunk = min(self.UPLOAD_CHUNK, size - sent)
+                await asyncio.sleep(chunk / self.upload_bytes_per_sec)
+                sent += chunk
+                if progress:
+                    await progress(sent, size, *progress_args)
+            self.uploads += 1
+            self.uploaded_bytes += size
+            file_id = f"bench-{kind}-{next(self._file_ids)}"
+        else:
+            await asyncio.sleep(self.rtt)
+            self.file_id_sends += 1
+            file_id = media
+        self.delivered[chat_id] = self.delivered.get(chat_id, 0) + 1
+        setattr(msg, kind, SimpleNamespace(file_id=file_id))
+        return msg
+
+    async def send_video(self, chat_id, video, progress=None, progress_args=(), **kwargs):
+        return await self._send("video", chat_id, video, progress, progress_args)
+
+    async def send_audio(self, chat_id, audio, progress=None, progress_args=(), **kwargs):
+        return await self._send("audio", chat_id, audio, progress, progress_args)
+
+    async def send_cached_media(self, chat_id, file_id, **kwargs):
+        return await self._send("audio", chat_id, file_id)
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ИЗМЕРЕНИЯ
+# ═══════════════════════════════════════════════════════════════
+
+class StageStats:
+    """Длительности по этапам конвейера"""
+
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, stage: str, seconds: float):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    @staticmethod
+    def percentile(values: list, p: float) -> float:
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+        return ordered[index]
+
+    def summary(self) -> dict:
+        return {
+            stage: {
+                "count": len(values),
+                "p50": self.percentile(values, 50),
+                "p95": self.percentile(values, 95),
+                "p99": self.percentile(values, 99),
+                "max": max(values),
+            }
+            for stage, values in self.samples.items()
+        }
+
+
+def instrument(bot, stats: StageStats):
+    """Оборачивает этапы бота замерами времени"""
+    original_info = bot.get_video_info
+
+    def get_video_info(url):
+        started = time.perf_counter()
+        try:
+            return original_info(url)
+        finally:
+            stats.add("info", time.perf_counter() - started)
+
+    bot.get_video_info = get_video_info
+
+    scheduler = bot.download_scheduler
+    original_submit = scheduler.submit
+
+    async def submit(user_id, cheap, func, *args, on_position=None):
+        submitted = time.perf_counter()
+
+        def timed(*call_args):
+            started = time.perf_counter()
+            stats.add("queue_wait", started - submitted)
+            try:
+                return func(*call_args)
+            finally:
+                stats.add("download", time.perf_counter() - started)
+
+        return await original_submit(user_id, cheap, timed, *args, on_position=on_position)
+
+    scheduler.submit = submit
+
+    original_finish = bot.finish_media
+
+    def finish_media(*args):
+        started = time.perf_counter()
+        try:
+            return original_finish(*args)
+        finally:
+            stats.add("postprocess", time.perf_counter() - started)
+
+    bot.finish_media = finish_media
+
+    original_send = bot._send_file
+
+    async def send_file(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await original_send(*args, **kwargs)
+        finally:
+            stats.add("upload", time.perf_counter() - started)
+
+    bot._send_file = send_file
+
+
+def _ratio(hits: int, misses: int) -> float:
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      НАГРУЗКА
+# ═══════════════════════════════════════════════════════════════
+
+async def user_session(bot, client: FakeClient, stats: StageStats, user_id: int,
+                       video_ids: list, weights: list, qualities: list, jobs: int, think: float):
+    """Один пользователь: jobs раз отправляет ссылку и нажимает кнопку"""
+    errors = 0
+    for _ in range(jobs):
+        video_id = random.choices(video_ids, weights=weights)[0]
+        action = random.choice(qualities)
+        url = f"https://youtu.be/{video_id}"
+
+        started = time.perf_counter()
+        message = FakeMessage(client, chat_id=user_id, text=url, user_id=user_id)
+        await bot.handle_url(client, message)
+        status = client.last_reply.get(user_id)
+        if status is None or "Выбери качество" not in (status.text or ""):
+            errors += 1
+            continue
+
+        await asyncio.sleep(think)
+        delivered = client.delivered.get(user_id, 0)
+        pressed = time.perf_counter()
+        await bot.handle_callback(client, FakeCallbackQuery(action, user_id, status))
+        finished = time.perf_counter()
+        if client.delivered.get(user_id, 0) == delivered:
+            errors += 1
+            continue
+        stats.add("callback", finished - pressed)
+        stats.add("end_to_end", finished - started)
+    return errors
+
+
+async def run_load(bot, args, client: FakeClient, stats: StageStats) -> dict:
+    background = [
+        asyncio.create_task(bot.edit_dispatcher.run()),
+        asyncio.create_task(bot.cache_janitor()),
+    ]
+
+    video_ids = [f"bench{i:06d}" for i in range(args.videos)]
+    # Популярность по Ципфу: несколько «вирусных» видео и длинный хвост
+    weights = [1 / (i + 1) ** args.zipf for i in range(args.videos)]
+    qualities = args.qualities.split(",")
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        user_session(bot, client, stats, 1000 + user, video_ids, weights, qualities,
+                     args.jobs_per_user, args.think)
+        for user in range(args.users)
+    ))
+    wall = time.perf_counter() - started
+
+    for task in background:
+        task.cancel()
+
+    jobs = args.users * args.jobs_per_user - sum(results)
+    return {
+        "wall_seconds": wall,
+        "jobs": jobs,
+        "errors": sum(results),
+        "jobs_per_min": jobs / wall * 60 if wall else 0.0,
+    }
+
+
+def run_benchmark(args) -> dict:
+    if shutil.which("ffmpeg") is None:
+        sys.exit("Нужен ffmpeg: бенчмарк генерирует синтетические потоки")
+
+    workdir = tempfile.mkdtemp(prefix="ytbot-bench-")
+    media_dir = os.path.join(workdir, "media")
+    os.makedirs(media_dir)
+    sizes = generate_media(media_dir, args.duration)
+
+    server = MediaServer(media_dir, args.download_mbps * 1024 * 1024 / 8)
+    server.start()
+
+    BenchYoutubeIE.base_url = server.base_url
+    BenchYoutubeIE.sizes = sizes
+    BenchYoutubeIE.duration = args.duration
+    BenchYoutubeIE.latency = args.extract_latency
+    yt_dlp.YoutubeDL = BenchYoutubeDL
+
+    # Бот пишет downloads/ относительно текущей папки — изолируем в workdir.
+    # Процессы-воркеры не видят подменённый экстрактор, поэтому только потоки.
+    os.chdir(workdir)
+    os.environ["DOWNLOAD_MODE"] = "thread"
+    sys.path.insert(0, BOT_DIR)
+    import bot
+    import downloader
+    bot.STREAM_UPLOAD = False
+    if not args.aria2c:
+        downloader.get_ydl_opts = _without_aria2c(downloader.get_ydl_opts)
+
+    stats = StageStats()
+    instrument(bot, stats)
+    client = FakeClient(
+        upload_bytes_per_sec=args.upload_mbps * 1024 * 1024 / 8,
+        flood_rate=args.flood_rate,
+        flood_wait=args.flood_wait,
+        rtt=args.rtt,
+    )
+
+    try:
+        load = asyncio.run(run_load(bot, args, client, stats))
+    finally:
+        server.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        **load,
+        "stages": stats.summary(),
+        "cache": {
+            "telegram_file_id": _ratio(bot.telegram_file_cache.hits, bot.telegram_file_cache.misses),
+            "disk": _ratio(bot.disk_cache.hits, bot.disk_cache.misses),
+            "info": _ratio(bot.info_cache.hits, bot.info_cache.misses),
+        },
+        "youtube": {
+            "extractions": BenchYoutubeIE.extractions,
+            "requests": server.requests,
+            "bytes": server.bytes_sent,
+        },
+        "telegram": {
+            "uploads": client.uploads,
+            "uploaded_bytes": client.uploaded_bytes,
+            "file_id_sends": client.file_id_sends,
+            "edits": client.edits,
+            "flood_waits": client.flood_waits,
+        },
+    }
+
+
+def _without_aria2c(get_ydl_opts):
+    """aria2c может не быть на машине бенчмарка — качаем встроенным загрузчиком"""
+    def wrapper():
+        opts = get_ydl_opts()
+        opts.pop("external_downloader", None)
+        opts.pop("external_downloader_args", None)
+        return opts
+    return wrapper
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ОТЧЁТ
+# ═══════════════════════════════════════════════════════════════
+
+def print_report(result: dict):
+    print("=" * 60)
+    print(f"Задач: {result['jobs']} (ошибок: {result['errors']}) за {result['wall_seconds']:.1f} с")
+    print(f"Пропускная способность: {result['jobs_per_min']:.1f} задач/мин")
+    print()
+    print(f"{'этап':<12}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage, s in sorted(result["stages"].items()):
+        print(f"{stage:<12}{s['count']:>6}{s['p50']:>10.3f}{s['p95']:>10.3f}{s['p99']:>10.3f}{s['max']:>10.3f}")
+    print()
+    print("Кэш-хиты: " + ", ".join(f"{k} {v * 100:.1f}%" for k, v in result["cache"].items()))
+    yt = result["youtube"]
+    tg = result["telegram"]
+    print(f"YouTube: извлечений {yt['extractions']}, запросов {yt['requests']}, "
+          f"{yt['bytes'] / 1024 / 1024:.1f} МБ")
+    print(f"Telegram: загрузок {tg['uploads']} ({tg['uploaded_bytes'] / 1024 / 1024:.1f} МБ), "
+          f"по file_id {tg['file_id_sends']}, правок {tg['edits']}, FloodWait {tg['flood_waits']}")
+    print("=" * 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=10, help="одновременных пользователей")
+    parser.add_argument("--jobs-per-user", type=int, default=3, help="задач на пользователя")
+    parser.add_argument("--videos", type=int, default=5, help="различных видео")
+    parser.add_argument("--zipf", type=float, default=1.0, help="перекос популярности видео")
+    parser.add_argument("--qualities", default="video_360,video_720,audio",
+                        help="кнопки, которые нажимают пользователи (через запятую)")
+    parser.add_argument("--duration", type=int, default=20, help="длительность синтетического видео, с")
+    parser.add_argument("--download-mbps", type=float, default=200, help="скорость «YouTube» на соединение, Мбит/с")
+    parser.add_argument("--upload-mbps", type=float, default=100, help="скорость загрузки в «Telegram», Мбит/с")
+    parser.add_argument("--extract-latency", type=float, default=0.5, help="задержка извлечения info, с")
+    parser.add_argument("--flood-rate", type=float, default=0.02, help="вероятность FloodWait на правку")
+    parser.add_argument("--flood-wait", type=int, default=2, help="длительность FloodWait, с")
+    parser.add_argument("--rtt", type=float, default=0.05, help="задержка запросов к Telegram, с")
+    parser.add_argument("--think", type=float, default=1.0, help="пауза перед нажатием кнопки, с")
+    parser.add_argument("--aria2c", action="store_true", help="качать через aria2c, как в проде")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результат в JSON (для сравнения между версиями)")
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.json:
+        args.json = os.path.abspath(args.json)   # run_benchmark переходит в рабочую папку
+    result = run_benchmark(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    # Прогон с ошибками — не результат: цифры несравнимы, а CI должен упасть
+    if result["errors"]:
+        sys.exit(f"❌ Ошибок: {result['errors']} из {result['jobs'] + result['errors']} задач")
+
+
+if __name__ == "__main__":
+    main()
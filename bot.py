@@ -1,13 +1,37 @@
 import os
+import re
+import sys
 import glob
+import shutil
 import time
+import json
+import sqlite3
+import socket
 import asyncio
 import logging
-from concurrent.futures import ThreadPoolExecutor
-from pyrogram import Client, filters
-from pyrogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+import itertools
+import threading
+import multiprocessing
+from types import SimpleNamespace
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pyrogram import Client, filters, idle, raw, utils as pyrogram_utils
+from pyrogram.types import (Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
+                            InputMediaVideo, InputMediaAudio, InlineQuery,
+                            InlineQueryResultCachedVideo, InlineQueryResultCachedAudio,
+                            InlineQueryResultCachedDocument)
+from pyrogram.file_id import FileId, FileType
 from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait, MessageNotModified
 import yt_dlp
+from downloader import (DOWNLOAD_PATH, STREAMS_PATH, DOWNLOAD_WORKERS, INFO_WORKERS, LOG_FORMAT,
+                        TRANSCODE_THREADS, FORMAT_MAP, MP3_BITRATE, OPUS_BITRATE, AAC_BITRATE,
+                        MAX_DOWNLOAD_CONNECTIONS, SPLIT_MAX, YDL_POOL_WARM,
+                        format_size_estimate, download_governor, ydl_pool, format_spec,
+                        drop_format_selection, select_formats, download_stream, fetch_streams,
+                        fetch_streams_relayed, init_download_worker, run_ffmpeg, audio_codec_args,
+                        STREAM_STOP_SUFFIX, stream_media, download_clip)
 
 # ═══════════════════════════════════════════════════════════════
 #                         НАСТРОЙКИ
@@ -20,16 +44,20 @@ API_HASH = os.environ.get("API_HASH", "")
 # Получить у @BotFather
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 
-# Папка для временных файлов
-DOWNLOAD_PATH = "./downloads"
-os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+# Лимит размера файла в Telegram (MTProto)
+TELEGRAM_FILE_LIMIT = 2 * 1024 * 1024 * 1024   # 2 ГБ
+
+# Папка для постоянных данных (кэш file_id и т.п.) — переживает рестарты,
+# очистка при старте удаляет только файлы верхнего уровня DOWNLOAD_PATH
+STATE_PATH = os.path.join(DOWNLOAD_PATH, "state")
+os.makedirs(STATE_PATH, exist_ok=True)
 
 # ═══════════════════════════════════════════════════════════════
 #                         ЛОГИРОВАНИЕ
 # ═══════════════════════════════════════════════════════════════
 
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
@@ -38,656 +66,4431 @@ logger = logging.getLogger(__name__)
 #                         ИНИЦИАЛИЗАЦИЯ
 # ═══════════════════════════════════════════════════════════════
 
+# Роль процесса: all — всё в одном процессе; frontend — принимает сообщения
+# и ставит задачи в общую очередь; worker — скачивает и отправляет задачи
+# из общей очереди через свою сессию того же бота (см. SHARED_BACKEND)
+BOT_ROLE = os.environ.get("BOT_ROLE", "all")
+WORKER_ID = os.environ.get("WORKER_ID") or socket.gethostname()
+
 app = Client(
-    "youtube_downloader_bot",
+    "youtube_downloader_bot" if BOT_ROLE != "worker" else f"youtube_downloader_worker_{WORKER_ID}",
     api_id=API_ID,
     api_hash=API_HASH,
     bot_token=BOT_TOKEN,
     max_concurrent_transmissions=3,
+    no_updates=BOT_ROLE == "worker",    # обновления получает только фронтенд
 )
 
-# Хранилище данных пользователей (в памяти)
-user_data = {}
+# Размер очереди (см. JobScheduler); число скачиваний — DOWNLOAD_WORKERS в downloader.py
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", "50"))
+MAX_QUEUE_PER_USER = int(os.environ.get("MAX_QUEUE_PER_USER", "5"))
+
+# Где выполняются скачивания: "thread" — потоки процесса бота,
+# "process" — отдельные процессы (не делят GIL с event loop Pyrogram)
+DOWNLOAD_MODE = os.environ.get("DOWNLOAD_MODE", "thread")
 
 # Раздельные пулы потоков
-info_executor = ThreadPoolExecutor(max_workers=4)       # метаданные
-download_executor = ThreadPoolExecutor(max_workers=3)   # загрузки
+info_executor = ThreadPoolExecutor(max_workers=INFO_WORKERS)            # метаданные
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)    # загрузки
+
+# Процессорная работа (склейка, кодирование аудио) — отдельный ограниченный пул,
+# чтобы ffmpeg не занимал слоты скачивания и не забирал все ядра сразу
+# (потоков на один ffmpeg — TRANSCODE_THREADS в downloader.py)
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+transcode_executor = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS)
 
 # ═══════════════════════════════════════════════════════════════
-#                      КЭШИРОВАНИЕ ФАЙЛОВ
+#                         МЕТРИКИ
 # ═══════════════════════════════════════════════════════════════
 
-CACHE_TTL = 600  # 10 минут
-
-# Кэш: (url, format_type, quality) -> {"path": str, "timestamp": float}
-file_cache = {}
+# Prometheus-эндпоинт (0 — выключен); по умолчанию слушает только localhost
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
 
-# Кэш Telegram file_id: (url, format_type, quality) -> telegram file_id
-# Повторная отправка по file_id — мгновенная, без скачивания и аплоада
-telegram_file_cache = {}
+# Telegram ID администраторов (через запятую) — им доступна команда /stats
+ADMIN_IDS = [int(x) for x in os.environ.get("ADMIN_IDS", "").replace(" ", "").split(",") if x]
 
+# Границы корзин гистограмм длительностей (секунды)
+LATENCY_BUCKETS = (0.005, 0.05, 0.25, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
 
-def cache_get(url: str, format_type: str, quality: str = "") -> str | None:
-    """Получить файл из кэша, если есть и не протух"""
-    key = (url, format_type, quality)
-    entry = file_cache.get(key)
-    if entry is None:
-        return None
-    if time.time() - entry["timestamp"] > CACHE_TTL:
-        # Протух — удаляем запись (файл может быть уже удалён)
-        file_cache.pop(key, None)
-        return None
-    if not os.path.exists(entry["path"]):
-        file_cache.pop(key, None)
-        return None
-    return entry["path"]
 
+class Metrics:
+    """Счётчики и гистограммы в памяти процесса (потокобезопасные)
 
-def cache_put(url: str, format_type: str, quality: str, path: str):
-    """Положить файл в кэш"""
-    file_cache[(url, format_type, quality)] = {
-        "path": path,
-        "timestamp": time.time(),
-    }
+    Метрика идентифицируется именем и набором меток:
+    metrics.inc("jobs_total", result="ok"),
+    metrics.observe("stage_seconds", 1.5, stage="download").
+    """
 
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self._counters = {}     # (name, labels) -> значение
+        self._histograms = {}   # (name, labels) -> [счётчики корзин..., +Inf], sum, count
+        self._lock = threading.Lock()
 
-# ═══════════════════════════════════════════════════════════════
-#                      ФОРМАТЫ КАЧЕСТВА
-# ═══════════════════════════════════════════════════════════════
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
 
-FORMAT_MAP = {
-    "360":  "bestvideo[height<=360][ext=mp4]+bestaudio[ext=m4a]/best[height<=360]/best",
-    "720":  "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]/best",
-    "1080": "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080]/best",
-    "best": "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
-}
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
 
-# ═══════════════════════════════════════════════════════════════
-#                      ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
-# ═══════════════════════════════════════════════════════════════
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts = hist[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            hist[1] += value
+            hist[2] += 1
 
-def get_ydl_opts():
-    """Базовые опции yt-dlp — ускорение + обход блокировок YouTube"""
-    return {
-        "quiet": True,
-        "no_warnings": True,
-        "noplaylist": True,
-        "socket_timeout": 60,
-        "retries": 10,
-        "fragment_retries": 10,
-        "file_access_retries": 5,
-        "extractor_retries": 5,
-        "http_chunk_size": 10485760,            # 10 MB
-        "external_downloader": "aria2c",
-        "external_downloader_args": {
-            "aria2c": [
-                "--min-split-size=1M",
-                "--max-connection-per-server=16",
-                "--max-concurrent-downloads=16",
-                "--split=16",
-            ]
-        },
-        "throttledratelimit": 100000,           # переподключение при <100 KB/s
-        "extractor_args": {
-            "youtube": {
-                "player_client": ["android", "web"],
-            }
-        },
-    }
+    def timer(self, name: str, **labels) -> "_Timer":
+        """Контекстный менеджер: длительность блока -> observe(name)"""
+        return _Timer(self, name, labels)
 
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
 
-def get_video_info(url: str) -> dict:
-    """Получение информации о видео (синхронная)"""
-    opts = get_ydl_opts()
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        return ydl.extract_info(url, download=False)
+    def quantile(self, name: str, q: float, **labels) -> float | None:
+        """Оценка квантиля по корзинам (как histogram_quantile в Prometheus)"""
+        with self._lock:
+            hist = self._histograms.get(self._key(name, labels))
+            if hist is None or not hist[2]:
+                return None
+            counts, _, count = hist[0][:], hist[1], hist[2]
+        rank = q * count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(self.buckets, counts):
+            if n and seen + n >= rank:
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return self.buckets[-1]
 
+    def histograms(self) -> list:
+        """Список (name, labels, count, sum) всех гистограмм"""
+        with self._lock:
+            return [(name, dict(labels), h[2], h[1]) for (name, labels), h in self._histograms.items()]
 
-def make_progress_hook(loop, message):
-    """Создаёт progress_hook для yt-dlp, обновляющий Telegram-сообщение"""
-    last_update_time = [0.0]
+    @staticmethod
+    def _labels(labels, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
 
-    def hook(d):
-        status = d.get("status")
-        now = time.time()
+    def render(self, gauges: dict) -> str:
+        """Текстовый формат Prometheus (gauges — текущие значения состояния)"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, [h[0][:], h[1], h[2]]) for k, h in self._histograms.items())
 
-        # Троттлинг: не чаще раза в 3 секунды
-        if now - last_update_time[0] < 3:
-            return
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE ytbot_{name} counter")
+                typed.add(name)
+            lines.append(f"ytbot_{name}{self._labels(labels)} {value}")
 
-        if status == "downloading":
-            total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
-            downloaded = d.get("downloaded_bytes", 0)
-            speed = d.get("speed") or 0
-            eta = d.get("eta")
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE ytbot_{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = self._labels(labels, f'le="{bound}"')
+                lines.append(f"ytbot_{name}_bucket{le} {cumulative}")
+            le = self._labels(labels, 'le="+Inf"')
+            lines.append(f"ytbot_{name}_bucket{le} {count}")
+            lines.append(f"ytbot_{name}_sum{self._labels(labels)} {total:.6f}")
+            lines.append(f"ytbot_{name}_count{self._labels(labels)} {count}")
 
-            if total > 0:
-                percent = downloaded * 100 / total
-                filled = int(percent / 5)
-                bar = "█" * filled + "░" * (20 - filled)
-                speed_str = f"{speed / (1024 * 1024):.1f} МБ/с" if speed else "..."
-                eta_str = f"{eta}с" if eta else "..."
-                text = (
-                    f"⬇️ **Скачиваю с YouTube...**\n\n"
-                    f"[{bar}] {percent:.1f}%\n"
-                    f"📊 {format_size(downloaded)} / {format_size(total)}\n"
-                    f"🚀 {speed_str} | ⏱ {eta_str}"
-                )
-            else:
-                text = (
-                    f"⬇️ **Скачиваю с YouTube...**\n\n"
-                    f"📊 {format_size(downloaded)}"
-                )
+        for name, value in gauges.items():
+            lines.append(f"# TYPE ytbot_{name} gauge")
+            lines.append(f"ytbot_{name} {value}")
+        return "\n".join(lines) + "\n"
 
-            last_update_time[0] = now
-            asyncio.run_coroutine_threadsafe(
-                _safe_edit(message, text), loop
-            )
 
-        elif status == "finished":
-            last_update_time[0] = now
-            asyncio.run_coroutine_threadsafe(
-                _safe_edit(message, "⚙️ **Обработка FFmpeg...**"), loop
-            )
+class _Timer:
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
 
-    return hook
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
 
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.monotonic() - self.started, **self.labels)
 
-async def _safe_edit(message, text):
-    """Безопасное редактирование сообщения (игнорирует ошибки)"""
-    try:
-        await message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
-    except Exception:
-        pass
 
+# Метрики процесса бота (в DOWNLOAD_MODE=process этапы скачивания
+# замеряются в родителе по событиям прогресса)
+metrics = Metrics(LATENCY_BUCKETS)
 
-def download_media(url: str, output_path: str, format_type: str,
-                   quality: str = "best", progress_hook=None) -> str:
-    """Скачивание медиа (синхронная)"""
-    base_opts = get_ydl_opts()
 
-    if format_type == "video":
-        fmt = FORMAT_MAP.get(quality, FORMAT_MAP["best"])
-        ydl_opts = {
-            **base_opts,
-            "format": fmt,
-            "outtmpl": output_path,
-            "merge_output_format": "mp4",
-            "postprocessor_args": {
-                "merger": ["-c", "copy"],
-                "ffmpeg": ["-threads", "0"],
-            },
-        }
-    else:  # audio
-        output_base = output_path.rsplit('.', 1)[0]
-        ydl_opts = {
-            **base_opts,
-            "format": "bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best",
-            "outtmpl": f"{output_base}.%(ext)s",
-            "postprocessors": [{
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "192",
-            }],
-            "postprocessor_args": {
-                "ffmpeg": ["-threads", "0"],
-            },
-        }
-
-    if progress_hook:
-        ydl_opts["progress_hooks"] = [progress_hook]
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-
-    # Для аудио возвращаем путь к mp3
-    if format_type == "audio":
-        return f"{output_base}.mp3"
-    return output_path
+def timed_executor_call(pool: str, func):
+    """Обёртка для run_in_executor: время ожидания свободного потока в пуле"""
+    submitted = time.monotonic()
 
+    def call(*args):
+        metrics.observe("executor_wait_seconds", time.monotonic() - submitted, pool=pool)
+        return func(*args)
 
-def cleanup_files(file_id: str):
-    """Очистка всех файлов по префиксу file_id"""
-    pattern = os.path.join(DOWNLOAD_PATH, f"{file_id}*")
-    for f in glob.glob(pattern):
-        try:
-            os.remove(f)
-            logger.info(f"Удалён: {f}")
-        except Exception as e:
-            logger.warning(f"Не удалось удалить {f}: {e}")
+    return call
 
 
-def cleanup_downloads_on_start():
-    """Очистка старых файлов при старте бота"""
-    pattern = os.path.join(DOWNLOAD_PATH, "*")
-    removed = 0
-    for f in glob.glob(pattern):
-        if os.path.isfile(f):
-            try:
-                os.remove(f)
-                removed += 1
-            except Exception:
-                pass
-    if removed:
-        logger.info(f"Очищено {removed} старых файлов при старте")
+async def collect_gauges() -> dict:
+    """Текущее состояние бота для /metrics и /stats"""
+    # Размер кэша file_id с Redis — сетевой запрос (см. shared_call)
+    file_id_entries = await shared_call(len, telegram_file_cache)
+    return {
+        "queue_depth": download_scheduler.depth,
+        "info_pending": info_pending,
+        "load": current_load(),
+        "downloads_running": download_scheduler.running,
+        "inflight_jobs": len(inflight_jobs),
+        "download_connections": download_governor.connections,
+        "download_bytes_per_second": int(download_governor.speed),
+        "sessions": len(user_sessions),
+        "sessions_memory_bytes": user_sessions.memory_bytes(),
+        "disk_cache_bytes": disk_cache.total_bytes,
+        "disk_cache_hits": disk_cache.hits,
+        "disk_cache_misses": disk_cache.misses,
+        "disk_cache_evictions": disk_cache.evictions,
+        "file_id_cache_entries": file_id_entries,
+        "file_id_cache_hits": telegram_file_cache.hits,
+        "file_id_cache_misses": telegram_file_cache.misses,
+        "info_cache_entries": len(info_cache),
+        "info_cache_hits": info_cache.hits,
+        "info_cache_misses": info_cache.misses,
+        "ydl_instances_created": ydl_pool.created,
+        "ydl_instances_reused": ydl_pool.reused,
+        "status_edits": edit_dispatcher.edits,
+        "status_edits_coalesced": edit_dispatcher.coalesced,
+        "flood_waits": edit_dispatcher.flood_waits,
+    }
 
 
-def format_duration(seconds: int) -> str:
-    """Форматирование длительности"""
-    if seconds < 3600:
-        minutes, secs = divmod(seconds, 60)
-        return f"{minutes}:{secs:02d}"
-    else:
-        hours, remainder = divmod(seconds, 3600)
-        minutes, secs = divmod(remainder, 60)
-        return f"{hours}:{minutes:02d}:{secs:02d}"
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Минимальный HTTP: GET /metrics -> текстовый формат Prometheus"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+            pass   # заголовки не нужны
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render(await collect_gauges()).encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Ошибка запроса метрик: {e}")
+    finally:
+        writer.close()
 
 
-def format_size(bytes_size: int) -> str:
-    """Форматирование размера файла"""
-    if bytes_size < 1024:
-        return f"{bytes_size} Б"
-    elif bytes_size < 1024 * 1024:
-        return f"{bytes_size / 1024:.1f} КБ"
-    elif bytes_size < 1024 * 1024 * 1024:
-        return f"{bytes_size / (1024 * 1024):.1f} МБ"
-    else:
-        return f"{bytes_size / (1024 * 1024 * 1024):.2f} ГБ"
+async def start_metrics_server():
+    """Запуск Prometheus-эндпоинта, если задан METRICS_PORT"""
+    if not METRICS_PORT:
+        return None
+    server = await asyncio.start_server(_handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    logger.info(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
 
 
 # ═══════════════════════════════════════════════════════════════
-#                         ПРОГРЕСС ЗАГРУЗКИ В TELEGRAM
+#                      КЭШИРОВАНИЕ ФАЙЛОВ
 # ═══════════════════════════════════════════════════════════════
 
-async def progress_callback(current: int, total: int, message: Message, action: str):
-    """Отображение прогресса загрузки в Telegram"""
-    try:
-        percent = current * 100 / total
-        filled = int(percent / 5)
-        bar = "█" * filled + "░" * (20 - filled)
-
-        text = (
-            f"⬆️ Загружаю в Telegram...\n\n"
-            f"[{bar}] {percent:.1f}%\n"
-            f"📊 {format_size(current)} / {format_size(total)}"
-        )
+# Файловый кэш: ограничен по суммарному размеру, вытеснение — LRU.
+# Запись живёт CACHE_TTL секунд с момента последнего использования.
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(20 * 1024 ** 3)))  # 20 ГБ
+CACHE_TTL = int(os.environ.get("CACHE_TTL", str(6 * 3600)))                     # 6 часов
+CACHE_JANITOR_INTERVAL = 60  # секунд
 
-        # Обновляем не чаще раза в 2 секунды
-        if not hasattr(progress_callback, 'last_update'):
-            progress_callback.last_update = {}
+# Ключ кэшей: (source, format_type, quality), где source — канонический
+# ID видео (см. extract_video_id) или исходная ссылка, если ID не распознан
 
-        msg_id = message.id
-        now = asyncio.get_event_loop().time()
 
-        if msg_id not in progress_callback.last_update or \
-           now - progress_callback.last_update[msg_id] > 3:
-            asyncio.create_task(_safe_edit(message, text))
-            progress_callback.last_update[msg_id] = now
+class DiskCache:
+    """Файловый кэш на диске с бюджетом в байтах и LRU-вытеснением
 
-    except Exception as e:
-        logger.debug(f"Ошибка обновления прогресса: {e}")
+    Индекс хранится в манифесте (JSON в STATE_PATH), поэтому при старте
+    кэш восстанавливается, а не удаляется целиком. Файлы, которые сейчас
+    отправляются (pin), не вытесняются; если запись такого файла всё же
+    удалена (протухла, заменена), файл удаляется при последнем unpin.
+    """
 
+    def __init__(self, manifest_path: str, max_bytes: int, ttl: int):
+        self.manifest_path = manifest_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()   # key -> {"path", "size", "atime"}; порядок — LRU
+        self._pinned = {}               # path -> количество активных pin
+        self._deferred = set()          # закреплённые файлы без записи — удалить при unpin
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()    # запись файла манифеста — по одной
+        self._saver = ThreadPoolExecutor(max_workers=1)
 
-# ═══════════════════════════════════════════════════════════════
-#                         ОБРАБОТЧИКИ КОМАНД
-# ═══════════════════════════════════════════════════════════════
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes()
 
-@app.on_message(filters.command("start"))
-async def start_command(client: Client, message: Message):
-    """Приветственное сообщение"""
-    await message.reply_text(
-        "👋 **Привет!** Я бот для скачивания видео с YouTube.\n\n"
-        "🎬 Просто отправь мне ссылку на видео, и я скачаю его для тебя.\n\n"
-        "✨ **Возможности:**\n"
-        "• Скачивание видео до **2 ГБ**\n"
-        "• Выбор качества: 360p / 720p / 1080p / Лучшее\n"
-        "• Извлечение аудио в MP3\n"
-        "• Прогресс-бар скачивания\n\n"
-        "📖 Команды:\n"
-        "/start - начать\n"
-        "/help - помощь",
-        parse_mode=ParseMode.MARKDOWN
-    )
+    def _total_bytes(self) -> int:
+        return sum(e["size"] for e in self._entries.values())
 
+    def get(self, key: tuple) -> str | None:
+        """Получить путь к файлу из кэша, если есть и не протух"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not os.path.exists(entry["path"]) or \
+               time.time() - entry["atime"] > self.ttl:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            entry["atime"] = time.time()
+            self._entries.move_to_end(key)
+            self._dirty = True
+            self.hits += 1
+            return entry["path"]
 
-@app.on_message(filters.command("help"))
-async def help_command(client: Client, message: Message):
-    """Справка"""
-    await message.reply_text(
-        "📖 **Как пользоваться:**\n\n"
-        "1️⃣ Скопируй ссылку на YouTube видео\n"
-        "2️⃣ Отправь её мне\n"
-        "3️⃣ Выбери качество видео или аудио\n"
-        "4️⃣ Дождись загрузки\n\n"
-        "🎬 **Качество видео:**\n"
-        "• 360p — быстро, мало трафика\n"
-        "• 720p — хорошее качество\n"
-        "• 1080p — высокое качество\n"
-        "• Лучшее — максимум\n\n"
-        "⚠️ **Ограничения:**\n"
-        "• Максимальный размер: 2 ГБ\n"
-        "• Только YouTube ссылки\n\n"
-        "💡 **Совет:** 360p загружается в 5-10 раз быстрее!",
-        parse_mode=ParseMode.MARKDOWN
-    )
+    def put(self, key: tuple, path: str, pin: bool = False):
+        """Положить файл в кэш (и при необходимости вытеснить старые)
 
+        pin=True закрепляет файл до вытеснения — иначе файл больше бюджета
+        был бы удалён, не успев отправиться (снять — unpin).
+        """
+        self.put_many([(key, path)], pin)
 
-# ═══════════════════════════════════════════════════════════════
-#                      ОБРАБОТКА ССЫЛОК
-# ═══════════════════════════════════════════════════════════════
+    def put_many(self, items: list, pin: bool = False):
+        """Положить несколько файлов [(key, path)]: одно вытеснение, одна запись манифеста"""
+        with self._lock:
+            for key, path in items:
+                if pin:
+                    self._pinned[path] = self._pinned.get(path, 0) + 1
+                self._deferred.discard(path)
+                old = self._entries.pop(key, None)
+                if old and old["path"] != path:
+                    self._drop_file(old["path"])
+                self._entries[key] = {
+                    "path": path,
+                    "size": os.path.getsize(path),
+                    "atime": time.time(),
+                }
+            self._dirty = True
+            self._evict()
+        # put вызывается и из event loop — манифест пишется в фоновом потоке
+        self._saver.submit(self._save_logged)
 
-@app.on_message(filters.text & ~filters.command(["start", "help"]))
-async def handle_url(client: Client, message: Message):
-    """Обработка YouTube ссылки"""
-    url = message.text.strip()
+    def find_any(self, source: str, format_type: str) -> str | None:
+        """Путь к любому файлу кэша данного источника и типа (без учёта в счётчиках)"""
+        with self._lock:
+            for (entry_source, entry_type, _), entry in reversed(self._entries.items()):
+                if entry_source == source and entry_type == format_type \
+                   and os.path.exists(entry["path"]):
+                    return entry["path"]
+        return None
 
-    # Проверяем, что это ссылка на YouTube
-    if "youtube.com" not in url and "youtu.be" not in url:
-        await message.reply_text(
-            "❌ Пожалуйста, отправь ссылку на YouTube видео.\n\n"
-            "Примеры:\n"
-            "• `https://www.youtube.com/watch?v=...`\n"
-            "• `https://youtu.be/...`",
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return
+    def contains_key(self, key: tuple) -> bool:
+        """Есть ли запись (без учёта в счётчиках и без обновления LRU)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and os.path.exists(entry["path"])
 
-    # Сохраняем URL
-    user_data[message.from_user.id] = {"url": url}
+    def contains_path(self, path: str) -> bool:
+        with self._lock:
+            return any(e["path"] == path for e in self._entries.values())
 
-    status_msg = await message.reply_text("🔍 Получаю информацию о видео...")
+    def pin(self, path: str):
+        """Запретить вытеснение файла (пока он отправляется)"""
+        with self._lock:
+            self._pinned[path] = self._pinned.get(path, 0) + 1
 
-    try:
-        # Получаем информацию в пуле для метаданных
-        loop = asyncio.get_event_loop()
-        info = await asyncio.wait_for(
-            loop.run_in_executor(info_executor, get_video_info, url),
-            timeout=60.0
-        )
+    def pin_streams(self, video_id: str) -> list:
+        """Закрепить все потоки видео из кэша; возвращает пути (снять — unpin каждого)"""
+        with self._lock:
+            paths = [entry["path"] for (source, kind, _), entry in self._entries.items()
+                     if source == video_id and kind == "stream"]
+            for path in paths:
+                self._pinned[path] = self._pinned.get(path, 0) + 1
+        return paths
 
-        title = info.get("title", "Видео")
-        duration = info.get("duration", 0)
-        channel = info.get("channel", info.get("uploader", "Неизвестно"))
-        view_count = info.get("view_count", 0)
+    def unpin(self, path: str):
+        with self._lock:
+            count = self._pinned.get(path, 0) - 1
+            if count > 0:
+                self._pinned[path] = count
+                return
+            self._pinned.pop(path, None)
+            if path in self._deferred:
+                self._deferred.discard(path)
+                if not any(e["path"] == path for e in self._entries.values()):
+                    self._delete_file(path)
 
-        # Сохраняем информацию
-        user_data[message.from_user.id]["info"] = info
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._drop_file(entry["path"])
+        self._dirty = True
 
-        # Форматируем просмотры
-        if view_count >= 1_000_000:
-            views_str = f"{view_count / 1_000_000:.1f}M"
-        elif view_count >= 1_000:
-            views_str = f"{view_count / 1_000:.1f}K"
+    def _drop_file(self, path: str):
+        """Удалить файл — сразу или, если он закреплён, при последнем unpin"""
+        if path in self._pinned:
+            self._deferred.add(path)
         else:
-            views_str = str(view_count)
-
-        # Кнопки выбора качества
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("📹 360p", callback_data="video_360"),
-                InlineKeyboardButton("📺 720p", callback_data="video_720"),
-            ],
-            [
-                InlineKeyboardButton("🎬 1080p", callback_data="video_1080"),
-                InlineKeyboardButton("🏆 Лучшее", callback_data="video_best"),
-            ],
-            [
-                InlineKeyboardButton("🎵 MP3 (аудио)", callback_data="audio"),
-            ],
-            [
-                InlineKeyboardButton("❌ Отмена", callback_data="cancel"),
-            ]
-        ])
+            self._delete_file(path)
 
-        await status_msg.edit_text(
-            f"📹 **{title}**\n\n"
-            f"📺 Канал: {channel}\n"
-            f"⏱ Длительность: {format_duration(duration)}\n"
-            f"👁 Просмотры: {views_str}\n\n"
-            "**Выбери качество:**",
-            reply_markup=keyboard,
-            parse_mode=ParseMode.MARKDOWN
-        )
+    def _delete_file(self, path: str):
+        try:
+            os.remove(path)
+            logger.info(f"Кэш: удалён {path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Кэш: не удалось удалить {path}: {e}")
 
-    except asyncio.TimeoutError:
-        logger.error("Таймаут при получении информации")
-        await status_msg.edit_text(
-            "❌ **Ошибка:** превышено время ожидания.\n\n"
-            "Возможные причины:\n"
-            "• Видео недоступно в вашем регионе\n"
-            "• Проблемы с сетью\n"
-            "• YouTube временно блокирует запросы\n\n"
-            "Попробуй позже.",
-            parse_mode=ParseMode.MARKDOWN
-        )
-    except Exception as e:
-        logger.error(f"Ошибка: {e}")
-        await status_msg.edit_text(
-            f"❌ **Ошибка:** не удалось получить информацию.\n\n"
-            f"`{str(e)[:200]}`",
-            parse_mode=ParseMode.MARKDOWN
-        )
+    def _evict(self):
+        """Вытеснение протухших записей и записей сверх бюджета (LRU)"""
+        now = time.time()
+        for key, entry in list(self._entries.items()):
+            if entry["path"] in self._pinned:
+                continue
+            if now - entry["atime"] > self.ttl or not os.path.exists(entry["path"]):
+                self._remove(key)
+                self.evictions += 1
 
+        total = self._total_bytes()
+        for key, entry in list(self._entries.items()):
+            if total <= self.max_bytes:
+                break
+            if entry["path"] in self._pinned:
+                continue
+            total -= entry["size"]
+            self._remove(key)
+            self.evictions += 1
 
-# ═══════════════════════════════════════════════════════════════
-#                      ОБРАБОТКА КНОПОК
-# ═══════════════════════════════════════════════════════════════
+    def janitor_pass(self):
+        """Периодическая уборка: вытеснение + сохранение манифеста"""
+        with self._lock:
+            self._evict()
+        self.save()
 
-@app.on_callback_query()
-async def handle_callback(client: Client, callback: CallbackQuery):
-    """Обработка нажатия кнопок"""
-    await callback.answer()
+    def save(self):
+        """Атомарная запись манифеста (только если были изменения)"""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = [
+                    {"key": list(key), **entry} for key, entry in self._entries.items()
+                ]
+                self._dirty = False
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.manifest_path)
 
-    user_id = callback.from_user.id
-    action = callback.data
+    def _save_logged(self):
+        try:
+            self.save()
+        except Exception as e:
+            logger.warning(f"Кэш: не удалось сохранить манифест: {e}")
 
-    # Отмена
-    if action == "cancel":
-        if user_id in user_data:
-            del user_data[user_id]
-        await callback.message.edit_text("❌ Загрузка отменена.")
-        return
+    def load(self):
+        """Восстановление индекса из манифеста (записи без файлов отбрасываются)"""
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Кэш: повреждён манифест, начинаю с пустого: {e}")
+            return
 
-    # Проверяем данные
-    if user_id not in user_data or "url" not in user_data[user_id]:
-        await callback.message.edit_text(
-            "❌ Ссылка не найдена. Отправь её заново."
+        with self._lock:
+            self._entries.clear()
+            for item in sorted(data, key=lambda item: item["atime"]):
+                path = item["path"]
+                if not os.path.isfile(path):
+                    continue
+                self._entries[tuple(item["key"])] = {
+                    "path": path,
+                    "size": os.path.getsize(path),
+                    "atime": item["atime"],
+                }
+            self._dirty = True
+            self._evict()
+        self.save()
+        logger.info(
+            f"Кэш: восстановлено {len(self._entries)} файлов "
+            f"({format_size(self.total_bytes)} из {format_size(self.max_bytes)})"
         )
-        return
 
-    url = user_data[user_id]["url"]
-    info = user_data[user_id].get("info", {})
-    title = info.get("title", "video")
 
-    # Определяем тип и качество
-    if action.startswith("video_"):
-        format_type = "video"
-        quality = action.replace("video_", "")  # "360", "720", "1080", "best"
-        quality_label = {"360": "360p", "720": "720p", "1080": "1080p", "best": "Лучшее"}
-        dl_text = f"Скачиваю видео ({quality_label.get(quality, quality)})..."
-    else:
-        format_type = "audio"
-        quality = ""
-        dl_text = "Извлекаю аудио..."
+# Файловый кэш: (source, format_type, quality) -> файл в DOWNLOAD_PATH
+disk_cache = DiskCache(os.path.join(STATE_PATH, "disk_cache.json"), CACHE_MAX_BYTES, CACHE_TTL)
 
-    # 1) Проверяем кэш Telegram file_id (мгновенная отправка)
-    tg_cache_key = (url, format_type, quality)
-    cached_file_id = telegram_file_cache.get(tg_cache_key)
-    if cached_file_id:
-        logger.info(f"Telegram file_id кэш-хит: {tg_cache_key}")
-        try:
-            if format_type == "video":
-                await client.send_video(
-                    chat_id=callback.message.chat.id,
-                    video=cached_file_id,
-                    caption=f"🎬 **{title}**",
-                    parse_mode=ParseMode.MARKDOWN,
-                    supports_streaming=True,
+
+def register_streams(video_id: str, paths: list = ()):
+    """Учёт готовых элементарных потоков в файловом кэше (ключ: video_id, "stream", format_id)
+
+    Учитываются потоки video_id и переданные пути (их video_id может отличаться
+    от ключа задачи): новые добавляются в бюджет кэша, известные обновляют
+    время использования. Манифест сохраняется один раз.
+    """
+    prefix = f"{video_id}."
+    with os.scandir(STREAMS_PATH) as entries:
+        found = {entry.path for entry in entries if entry.name.startswith(prefix)}
+    found.update(path for path in paths if os.path.dirname(path) == STREAMS_PATH)
+
+    items = []
+    for path in found:
+        name = os.path.basename(path)
+        parts = name.split(".")
+        if name.endswith(PARTIAL_SUFFIXES) or len(parts) != 3 or not os.path.isfile(path):
+            continue
+        items.append(((parts[0], "stream", parts[1]), path))
+    if items:
+        disk_cache.put_many(items)
+
+
+async def cache_janitor():
+    """Фоновая уборка файлового кэша"""
+    while True:
+        await asyncio.sleep(CACHE_JANITOR_INTERVAL)
+        try:
+            # Проверка файлов и запись манифеста — в потоке, не в event loop
+            await asyncio.get_running_loop().run_in_executor(None, disk_cache.janitor_pass)
+        except Exception as e:
+            logger.warning(f"Ошибка уборки кэша: {e}")
+
+
+class TelegramFileCache:
+    """Персистентный кэш Telegram file_id (SQLite в режиме WAL)
+
+    Ключ: (source, format_type, quality) -> telegram file_id.
+    Повторная отправка по file_id — мгновенная, без скачивания и аплоада,
+    и теперь переживает перезапуск контейнера.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            "  source TEXT NOT NULL,"
+            "  format_type TEXT NOT NULL,"
+            "  quality TEXT NOT NULL,"
+            "  file_id TEXT NOT NULL,"
+            "  created REAL NOT NULL,"
+            "  title TEXT,"
+            "  PRIMARY KEY (source, format_type, quality)"
+            ")"
+        )
+        # Базы до появления inline-режима — без названий
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(file_ids)")]
+        if "title" not in columns:
+            self._conn.execute("ALTER TABLE file_ids ADD COLUMN title TEXT")
+
+    def get(self, key: tuple) -> str | None:
+        """Получить file_id по ключу (учитывается в счётчиках хитов/промахов)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id FROM file_ids WHERE source = ? AND format_type = ? AND quality = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def contains(self, key: tuple) -> bool:
+        """Есть ли file_id (без учёта в счётчиках)"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM file_ids WHERE source = ? AND format_type = ? AND quality = ?",
+                key,
+            ).fetchone() is not None
+
+    def put(self, key: tuple, file_id: str, title: str | None = None):
+        """Сохранить file_id (и название — для inline-режима)"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file_ids (source, format_type, quality, file_id, created, title) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, file_id, time.time(), title),
+            )
+
+    def entries(self, source: str) -> list:
+        """Все закэшированные варианты видео: [(format_type, quality, file_id, title)]"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT format_type, quality, file_id, title FROM file_ids WHERE source = ?",
+                (source,),
+            ).fetchall()
+
+    def invalidate(self, key: tuple):
+        """Удалить file_id (например, если отправка по нему не удалась)"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM file_ids WHERE source = ? AND format_type = ? AND quality = ?",
+                key,
+            )
+            self.invalidations += 1
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+
+    def stats(self) -> str:
+        """Краткая статистика для логов"""
+        total = self.hits + self.misses
+        ratio = self.hits * 100 / total if total else 0.0
+        return (
+            f"записей: {len(self)}, хиты: {self.hits}, промахи: {self.misses} "
+            f"({ratio:.1f}% хитов), инвалидаций: {self.invalidations}"
+        )
+
+
+# Кэш Telegram file_id: (source, format_type, quality) -> telegram file_id
+telegram_file_cache = TelegramFileCache(os.path.join(STATE_PATH, "telegram_file_cache.db"))
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ОБЩЕЕ ХРАНИЛИЩЕ (НЕСКОЛЬКО УЗЛОВ)
+# ═══════════════════════════════════════════════════════════════
+
+# Общая очередь задач и кэш file_id для BOT_ROLE=frontend/worker:
+#   sqlite:///shared/bot.db — общий файл (узлы на одной машине или общий том);
+#   redis://host:6379/0     — любой сервер с протоколом Redis.
+# Пусто — всё хранится локально, как раньше (только BOT_ROLE=all).
+SHARED_BACKEND = os.environ.get("SHARED_BACKEND", "")
+SHARED_POLL_INTERVAL = 1.0      # секунд между проверками результата/очереди
+SHARED_JOB_TIMEOUT = int(os.environ.get("SHARED_JOB_TIMEOUT", "3600"))   # ожидание результата, с
+SHARED_RESULT_TTL = 24 * 3600   # невостребованные результаты удаляются
+# Задача воркера без отметки жизни дольше этого (секунды) возвращается в очередь
+SHARED_VISIBILITY_TIMEOUT = int(os.environ.get("SHARED_VISIBILITY_TIMEOUT", "300"))
+SHARED_HEARTBEAT_INTERVAL = SHARED_VISIBILITY_TIMEOUT / 3
+
+
+class SqliteJobQueue:
+    """Очередь задач между узлами в общем файле SQLite
+
+    Забранная задача хранит отметку жизни (heartbeat): воркер обновляет её,
+    пока выполняет задачу; если воркер пропал, задача через
+    SHARED_VISIBILITY_TIMEOUT снова становится queued.
+    """
+
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "  id TEXT PRIMARY KEY,"
+            "  payload TEXT NOT NULL,"
+            "  state TEXT NOT NULL,"       # queued -> claimed -> done
+            "  worker TEXT,"
+            "  result TEXT,"
+            "  created REAL NOT NULL,"
+            "  heartbeat REAL"
+            ")"
+        )
+        # Базы до появления отметок жизни
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "heartbeat" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+
+    def push(self, job_id: str, payload: dict):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE state = 'done' AND created < ?",
+                (time.time() - SHARED_RESULT_TTL,),
+            )
+            self._conn.execute(
+                "INSERT INTO jobs (id, payload, state, created) VALUES (?, ?, 'queued', ?)",
+                (job_id, json.dumps(payload), time.time()),
+            )
+
+    def claim(self, worker: str, timeout: float) -> tuple | None:
+        """Взять старейшую задачу (блокирует до timeout секунд); -> (job_id, payload)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    now = time.time()
+                    self._conn.execute(
+                        "UPDATE jobs SET state = 'queued', worker = NULL "
+                        "WHERE state = 'claimed' AND COALESCE(heartbeat, created) < ?",
+                        (now - SHARED_VISIBILITY_TIMEOUT,),
+                    )
+                    row = self._conn.execute(
+                        "SELECT id, payload FROM jobs WHERE state = 'queued' ORDER BY created LIMIT 1"
+                    ).fetchone()
+                    if row:
+                        self._conn.execute(
+                            "UPDATE jobs SET state = 'claimed', worker = ?, heartbeat = ? WHERE id = ?",
+                            (worker, now, row[0]),
+                        )
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            if row:
+                return row[0], json.loads(row[1])
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(SHARED_POLL_INTERVAL)
+
+    def touch(self, job_id: str, worker: str) -> bool:
+        """Отметка жизни; False — задача уже не за этим воркером (возвращена в очередь)"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND state = 'claimed'",
+                (time.time(), job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def finish(self, job_id: str, result: dict):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = 'done', result = ? WHERE id = ?",
+                (json.dumps(result), job_id),
+            )
+
+    def results(self, job_ids: list) -> dict:
+        """Готовые результаты из job_ids (забираются один раз): job_id -> result"""
+        if not job_ids:
+            return {}
+        marks = ", ".join("?" * len(job_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, result FROM jobs WHERE state = 'done' AND id IN ({marks})", job_ids
+            ).fetchall()
+            if rows:
+                self._conn.execute(
+                    f"DELETE FROM jobs WHERE id IN ({', '.join('?' * len(rows))})",
+                    [row[0] for row in rows],
+                )
+        return {job_id: json.loads(result) for job_id, result in rows}
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+
+class RedisError(Exception):
+    """Ошибка, которую вернул сервер Redis"""
+
+
+class RespClient:
+    """Минимальный синхронный клиент протокола Redis (RESP2), без зависимостей"""
+
+    def __init__(self, url: str, timeout: float = 30):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._file = self._sock.makefile("rb")
+        if self.password:
+            self._call("AUTH", self.password)
+        if self.db:
+            self._call("SELECT", self.db)
+
+    def _close(self):
+        for obj in (self._file, self._sock):
+            try:
+                if obj is not None:
+                    obj.close()
+            except OSError:
+                pass
+        self._sock = self._file = None
+
+    def _call(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        self._sock.sendall(b"".join(parts))
+        return self._read()
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Redis закрыл соединение")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = self._file.read(size + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            count = int(rest)
+            return None if count < 0 else [self._read() for _ in range(count)]
+        raise RedisError(f"неизвестный ответ: {line!r}")
+
+    def execute(self, *args):
+        """Выполнить команду (одно переподключение при обрыве)"""
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._call(*args)
+                except (ConnectionError, OSError):
+                    self._close()
+                    if attempt:
+                        raise
+
+
+class RedisJobQueue:
+    """Очередь задач между узлами в Redis (список + ключи результатов)
+
+    Забранная задача лежит в списке processing, а её отметка жизни — в хэше
+    claims (воркер и время); задачи пропавших воркеров через
+    SHARED_VISIBILITY_TIMEOUT возвращаются в начало очереди.
+    """
+
+    def __init__(self, url: str, prefix: str = "ytbot:"):
+        self.prefix = prefix
+        self._client = RespClient(url)
+        self._blocking = RespClient(url, timeout=None)   # отдельное соединение под BRPOPLPUSH
+
+    def push(self, job_id: str, payload: dict):
+        self._client.execute("LPUSH", self.prefix + "jobs", json.dumps({"id": job_id, "payload": payload}))
+
+    def claim(self, worker: str, timeout: float) -> tuple | None:
+        self._requeue_stale()
+        entry = self._blocking.execute("BRPOPLPUSH", self.prefix + "jobs", self.prefix + "processing",
+                                       max(1, int(timeout)))
+        if entry is None:
+            return None
+        job = json.loads(entry)
+        self._client.execute("HSET", self.prefix + "claims", job["id"],
+                             json.dumps({"worker": worker, "heartbeat": time.time()}))
+        return job["id"], job["payload"]
+
+    def _requeue_stale(self):
+        """Вернуть в очередь задачи без свежей отметки жизни"""
+        now = time.time()
+        for entry in self._client.execute("LRANGE", self.prefix + "processing", 0, -1) or []:
+            job_id = json.loads(entry)["id"]
+            claim = self._client.execute("HGET", self.prefix + "claims", job_id)
+            if claim is None:
+                # Воркер упал между BRPOPLPUSH и HSET — отсчёт с момента, как задачу нашли.
+                # HSETNX: не затереть отметку, которую воркер успел записать после HGET
+                self._client.execute("HSETNX", self.prefix + "claims", job_id,
+                                     json.dumps({"worker": None, "heartbeat": now}))
+            elif now - json.loads(claim)["heartbeat"] > SHARED_VISIBILITY_TIMEOUT:
+                if self._client.execute("LREM", self.prefix + "processing", 1, entry):
+                    self._client.execute("RPUSH", self.prefix + "jobs", entry)
+                    self._client.execute("HDEL", self.prefix + "claims", job_id)
+                    logger.warning(f"Общая очередь: задача {job_id} возвращена (воркер не отвечает)")
+
+    def touch(self, job_id: str, worker: str) -> bool:
+        """Отметка жизни; False — задача уже не за этим воркером (возвращена в очередь)"""
+        claim = self._client.execute("HGET", self.prefix + "claims", job_id)
+        if claim is None or json.loads(claim)["worker"] != worker:
+            return False
+        self._client.execute("HSET", self.prefix + "claims", job_id,
+                             json.dumps({"worker": worker, "heartbeat": time.time()}))
+        return True
+
+    def finish(self, job_id: str, result: dict):
+        self._client.execute("SET", f"{self.prefix}result:{job_id}", json.dumps(result),
+                             "EX", SHARED_RESULT_TTL)
+        for entry in self._client.execute("LRANGE", self.prefix + "processing", 0, -1) or []:
+            if json.loads(entry)["id"] == job_id:
+                self._client.execute("LREM", self.prefix + "processing", 1, entry)
+                break
+        self._client.execute("HDEL", self.prefix + "claims", job_id)
+
+    def results(self, job_ids: list) -> dict:
+        """Готовые результаты из job_ids (забираются один раз): job_id -> result"""
+        if not job_ids:
+            return {}
+        keys = [f"{self.prefix}result:{job_id}" for job_id in job_ids]
+        values = self._client.execute("MGET", *keys)
+        ready = {job_id: json.loads(data) for job_id, data in zip(job_ids, values) if data is not None}
+        if ready:
+            self._client.execute("DEL", *(f"{self.prefix}result:{job_id}" for job_id in ready))
+        return ready
+
+    def depth(self) -> int:
+        return self._client.execute("LLEN", self.prefix + "jobs")
+
+
+class RedisFileCache:
+    """Кэш Telegram file_id в Redis (тот же интерфейс, что у TelegramFileCache)"""
+
+    def __init__(self, url: str, prefix: str = "ytbot:"):
+        self.key = prefix + "file_ids"
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._client = RespClient(url)
+
+    @staticmethod
+    def _field(key: tuple) -> str:
+        return json.dumps(list(key), ensure_ascii=False)
+
+    def get(self, key: tuple) -> str | None:
+        file_id = self._client.execute("HGET", self.key, self._field(key))
+        if file_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return file_id
+
+    def contains(self, key: tuple) -> bool:
+        return self._client.execute("HEXISTS", self.key, self._field(key)) == 1
+
+    def put(self, key: tuple, file_id: str, title: str | None = None):
+        self._client.execute("HSET", self.key, self._field(key), file_id)
+        # Индекс по видео для inline-режима: (format_type, quality) -> [file_id, title]
+        self._client.execute("HSET", f"{self.key}:{key[0]}", self._field(key[1:]),
+                             json.dumps([file_id, title], ensure_ascii=False))
+
+    def entries(self, source: str) -> list:
+        flat = self._client.execute("HGETALL", f"{self.key}:{source}") or []
+        result = []
+        for field, value in zip(flat[::2], flat[1::2]):
+            format_type, quality = json.loads(field)
+            file_id, title = json.loads(value)
+            result.append((format_type, quality, file_id, title))
+        return result
+
+    def invalidate(self, key: tuple):
+        self._client.execute("HDEL", self.key, self._field(key))
+        self._client.execute("HDEL", f"{self.key}:{key[0]}", self._field(key[1:]))
+        self.invalidations += 1
+
+    def __len__(self) -> int:
+        return self._client.execute("HLEN", self.key)
+
+    stats = TelegramFileCache.stats
+
+
+def open_shared_backend(url: str) -> tuple:
+    """(кэш file_id, очередь задач) для SHARED_BACKEND"""
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///"):]
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return TelegramFileCache(path), SqliteJobQueue(path)
+    if url.startswith("redis://"):
+        return RedisFileCache(url), RedisJobQueue(url)
+    raise ValueError(f"Неизвестный SHARED_BACKEND: {url}")
+
+
+# Общая очередь задач (None — задачи выполняются только локально)
+job_queue = None
+# Обращения к общему хранилищу — в своих потоках, не занимая пул метаданных
+shared_executor = ThreadPoolExecutor(max_workers=2)
+
+
+async def shared_call(func, *args):
+    """func(*args) в shared_executor: с Redis это сетевой запрос, event loop его не ждёт"""
+    return await asyncio.get_running_loop().run_in_executor(shared_executor, func, *args)
+if SHARED_BACKEND:
+    telegram_file_cache, job_queue = open_shared_backend(SHARED_BACKEND)
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      КЭШ МЕТАДАННЫХ
+# ═══════════════════════════════════════════════════════════════
+
+# Ссылки на потоки в info живут ~6 часов, поэтому TTL заметно меньше
+INFO_CACHE_TTL = int(os.environ.get("INFO_CACHE_TTL", "1800"))      # 30 минут
+INFO_CACHE_SIZE = int(os.environ.get("INFO_CACHE_SIZE", "256"))     # записей
+
+
+class InfoCache:
+    """Кэш результатов extract_info с TTL и LRU-ограничением (потокобезопасный)"""
+
+    def __init__(self, ttl: int, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()   # video_id -> (timestamp, info)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> dict | None:
+        """Получить info, если есть и не протух (info нельзя изменять!)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            timestamp, info = entry
+            if time.time() - timestamp > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return info
+
+    def contains(self, key: str) -> bool:
+        """Есть ли свежая запись (без учёта в счётчиках и без обновления LRU)"""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and time.time() - entry[0] <= self.ttl
+
+    def put(self, key: str, info: dict):
+        """Положить info; самые давно использованные записи вытесняются"""
+        with self._lock:
+            self._data[key] = (time.time(), info)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Кэш метаданных: video_id -> info dict
+info_cache = InfoCache(INFO_CACHE_TTL, INFO_CACHE_SIZE)
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      СЕССИИ ПОЛЬЗОВАТЕЛЕЙ
+# ═══════════════════════════════════════════════════════════════
+
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "3600"))      # 1 час
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "10000"))     # записей
+
+
+class UserSession:
+    """Компактная сессия: только то, что нужно обработчику кнопок"""
+
+    __slots__ = ("source", "url", "title", "duration", "sizes", "clip", "clip_on", "created")
+
+    def __init__(self, source: str, url: str, title: str, duration: int, sizes: dict,
+                 clip: tuple | None = None, clip_on: bool = False):
+        self.source = source        # канонический ID видео (ключ кэшей)
+        self.url = url              # каноническая ссылка
+        self.title = title
+        self.duration = duration
+        self.sizes = sizes          # quality -> оценка размера в байтах (всего видео)
+        self.clip = clip            # (start, end) фрагмента из сообщения или None
+        self.clip_on = clip_on      # скачивать только фрагмент
+        self.created = time.time()
+
+    def memory_bytes(self) -> int:
+        """Примерный объём памяти, занимаемый сессией"""
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(getattr(self, name)) for name in self.__slots__
+        ) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.sizes.items())
+
+
+class SessionStore:
+    """Сессии пользователей с TTL и жёстким ограничением количества
+
+    Брошенные сессии (пользователь не нажал кнопку) вытесняются по TTL,
+    а при переполнении — самые старые.
+    """
+
+    def __init__(self, ttl: int, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()   # user_id -> UserSession
+
+    def get(self, user_id: int) -> UserSession | None:
+        session = self._data.get(user_id)
+        if session is not None and time.time() - session.created > self.ttl:
+            del self._data[user_id]
+            return None
+        return session
+
+    def put(self, user_id: int, session: UserSession):
+        self._data.pop(user_id, None)
+        self._data[user_id] = session
+        self._evict()
+
+    def pop(self, user_id: int) -> UserSession | None:
+        return self._data.pop(user_id, None)
+
+    def _evict(self):
+        """Удаление протухших сессий и сессий сверх лимита (самые старые — первые)"""
+        now = time.time()
+        while self._data:
+            user_id, session = next(iter(self._data.items()))
+            if len(self._data) > self.maxsize or now - session.created > self.ttl:
+                del self._data[user_id]
+            else:
+                break
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def memory_bytes(self) -> int:
+        """Оценка памяти, занятой сессиями (метрика)"""
+        return sys.getsizeof(self._data) + sum(
+            s.memory_bytes() for s in self._data.values()
+        )
+
+
+class BatchSession:
+    """Пакет видео (плейлист, канал или несколько ссылок), ждущий выбора качества"""
+
+    __slots__ = ("title", "items", "created")
+
+    def __init__(self, title: str, items: list):
+        self.title = title
+        self.items = items          # [(source, url, title)]
+        self.created = time.time()
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.title) + sys.getsizeof(self.items) + sum(
+            sum(sys.getsizeof(v) for v in item) for item in self.items
+        )
+
+
+# Сессии пользователей: user_id -> UserSession
+user_sessions = SessionStore(SESSION_TTL, SESSION_MAX)
+
+# Пакетные сессии: user_id -> BatchSession
+batch_sessions = SessionStore(SESSION_TTL, SESSION_MAX)
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ФОРМАТЫ КАЧЕСТВА
+# ═══════════════════════════════════════════════════════════════
+
+# Ограничение высоты для каждого качества (None — без ограничения)
+QUALITY_HEIGHT = {"360": 360, "720": 720, "1080": 1080, "best": None}
+
+# Аудиоформаты: quality -> (расширение, подпись). "" — MP3 (перекодирование),
+# m4a и opus — перепаковка исходной дорожки без перекодирования
+AUDIO_FORMATS = {"": ("mp3", "MP3"), "m4a": ("m4a", "M4A"), "opus": ("opus", "Opus")}
+
+
+def audio_ext(quality: str) -> str:
+    return AUDIO_FORMATS.get(quality, AUDIO_FORMATS[""])[0]
+
+
+def audio_size_key(quality: str) -> str:
+    """Ключ аудиоформата в оценке размеров ("audio" — MP3)"""
+    return f"audio_{quality}" if quality else "audio"
+
+
+def parse_audio_action(action: str) -> str | None:
+    """quality аудио из callback_data ("audio", "audio_mp3", "audio_m4a", ...); None — не аудио"""
+    if action == "audio" or action == "audio_mp3":
+        return ""
+    if action.startswith("audio_") and action[6:] in AUDIO_FORMATS:
+        return action[6:]
+    return None
+
+
+def _best_format(formats: list, key) -> dict | None:
+    """Лучший из форматов по ключу сортировки"""
+    return max(formats, key=key) if formats else None
+
+
+def estimate_sizes(info: dict) -> dict:
+    """Оценка размера результата для каждого качества FORMAT_MAP и для аудио
+
+    Повторяет логику выбора FORMAT_MAP: лучшее mp4-видео до нужной высоты
+    + лучшее m4a-аудио, иначе лучший совмещённый формат.
+    """
+    formats = info.get("formats") or []
+    duration = info.get("duration") or 0
+
+    def is_video_only(f):
+        return f.get("vcodec") not in (None, "none") and f.get("acodec") == "none"
+
+    def is_audio_only(f):
+        return f.get("acodec") not in (None, "none") and f.get("vcodec") == "none"
+
+    def is_combined(f):
+        return f.get("vcodec") not in (None, "none") and f.get("acodec") not in (None, "none")
+
+    def quality_key(f):
+        return (f.get("height") or 0, f.get("tbr") or 0)
+
+    audio = _best_format(
+        [f for f in formats if is_audio_only(f) and f.get("ext") == "m4a"],
+        key=lambda f: f.get("abr") or f.get("tbr") or 0,
+    )
+
+    sizes = {}
+    for quality, max_height in QUALITY_HEIGHT.items():
+        def fits(f):
+            return max_height is None or (f.get("height") or 0) <= max_height
+
+        video = _best_format(
+            [f for f in formats if is_video_only(f) and f.get("ext") == "mp4" and fits(f)],
+            key=quality_key,
+        )
+        if video and audio:
+            size = format_size_estimate(video, duration) + format_size_estimate(audio, duration)
+        else:
+            combined = _best_format([f for f in formats if is_combined(f) and fits(f)], key=quality_key)
+            size = format_size_estimate(combined, duration) if combined else 0
+        if size:
+            sizes[quality] = size
+
+    if duration:
+        sizes["audio"] = int(MP3_BITRATE * 1000 / 8 * duration)
+    # Перепаковка сохраняет размер исходной дорожки
+    if audio:
+        sizes["audio_m4a"] = format_size_estimate(audio, duration)
+    elif duration:
+        sizes["audio_m4a"] = int(AAC_BITRATE * 1000 / 8 * duration)
+    opus = _best_format(
+        [f for f in formats if is_audio_only(f) and (f.get("acodec") or "").startswith("opus")],
+        key=lambda f: f.get("abr") or f.get("tbr") or 0,
+    )
+    if opus:
+        sizes["audio_opus"] = format_size_estimate(opus, duration)
+    elif duration:
+        sizes["audio_opus"] = int(OPUS_BITRATE * 1000 / 8 * duration)
+    return sizes
+
+QUALITY_LABELS = {"360": "360p", "720": "720p", "1080": "1080p", "best": "Лучшее"}
+
+# Порядок понижения качества, если оценка размера больше лимита Telegram
+QUALITY_DOWNGRADE = ["best", "1080", "720", "360"]
+
+
+def _size_hint(sizes: dict, key: str) -> str:
+    """Подпись к кнопке с оценкой размера"""
+    size = sizes.get(key)
+    return f" · ~{format_size(size)}" if size else ""
+
+
+def build_quality_keyboard(sizes: dict, prefix: str = "", clip: tuple | None = None,
+                           clip_on: bool = False) -> InlineKeyboardMarkup:
+    """Кнопки выбора качества с оценкой размера; слишком большие помечены
+
+    prefix добавляется к callback_data (например, "batch_" для пакетов).
+    clip — найденный в сообщении фрагмент (start, end): кнопка переключает
+    скачивание фрагмента или всего видео.
+    """
+    def video_button(emoji: str, quality: str) -> InlineKeyboardButton:
+        over = sizes.get(quality, 0) > TELEGRAM_FILE_LIMIT
+        mark = ("🧩 " if SPLIT_UPLOAD else "⚠️ ") if over else ""
+        return InlineKeyboardButton(
+            f"{mark}{emoji} {QUALITY_LABELS[quality]}{_size_hint(sizes, quality)}",
+            callback_data=f"{prefix}video_{quality}",
+        )
+
+    def audio_button(emoji: str, quality: str, suffix: str = "") -> InlineKeyboardButton:
+        ext, label = AUDIO_FORMATS[quality]
+        return InlineKeyboardButton(
+            f"{emoji} {label}{suffix}{_size_hint(sizes, audio_size_key(quality))}",
+            callback_data=f"{prefix}audio_{ext}",
+        )
+
+    return InlineKeyboardMarkup([
+        [
+            video_button("📹", "360"),
+            video_button("📺", "720"),
+        ],
+        [
+            video_button("🎬", "1080"),
+            video_button("🏆", "best"),
+        ],
+        [
+            audio_button("🎵", "", " (аудио)"),
+        ],
+        [
+            audio_button("🎧", "m4a"),
+            audio_button("🎧", "opus"),
+        ],
+        *([[
+            InlineKeyboardButton(
+                f"{'✅' if clip_on else '✂️'} Только фрагмент {format_clip(clip)}",
+                callback_data="clip_toggle",
+            ),
+        ]] if clip else []),
+        [
+            InlineKeyboardButton("❌ Отмена", callback_data="cancel"),
+        ]
+    ])
+
+
+def fit_quality(sizes: dict, quality: str) -> str | None:
+    """Качество не выше запрошенного, которое по оценке влезает в лимит Telegram
+
+    Без оценки размера качество не меняется; None — не влезает ни одно.
+    При SPLIT_UPLOAD большое видео отправляется частями и не понижается.
+    """
+    if SPLIT_UPLOAD or sizes.get(quality, 0) <= TELEGRAM_FILE_LIMIT:
+        return quality
+    start = QUALITY_DOWNGRADE.index(quality) if quality in QUALITY_DOWNGRADE else 0
+    for candidate in QUALITY_DOWNGRADE[start + 1:]:
+        if sizes.get(candidate, 0) <= TELEGRAM_FILE_LIMIT:
+            return candidate
+    return None
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
+# ═══════════════════════════════════════════════════════════════
+
+YOUTUBE_ID_RE = re.compile(r"^[0-9A-Za-z_-]{11}$")
+YOUTUBE_HOSTS = ("youtube.com", "youtube-nocookie.com")
+YOUTUBE_PATH_PREFIXES = ("shorts", "embed", "live", "v", "e")
+
+
+def extract_video_id(url: str) -> str | None:
+    """Канонический ID видео YouTube из любой формы ссылки (без сети)
+
+    Поддерживает youtu.be/ID, watch?v=ID (с любыми доп. параметрами),
+    m./music./www. поддомены, /shorts/ID, /embed/ID, /live/ID.
+    """
+    url = url.strip()
+    if "://" not in url:
+        url = "https://" + url
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return None
+
+    host = (parsed.hostname or "").lower()
+    parts = [p for p in parsed.path.split("/") if p]
+
+    candidate = None
+    if host == "youtu.be" or host.endswith(".youtu.be"):
+        candidate = parts[0] if parts else None
+    elif any(host == h or host.endswith("." + h) for h in YOUTUBE_HOSTS):
+        if parts and parts[0] == "watch":
+            candidate = parse_qs(parsed.query).get("v", [None])[0]
+        elif len(parts) >= 2 and parts[0] in YOUTUBE_PATH_PREFIXES:
+            candidate = parts[1]
+
+    if candidate and YOUTUBE_ID_RE.match(candidate):
+        return candidate
+    return None
+
+
+def canonical_url(video_id: str) -> str:
+    """Каноническая ссылка на видео по ID"""
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+
+# Все ссылки на YouTube в тексте сообщения
+YOUTUBE_LINK_RE = re.compile(
+    r"(?:https?://)?(?:[\w-]+\.)*(?:youtube\.com|youtube-nocookie\.com|youtu\.be)/[^\s<>\"']*",
+    re.IGNORECASE,
+)
+
+# Первый сегмент пути ссылки на канал
+CHANNEL_PREFIXES = ("channel", "c", "user")
+# Вкладки канала, которые можно указать в ссылке явно
+CHANNEL_TABS = ("videos", "shorts", "streams", "playlists")
+
+
+def find_youtube_links(text: str) -> list:
+    """Ссылки на YouTube из текста (в порядке появления, без повторов)"""
+    links = []
+    for link in YOUTUBE_LINK_RE.findall(text):
+        link = link.rstrip(".,;:!?)")
+        if link not in links:
+            links.append(link)
+    return links
+
+
+def collection_url(url: str) -> str | None:
+    """Ссылка для плоского извлечения, если url — плейлист или канал, иначе None
+
+    watch?v=...&list=... остаётся одиночным видео (как и раньше, noplaylist);
+    у канала без явной вкладки берутся последние видео (/videos).
+    """
+    if "://" not in url:
+        url = "https://" + url
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return None
+    host = (parsed.hostname or "").lower()
+    if not any(host == h or host.endswith("." + h) for h in YOUTUBE_HOSTS):
+        return None
+
+    parts = [p for p in parsed.path.split("/") if p]
+    if not parts:
+        return None
+    if parts[0] == "playlist" and parse_qs(parsed.query).get("list"):
+        return url
+    if parts[0].startswith("@") or (parts[0] in CHANNEL_PREFIXES and len(parts) >= 2):
+        base = parts[:1] if parts[0].startswith("@") else parts[:2]
+        tab = parts[len(base)] if len(parts) > len(base) else "videos"
+        if tab not in CHANNEL_TABS:
+            tab = "videos"
+        return f"https://www.youtube.com/{'/'.join(base)}/{tab}"
+    return None
+
+
+def get_video_info(url: str) -> dict:
+    """Получение информации о видео (синхронная, с кэшем по ID видео)"""
+    video_id = extract_video_id(url)
+    if video_id:
+        with metrics.timer("cache_lookup_seconds", cache="info"):
+            info = info_cache.get(video_id)
+        if info is not None:
+            logger.info(f"Кэш метаданных: хит {video_id}")
+            return info
+
+    with metrics.timer("stage_seconds", stage="extract"):
+        with ydl_pool.acquire() as ydl:
+            info = ydl.extract_info(url, download=False)
+
+    # В кэш — без выбора форматов извлечения: info повторно обрабатывается
+    # для любого качества и формата
+    drop_format_selection(info)
+    if video_id:
+        info_cache.put(video_id, info)
+    return info
+
+
+def get_playlist_entries(url: str, limit: int) -> tuple:
+    """Плоское извлечение плейлиста/канала (синхронная): (название, [(id, title)])
+
+    Одним запросом, без извлечения каждого видео; форматы получаются позже,
+    когда видео действительно скачивается.
+    """
+    opts = {
+        "noplaylist": False,
+        "extract_flat": "in_playlist",
+        "playlistend": limit,
+    }
+    with metrics.timer("stage_seconds", stage="extract_flat"):
+        with ydl_pool.acquire(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+
+    entries = []
+    for entry in info.get("entries") or []:
+        video_id = entry.get("id") if entry else None
+        if video_id and YOUTUBE_ID_RE.match(video_id):
+            entries.append((video_id, entry.get("title") or video_id))
+        if len(entries) >= limit:
+            break
+    return info.get("title") or "Плейлист", entries
+
+
+def make_progress_hook(loop, messages: list):
+    """Создаёт progress_hook для yt-dlp, обновляющий статусные сообщения
+
+    messages — изменяемый список: к выполняющейся задаче могут
+    присоединяться новые пользователи, и они сразу начинают видеть прогресс.
+    """
+    last_update_time = [0.0]
+
+    def hook(d):
+        status = d.get("status")
+        now = time.time()
+
+        if status == "finished":
+            metrics.inc("bytes_total", d.get("total_bytes") or d.get("downloaded_bytes") or 0,
+                        direction="download")
+
+        # Троттлинг: не чаще раза в 3 секунды
+        if now - last_update_time[0] < 3:
+            return
+
+        if status == "downloading":
+            total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
+            downloaded = d.get("downloaded_bytes", 0)
+            speed = d.get("speed") or 0
+            eta = d.get("eta")
+
+            if total > 0:
+                percent = downloaded * 100 / total
+                filled = int(percent / 5)
+                bar = "█" * filled + "░" * (20 - filled)
+                speed_str = f"{speed / (1024 * 1024):.1f} МБ/с" if speed else "..."
+                eta_str = f"{eta}с" if eta else "..."
+                text = (
+                    f"⬇️ **Скачиваю с YouTube...**\n\n"
+                    f"[{bar}] {percent:.1f}%\n"
+                    f"📊 {format_size(downloaded)} / {format_size(total)}\n"
+                    f"🚀 {speed_str} | ⏱ {eta_str}"
                 )
             else:
-                await client.send_audio(
-                    chat_id=callback.message.chat.id,
-                    audio=cached_file_id,
-                    caption=f"🎵 **{title}**",
-                    parse_mode=ParseMode.MARKDOWN,
-                    title=title,
+                text = (
+                    f"⬇️ **Скачиваю с YouTube...**\n\n"
+                    f"📊 {format_size(downloaded)}"
                 )
+
+            last_update_time[0] = now
+            loop.call_soon_threadsafe(_edit_all, messages, text)
+
+        elif status == "finished":
+            last_update_time[0] = now
+            loop.call_soon_threadsafe(_edit_all, messages, "⚙️ **Обработка FFmpeg...**")
+
+    return hook
+
+
+async def _safe_edit(message, text):
+    """Безопасное редактирование сообщения (игнорирует ошибки)"""
+    try:
+        await message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
+    except Exception:
+        pass
+
+
+# Временные файлы незавершённых скачиваний (не считаются готовыми потоками)
+PARTIAL_SUFFIXES = (".part", ".ytdl", ".aria2", ".temp")
+
+
+def _is_audio_only(fmt: dict) -> bool:
+    return fmt.get("vcodec") == "none"
+
+
+def finish_media(streams: list, formats: list, output_path: str,
+                 format_type: str, quality: str) -> str:
+    """Процессорная часть: склейка или кодирование аудио (синхронная, в transcode_executor)"""
+    with metrics.timer("stage_seconds", stage="postprocess"):
+        return _finish_media(streams, formats, output_path, format_type, quality)
+
+
+def _finish_media(streams: list, formats: list, output_path: str,
+                  format_type: str, quality: str) -> str:
+    threads = str(TRANSCODE_THREADS)
+    if format_type == "audio":
+        codec_args = audio_codec_args(quality, formats[0].get("acodec") or "")
+        run_ffmpeg(["-i", streams[0], "-vn", *codec_args, "-threads", threads, output_path])
+    elif len(streams) == 2:
+        video, audio = (streams if not _is_audio_only(formats[0]) else streams[::-1])
+        run_ffmpeg([
+            "-i", video, "-i", audio,
+            "-map", "0:v:0", "-map", "1:a:0",
+            "-c", "copy", "-movflags", "+faststart",
+            "-threads", threads, output_path,
+        ])
+    else:
+        # Совмещённый формат — отдельная копия (поток остаётся в кэше потоков)
+        try:
+            os.link(streams[0], output_path)
+        except OSError:
+            shutil.copyfile(streams[0], output_path)
+
+    return output_path
+
+
+def download_media(url: str, output_path: str, format_type: str,
+                   quality: str = "best", progress_hook=None,
+                   info: dict | None = None, local_source: str | None = None) -> str:
+    """Скачивание и обработка за один вызов (синхронная)"""
+    streams, formats, refreshed = fetch_streams(url, format_type, quality, progress_hook, info, local_source)
+    if refreshed:
+        info_cache.invalidate(extract_video_id(url) or "")
+    return finish_media(streams, formats, output_path, format_type, quality)
+
+
+def cleanup_files(file_id: str):
+    """Очистка всех файлов по префиксу file_id"""
+    pattern = os.path.join(DOWNLOAD_PATH, f"{file_id}*")
+    for f in glob.glob(pattern):
+        try:
+            os.remove(f)
+            logger.info(f"Удалён: {f}")
+        except Exception as e:
+            logger.warning(f"Не удалось удалить {f}: {e}")
+
+
+def cleanup_downloads_on_start():
+    """Восстановление кэша и очистка остальных файлов при старте бота"""
+    disk_cache.load()
+
+    # Файлы прерванных задач (включая .part и .aria2) нужны, чтобы докачать с места остановки
+    outputs, sources = journal_protected_paths()
+
+    removed = 0
+    files = glob.glob(os.path.join(DOWNLOAD_PATH, "*")) + glob.glob(os.path.join(STREAMS_PATH, "*"))
+    for f in files:
+        if f in outputs or (os.path.dirname(f) == STREAMS_PATH
+                            and os.path.basename(f).split(".")[0] in sources):
+            continue
+        if os.path.isfile(f) and not disk_cache.contains_path(f):
+            try:
+                os.remove(f)
+                removed += 1
+            except Exception:
+                pass
+    if removed:
+        logger.info(f"Очищено {removed} старых файлов при старте")
+
+
+def format_duration(seconds: int) -> str:
+    """Форматирование длительности"""
+    if seconds < 3600:
+        minutes, secs = divmod(seconds, 60)
+        return f"{minutes}:{secs:02d}"
+    else:
+        hours, remainder = divmod(seconds, 3600)
+        minutes, secs = divmod(remainder, 60)
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+
+
+def format_size(bytes_size: int) -> str:
+    """Форматирование размера файла"""
+    if bytes_size < 1024:
+        return f"{bytes_size} Б"
+    elif bytes_size < 1024 * 1024:
+        return f"{bytes_size / 1024:.1f} КБ"
+    elif bytes_size < 1024 * 1024 * 1024:
+        return f"{bytes_size / (1024 * 1024):.1f} МБ"
+    else:
+        return f"{bytes_size / (1024 * 1024 * 1024):.2f} ГБ"
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ПРОЦЕССЫ-ВОРКЕРЫ
+# ═══════════════════════════════════════════════════════════════
+
+# Код самих воркеров — в downloader.py (init_download_worker, fetch_streams_relayed):
+# они импортируют только его, без клиента Telegram и хранилищ этого модуля
+
+class ProgressRelay:
+    """Пересылка событий прогресса из процессов-воркеров в обычные progress hook"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._hooks = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def register(self, hook) -> int:
+        with self._lock:
+            token = next(self._ids)
+            self._hooks[token] = hook
+            return token
+
+    def unregister(self, token: int):
+        with self._lock:
+            self._hooks.pop(token, None)
+
+    def start(self):
+        threading.Thread(target=self._run, name="progress-relay", daemon=True).start()
+
+    def _run(self):
+        while True:
+            token, event = self.queue.get()
+            with self._lock:
+                hook = self._hooks.get(token)
+            if hook is None:
+                continue
+            try:
+                hook(event)
+            except Exception as e:
+                logger.debug(f"Ошибка пересылки прогресса: {e}")
+
+
+# Задаётся в start_download_processes() при DOWNLOAD_MODE=process
+progress_relay = None
+
+
+def start_download_processes():
+    """Перевод планировщика на пул процессов-воркеров"""
+    global progress_relay, download_executor
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    progress_relay = ProgressRelay(queue)
+    progress_relay.start()
+    download_executor = ProcessPoolExecutor(
+        max_workers=DOWNLOAD_WORKERS,
+        mp_context=ctx,
+        initializer=init_download_worker,
+        initargs=(queue,),
+    )
+    download_scheduler.executor = download_executor
+    logger.info(f"Скачивания выполняются в {DOWNLOAD_WORKERS} процессах-воркерах")
+    if __name__ == "__main__":
+        # spawn заново импортирует главный модуль в каждом воркере
+        logger.warning("bot.py запущен напрямую — воркеры импортируют его целиком; "
+                       "запускайте через main.py")
+
+
+def download_call(hook, url: str, format_type: str, quality: str,
+                  info: dict | None, local_source: str | None = None) -> tuple:
+    """Функция и аргументы сетевой части (fetch_streams) для планировщика с учётом DOWNLOAD_MODE
+
+    Возвращает (func, args, token); token нужно передать в
+    progress_relay.unregister после завершения (None в режиме потоков).
+    """
+    if progress_relay is None:
+        return fetch_streams, (url, format_type, quality, hook, info, local_source), None
+
+    token = progress_relay.register(hook)
+    if info is not None:
+        # В воркер уходит только сериализуемая копия
+        info = yt_dlp.YoutubeDL.sanitize_info(info)
+    return fetch_streams_relayed, (token, url, format_type, quality, info, local_source), token
+
+
+# ═══════════════════════════════════════════════════════════════
+#                         ПРОГРЕСС ЗАГРУЗКИ В TELEGRAM
+# ═══════════════════════════════════════════════════════════════
+
+class EditDispatcher:
+    """Единая очередь редактирования статусных сообщений
+
+    - последнее значение побеждает: промежуточные тексты прогресса
+      одного сообщения склеиваются, отправляется только свежий;
+    - не чаще раза в EDIT_INTERVAL_PER_CHAT секунд на чат и не более
+      EDITS_PER_SECOND правок в секунду на весь бот;
+    - при FloodWait правки приостанавливаются на указанное время,
+      чтобы не тормозить загрузки на той же MTProto-сессии;
+    - forget() очищает состояние сообщения, когда задача завершена.
+    """
+
+    def __init__(self, per_chat_interval: float, per_second: float, concurrency: int = 8):
+        self.per_chat_interval = per_chat_interval
+        self.min_gap = 1 / per_second
+        self.edits = 0
+        self.coalesced = 0
+        self.flood_waits = 0
+        self._pending = OrderedDict()    # (chat_id, msg_id) -> (message, text)
+        self._last_text = {}             # (chat_id, msg_id) -> последний отправленный текст
+        self._chat_last_edit = {}        # chat_id -> время последней правки
+        self._chats_in_flight = set()
+        self._keys_in_flight = set()     # сообщения, правка которых сейчас отправляется
+        self._closed = set()             # из них забытые: результат правки не учитывается
+        self._paused_until = 0.0
+        self._last_start = 0.0
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+
+    @staticmethod
+    def _key(message) -> tuple:
+        return message.chat.id, message.id
+
+    def submit(self, message, text: str):
+        """Запланировать правку (вызывать из event loop)"""
+        key = self._key(message)
+        if self._last_text.get(key) == text and key not in self._pending:
+            return
+        if key in self._pending:
+            self.coalesced += 1
+        self._closed.discard(key)
+        self._pending[key] = (message, text)
+        self._wakeup.set()
+
+    def forget(self, message):
+        """Задача завершена: отбросить ожидающие правки и состояние сообщения"""
+        key = self._key(message)
+        self._pending.pop(key, None)
+        self._last_text.pop(key, None)
+        if key in self._keys_in_flight:
+            self._closed.add(key)
+
+    def _next_ready(self, now: float):
+        """Первое сообщение, чат которого можно редактировать прямо сейчас"""
+        wait = None
+        for key in self._pending:
+            chat_id = key[0]
+            if chat_id in self._chats_in_flight:
+                continue
+            ready_at = self._chat_last_edit.get(chat_id, 0.0) + self.per_chat_interval
+            if ready_at <= now:
+                return key, 0.0
+            wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return None, (wait if wait is not None else 0.1)
+
+    async def run(self):
+        """Основной цикл диспетчера (фоновая задача)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = loop.time()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            key, wait = self._next_ready(now)
+            if key is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Глобальный бюджет правок
+            gap = self._last_start + self.min_gap - now
+            if gap > 0:
+                await asyncio.sleep(gap)
+                continue
+
+            await self._slots.acquire()
+            if key not in self._pending:
+                self._slots.release()
+                continue
+            message, text = self._pending.pop(key)
+            self._last_start = loop.time()
+            self._chat_last_edit[key[0]] = self._last_start
+            self._chats_in_flight.add(key[0])
+            self._keys_in_flight.add(key)
+            asyncio.create_task(self._edit(key, message, text))
+            self._prune(self._last_start)
+
+    async def _edit(self, key: tuple, message, text: str):
+        # Сообщение, забытое во время правки, больше не отслеживается и не правится повторно
+        try:
+            await message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
+            if key not in self._closed:
+                self._last_text[key] = text
+            self.edits += 1
+        except MessageNotModified:
+            if key not in self._closed:
+                self._last_text[key] = text
+        except FloodWait as e:
+            self.flood_waits += 1
+            wait = float(e.value or 1)
+            logger.warning(f"FloodWait при редактировании: пауза {wait:.0f} с")
+            self._paused_until = asyncio.get_running_loop().time() + wait
+            # Повторим, если за это время не пришёл текст новее
+            if key not in self._closed:
+                self._pending.setdefault(key, (message, text))
+        except Exception as e:
+            logger.debug(f"Ошибка редактирования сообщения: {e}")
+        finally:
+            self._keys_in_flight.discard(key)
+            self._closed.discard(key)
+            self._chats_in_flight.discard(key[0])
+            self._slots.release()
+            self._wakeup.set()
+
+    def _prune(self, now: float):
+        """Удаление устаревших отметок времени по чатам"""
+        if len(self._chat_last_edit) < 1000:
+            return
+        expired = now - self.per_chat_interval
+        for chat_id, t in list(self._chat_last_edit.items()):
+            if t < expired:
+                del self._chat_last_edit[chat_id]
+
+
+EDIT_INTERVAL_PER_CHAT = float(os.environ.get("EDIT_INTERVAL_PER_CHAT", "3"))
+EDITS_PER_SECOND = float(os.environ.get("EDITS_PER_SECOND", "20"))
+
+edit_dispatcher = EditDispatcher(EDIT_INTERVAL_PER_CHAT, EDITS_PER_SECOND)
+
+
+async def progress_callback(current: int, total: int, messages: list, action: str):
+    """Отображение прогресса загрузки в Telegram (во всех статусных сообщениях задачи)"""
+    try:
+        percent = current * 100 / total
+        filled = int(percent / 5)
+        bar = "█" * filled + "░" * (20 - filled)
+
+        text = (
+            f"⬆️ Загружаю в Telegram...\n\n"
+            f"[{bar}] {percent:.1f}%\n"
+            f"📊 {format_size(current)} / {format_size(total)}"
+        )
+
+        # Частоту правок ограничивает edit_dispatcher
+        _edit_all(messages, text)
+
+    except Exception as e:
+        logger.debug(f"Ошибка обновления прогресса: {e}")
+
+
+# ═══════════════════════════════════════════════════════════════
+#                         ОБРАБОТЧИКИ КОМАНД
+# ═══════════════════════════════════════════════════════════════
+
+@app.on_message(filters.command("start"))
+async def start_command(client: Client, message: Message):
+    """Приветственное сообщение"""
+    # Переход из inline-режима: /start <video_id> — сразу выбор качества
+    if len(message.command) > 1 and YOUTUBE_ID_RE.match(message.command[1]):
+        await handle_url(client, message, canonical_url(message.command[1]))
+        return
+
+    await message.reply_text(
+        "👋 **Привет!** Я бот для скачивания видео с YouTube.\n\n"
+        "🎬 Просто отправь мне ссылку на видео, и я скачаю его для тебя.\n\n"
+        "✨ **Возможности:**\n"
+        "• Скачивание видео до **2 ГБ**\n"
+        "• Выбор качества: 360p / 720p / 1080p / Лучшее\n"
+        "• Аудио в MP3, M4A или Opus (без перекодирования)\n"
+        "• Прогресс-бар скачивания\n\n"
+        "📖 Команды:\n"
+        "/start - начать\n"
+        "/help - помощь",
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+
+@app.on_message(filters.command("help"))
+async def help_command(client: Client, message: Message):
+    """Справка"""
+    await message.reply_text(
+        "📖 **Как пользоваться:**\n\n"
+        "1️⃣ Скопируй ссылку на YouTube видео\n"
+        "2️⃣ Отправь её мне\n"
+        "3️⃣ Выбери качество видео или аудио\n"
+        "4️⃣ Дождись загрузки\n\n"
+        "📚 Можно отправить плейлист, канал или несколько ссылок в одном сообщении — "
+        f"скачаю до {BATCH_MAX_ITEMS} видео с одним выбором качества.\n\n"
+        "✂️ Нужен только кусок? Допиши диапазон после ссылки: `<ссылка> 1:00-1:30` — "
+        "скачается только этот фрагмент.\n\n"
+        "⚡ В любом чате набери `@" + (client.me.username if client.me else "бот") + " <ссылка>` — "
+        "уже скачанное видео отправится сразу.\n\n"
+        "🎬 **Качество видео:**\n"
+        "• 360p — быстро, мало трафика\n"
+        "• 720p — хорошее качество\n"
+        "• 1080p — высокое качество\n"
+        "• Лучшее — максимум\n\n"
+        "⚠️ **Ограничения:**\n"
+        + ("• Видео больше 2 ГБ приходит частями (🧩)\n" if SPLIT_UPLOAD else
+           "• Максимальный размер: 2 ГБ\n") +
+        "• Только YouTube ссылки\n\n"
+        "💡 **Совет:** 360p загружается в 5-10 раз быстрее!",
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+
+@app.on_message(filters.command("stats") & filters.user(ADMIN_IDS))
+async def stats_command(client: Client, message: Message):
+    """Сводка метрик для администраторов"""
+    def ratio(hits: int, misses: int) -> str:
+        total = hits + misses
+        return f"{hits * 100 / total:.0f}% ({hits}/{total})" if total else "—"
+
+    def seconds(value: float | None) -> str:
+        return f"{value:.2f}" if value is not None else "—"
+
+    lines = ["📊 **Статистика**", "", "⏱ **Этапы** (p50 / p95, с):"]
+    stages = sorted(labels["stage"] for name, labels, _, _ in metrics.histograms()
+                    if name == "stage_seconds")
+    for stage in stages:
+        p50 = metrics.quantile("stage_seconds", 0.5, stage=stage)
+        p95 = metrics.quantile("stage_seconds", 0.95, stage=stage)
+        lines.append(f"• {stage}: {seconds(p50)} / {seconds(p95)}")
+    if not stages:
+        lines.append("• пока нет данных")
+
+    gauges = await collect_gauges()
+    lines += [
+        "",
+        "💾 **Кэши** (хиты):",
+        f"• file_id: {ratio(gauges['file_id_cache_hits'], gauges['file_id_cache_misses'])}, "
+        f"записей {gauges['file_id_cache_entries']}",
+        f"• файлы: {ratio(gauges['disk_cache_hits'], gauges['disk_cache_misses'])}, "
+        f"{format_size(gauges['disk_cache_bytes'])} из {format_size(disk_cache.max_bytes)}",
+        f"• метаданные: {ratio(gauges['info_cache_hits'], gauges['info_cache_misses'])}",
+        "",
+        "🕐 **Очередь:**",
+        f"• скачиваются: {gauges['downloads_running']} из {download_scheduler.workers}, "
+        f"ждут: {gauges['queue_depth']}, задач: {gauges['inflight_jobs']}",
+        "",
+        "📦 **Задачи:** " + ", ".join(
+            f"{result} {int(metrics.counter('jobs_total', result=result))}"
+            for result in ("ok", "file_id", "joined", "rejected", "error")
+        ),
+        "🚦 **Допуск** (отказов, лимит пользователя / общий): " + ", ".join(
+            f"{name} {int(metrics.counter('admission_total', kind=kind, result='user_limit'))}"
+            f"/{int(metrics.counter('admission_total', kind=kind, result='global_limit'))}"
+            for kind, name in (("links", "ссылки"), ("downloads", "загрузки"))
+        ) + f"; сброшено при нагрузке {int(metrics.counter('admission_total', kind='load', result='shed'))}, "
+        f"нагрузка {gauges['load']} (порог {SHED_QUEUE_DEPTH or '—'})",
+        f"🔁 **Трафик:** ⬇️ {format_size(int(metrics.counter('bytes_total', direction='download')))}, "
+        f"⬆️ {format_size(int(metrics.counter('bytes_total', direction='upload')))}",
+        f"✏️ **Правки:** {gauges['status_edits']}, FloodWait: {gauges['flood_waits']}",
+        f"👤 **Сессии:** {gauges['sessions']}, {format_size(gauges['sessions_memory_bytes'])}",
+    ]
+    await message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ОБРАБОТКА ССЫЛОК
+# ═══════════════════════════════════════════════════════════════
+
+@app.on_message(filters.text & ~filters.command(["start", "help", "stats"]))
+async def handle_url(client: Client, message: Message, text: str | None = None):
+    """Обработка YouTube ссылки (text — вместо текста сообщения, например из /start)"""
+    global info_pending
+    url = (text or message.text).strip()
+
+    # Проверяем, что это ссылка на YouTube
+    if "youtube.com" not in url and "youtu.be" not in url:
+        await message.reply_text(
+            "❌ Пожалуйста, отправь ссылку на YouTube видео.\n\n"
+            "Примеры:\n"
+            "• `https://www.youtube.com/watch?v=...`\n"
+            "• `https://youtu.be/...`",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+
+    # Несколько ссылок, плейлист или канал — пакетный режим
+    links = find_youtube_links(url)
+    if len(links) > 1 or (links and collection_url(links[0])):
+        # Пакет — низкоприоритетная работа: при перегрузке не принимается
+        rejection = SHED_TEXT if should_shed(False) else link_limiter.admit(message.from_user.id)
+        if rejection:
+            await message.reply_text(rejection, parse_mode=ParseMode.MARKDOWN)
+            return
+        await handle_batch(client, message, links)
+        return
+
+    # Диапазон рядом со ссылкой или &t= — кандидат на скачивание фрагмента
+    link = links[0] if links else url
+    clip, clip_on = parse_clip(url, link)
+
+    # Приводим ссылку к каноническому ID — все варианты одной ссылки
+    # (youtu.be, shorts, &t=, трекинг-параметры) попадают в один ключ кэша
+    video_id = extract_video_id(link)
+    if video_id:
+        url = canonical_url(video_id)
+    else:
+        url = link
+        clip = None
+
+    # Метаданные из кэша не нагружают info_executor — без лимита
+    if not (video_id and info_cache.contains(video_id)):
+        rejection = link_limiter.admit(message.from_user.id)
+        if rejection:
+            await message.reply_text(rejection)
+            return
+
+    status_msg = await message.reply_text("🔍 Получаю информацию о видео...")
+
+    info_pending += 1
+    try:
+        # Получаем информацию в пуле для метаданных
+        loop = asyncio.get_event_loop()
+        try:
+            info = await asyncio.wait_for(
+                loop.run_in_executor(info_executor, timed_executor_call("info", get_video_info), url),
+                timeout=60.0
+            )
+        finally:
+            info_pending -= 1
+
+        title = info.get("title", "Видео")
+        duration = info.get("duration", 0)
+        channel = info.get("channel", info.get("uploader", "Неизвестно"))
+        view_count = info.get("view_count", 0)
+
+        sizes = estimate_sizes(info)
+        clip = fit_clip(clip, duration or 0)
+        clip_on = clip_on and clip is not None
+
+        # Сохраняем компактную сессию (полный info остаётся только в кэше метаданных)
+        user_sessions.put(message.from_user.id, UserSession(
+            source=video_id or url,
+            url=url,
+            title=title,
+            duration=duration or 0,
+            sizes=sizes,
+            clip=clip,
+            clip_on=clip_on,
+        ))
+
+        # Форматируем просмотры
+        if view_count >= 1_000_000:
+            views_str = f"{view_count / 1_000_000:.1f}M"
+        elif view_count >= 1_000:
+            views_str = f"{view_count / 1_000:.1f}K"
+        else:
+            views_str = str(view_count)
+
+        # Кнопки выбора качества (с оценкой размера)
+        shown_sizes = clip_sizes(sizes, duration, clip) if clip_on else sizes
+        keyboard = build_quality_keyboard(shown_sizes, clip=clip, clip_on=clip_on)
+        clip_line = f"✂️ Фрагмент: {format_clip(clip)}\n" if clip_on else ""
+
+        await status_msg.edit_text(
+            f"📹 **{title}**\n\n"
+            f"📺 Канал: {channel}\n"
+            f"⏱ Длительность: {format_duration(duration)}\n"
+            f"👁 Просмотры: {views_str}\n"
+            f"{clip_line}\n"
+            "**Выбери качество:**",
+            reply_markup=keyboard,
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+        # Пока пользователь выбирает — начинаем скачивать вероятный вариант
+        # (для фрагмента полное видео не нужно)
+        if not clip_on:
+            await maybe_prefetch(video_id or url, info, sizes)
+
+    except asyncio.TimeoutError:
+        logger.error("Таймаут при получении информации")
+        await status_msg.edit_text(
+            "❌ **Ошибка:** превышено время ожидания.\n\n"
+            "Возможные причины:\n"
+            "• Видео недоступно в вашем регионе\n"
+            "• Проблемы с сетью\n"
+            "• YouTube временно блокирует запросы\n\n"
+            "Попробуй позже.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    except Exception as e:
+        logger.error(f"Ошибка: {e}")
+        await status_msg.edit_text(
+            f"❌ **Ошибка:** не удалось получить информацию.\n\n"
+            f"`{str(e)[:200]}`",
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      INLINE-РЕЖИМ
+# ═══════════════════════════════════════════════════════════════
+
+# Сколько секунд Telegram кэширует ответ на inline-запрос (при промахе — меньше,
+# чтобы скачанное через бота видео быстро появилось в выдаче)
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "300"))
+INLINE_MISS_CACHE_TIME = 10
+
+
+def _inline_result(video_id: str, format_type: str, quality: str, file_id: str, title: str):
+    """Результат inline-запроса по file_id (тип результата — по типу файла в Telegram)"""
+    try:
+        file_type = FileId.decode(file_id).file_type
+    except Exception:
+        return None
+    if format_type == "video":
+        label = f"🎬 Видео {QUALITY_LABELS.get(quality, quality)}"
+        caption = f"🎬 **{title}**"
+    else:
+        label = f"🎵 Аудио {AUDIO_FORMATS.get(quality, AUDIO_FORMATS[''])[1]}"
+        caption = f"🎵 **{title}**"
+    result_id = f"{video_id}:{format_type}:{quality}"
+
+    if file_type == FileType.VIDEO:
+        return InlineQueryResultCachedVideo(file_id, title=title, id=result_id, description=label,
+                                            caption=caption, parse_mode=ParseMode.MARKDOWN)
+    if file_type == FileType.AUDIO:
+        return InlineQueryResultCachedAudio(file_id, id=result_id, caption=caption,
+                                            parse_mode=ParseMode.MARKDOWN)
+    return InlineQueryResultCachedDocument(file_id, title=title, id=result_id, description=label,
+                                           caption=caption, parse_mode=ParseMode.MARKDOWN)
+
+
+@app.on_inline_query()
+async def handle_inline(client: Client, inline_query: InlineQuery):
+    """@bot <ссылка>: мгновенный ответ из кэша file_id, без скачивания и статусов"""
+    video_id = extract_video_id(inline_query.query.strip())
+    if not video_id:
+        metrics.inc("inline_total", result="invalid")
+        await inline_query.answer(
+            [], cache_time=INLINE_CACHE_TIME,
+            switch_pm_text="Вставь ссылку на YouTube видео", switch_pm_parameter="inline",
+        )
+        return
+
+    with metrics.timer("cache_lookup_seconds", cache="file_id"):
+        entries = await shared_call(telegram_file_cache.entries, video_id)
+
+    # Сначала видео по возрастанию качества, затем аудио
+    order = [("video", q) for q in QUALITY_HEIGHT] + [("audio", q) for q in AUDIO_FORMATS]
+    entries.sort(key=lambda e: order.index(e[:2]) if e[:2] in order else len(order))
+    results = []
+    for format_type, quality, file_id, title in entries:
+        if PART_SEPARATOR in file_id:
+            continue    # в inline-результат помещается только один файл
+        result = _inline_result(video_id, format_type, quality, file_id, title or "YouTube")
+        if result is not None:
+            results.append(result)
+
+    if not results:
+        # Промах: предлагаем обычную загрузку в личке (/start <video_id>)
+        metrics.inc("inline_total", result="miss")
+        await inline_query.answer(
+            [], cache_time=INLINE_MISS_CACHE_TIME,
+            switch_pm_text="⬇️ Ещё не скачано — скачать через бота", switch_pm_parameter=video_id,
+        )
+        return
+
+    metrics.inc("inline_total", result="hit")
+    await inline_query.answer(
+        results, cache_time=INLINE_CACHE_TIME,
+        switch_pm_text="Другое качество — через бота", switch_pm_parameter=video_id,
+    )
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ОЧЕРЕДЬ ЗАГРУЗОК
+# ═══════════════════════════════════════════════════════════════
+
+# Сколько «дешёвых» задач подряд можно взять вне очереди round-robin
+CHEAP_BURST = 3
+
+
+class JobError(Exception):
+    """Ошибка задачи с готовым текстом для пользователя"""
+
+
+class QueueFull(JobError):
+    """Очередь переполнена — задача отклонена"""
+
+
+class ScheduledJob:
+    """Задача в очереди планировщика"""
+
+    __slots__ = ("user_id", "cheap", "func", "args", "future", "on_position", "position", "enqueued")
+
+    def __init__(self, user_id: int, cheap: bool, func, args: tuple, on_position):
+        self.user_id = user_id
+        self.cheap = cheap
+        self.func = func
+        self.args = args
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = None
+        self.enqueued = time.monotonic()
+
+
+class JobScheduler:
+    """Честный планировщик скачиваний перед download_executor
+
+    - round-robin между пользователями: десять ссылок одного пользователя
+      не блокируют остальных;
+    - «дешёвые» задачи (аудио, 360p) идут вперёд, но не более CHEAP_BURST
+      подряд, чтобы тяжёлые задачи не голодали;
+    - ограниченная очередь: при переполнении задача отклоняется (QueueFull);
+    - on_position(n) сообщает место в очереди (0 — задача запущена);
+      вызывается синхронно, поэтому места приходят строго по порядку.
+    """
+
+    def __init__(self, executor, workers: int, max_queue: int, max_per_user: int):
+        self.executor = executor
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.running = 0
+        self._queues = OrderedDict()   # user_id -> deque[ScheduledJob]; порядок — round-robin
+        self._cheap_streak = 0
+
+    @property
+    def depth(self) -> int:
+        """Количество задач, ожидающих в очереди"""
+        return sum(len(q) for q in self._queues.values())
+
+    async def submit(self, user_id: int, cheap: bool, func, *args, on_position=None):
+        """Поставить func(*args) в очередь и дождаться результата"""
+        if self.depth >= self.max_queue:
+            raise QueueFull(
+                "❌ Сейчас слишком много загрузок.\n\n"
+                "Попробуй через несколько минут."
+            )
+        if len(self._queues.get(user_id, ())) >= self.max_per_user:
+            raise QueueFull(
+                f"❌ У тебя уже {self.max_per_user} загрузок в очереди.\n\n"
+                "Дождись их завершения."
+            )
+
+        job = ScheduledJob(user_id, cheap, func, args, on_position)
+        self._queues.setdefault(user_id, deque()).append(job)
+        self._dispatch()
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            self._discard(job)
+            raise
+
+    def _discard(self, job: ScheduledJob):
+        """Убрать из очереди задачу, которую больше никто не ждёт"""
+        queue = self._queues.get(job.user_id)
+        if queue and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self._queues[job.user_id]
+            self._notify_positions()
+
+    def _select(self, queues: OrderedDict, streak: int) -> tuple:
+        """Выбор следующей задачи: дешёвая (в пределах CHEAP_BURST) или round-robin"""
+        user_id = None
+        if streak < CHEAP_BURST:
+            user_id = next((u for u, q in queues.items() if q[0].cheap), None)
+        if user_id is None:
+            user_id = next(iter(queues))
+
+        # Пользователь уходит в конец круга
+        queue = queues.pop(user_id)
+        job = queue.popleft()
+        if queue:
+            queues[user_id] = queue
+        return job, (streak + 1 if job.cheap else 0)
+
+    def _dispatch(self):
+        """Запуск задач, пока есть свободные слоты"""
+        while self.running < self.workers and self._queues:
+            job, self._cheap_streak = self._select(self._queues, self._cheap_streak)
+            self.running += 1
+            asyncio.create_task(self._run(job))
+        self._notify_positions()
+
+    def _notify_positions(self):
+        """Сообщить ожидающим задачам их новое место в очереди"""
+        queues = OrderedDict((u, deque(q)) for u, q in self._queues.items())
+        streak = self._cheap_streak
+        position = 0
+        while queues:
+            job, streak = self._select(queues, streak)
+            position += 1
+            self._set_position(job, position)
+
+    def _set_position(self, job: ScheduledJob, position: int):
+        if job.position != position:
+            job.position = position
+            if job.on_position:
+                try:
+                    job.on_position(position)
+                except Exception as e:
+                    logger.warning(f"Ошибка уведомления о месте в очереди: {e}")
+
+    async def _run(self, job: ScheduledJob):
+        loop = asyncio.get_running_loop()
+        try:
+            if job.future.cancelled():
+                return
+            self._set_position(job, 0)
+            metrics.observe("stage_seconds", time.monotonic() - job.enqueued, stage="queue_wait")
+            result = await loop.run_in_executor(self.executor, job.func, *job.args)
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self.running -= 1
+            self._dispatch()
+
+
+download_scheduler = JobScheduler(download_executor, DOWNLOAD_WORKERS, MAX_QUEUE, MAX_QUEUE_PER_USER)
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ДОПУСК ЗАПРОСОВ
+# ═══════════════════════════════════════════════════════════════
+
+# Лимиты «ведро токенов», запросов в минуту (0 — без ограничения): ссылки —
+# извлечение метаданных в info_executor, загрузки — новые задачи скачивания.
+# Ёмкость ведра равна минутной норме: короткий всплеск проходит сразу.
+# Ответы из кэшей и присоединение к уже идущей задаче лимиты не расходуют.
+USER_LINKS_PER_MINUTE = int(os.environ.get("USER_LINKS_PER_MINUTE", "10"))
+USER_DOWNLOADS_PER_MINUTE = int(os.environ.get("USER_DOWNLOADS_PER_MINUTE", "5"))
+GLOBAL_LINKS_PER_MINUTE = int(os.environ.get("GLOBAL_LINKS_PER_MINUTE", "120"))
+GLOBAL_DOWNLOADS_PER_MINUTE = int(os.environ.get("GLOBAL_DOWNLOADS_PER_MINUTE", "60"))
+
+# Нагрузка (ожидающие загрузки + извлечения сверх INFO_WORKERS), с которой
+# не принимаются пакеты и тяжёлые видео (720p и выше); 0 — не сбрасывать
+SHED_QUEUE_DEPTH = int(os.environ.get("SHED_QUEUE_DEPTH", str(MAX_QUEUE // 2)))
+
+RATE_LIMIT_USERS = 10000    # сколько вёдер пользователей держать в памяти
+
+
+class TokenBucket:
+    """Ведро токенов: per_minute токенов в минуту, в запасе не больше per_minute"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Лимит одного вида запросов: ведро на пользователя и общее ведро бота
+
+    Токен списывается из обоих вёдер только если есть в обоих — отказ
+    из-за общего лимита не тратит лимит пользователя. Администраторы
+    ограничены только общим ведром.
+    """
+
+    def __init__(self, kind: str, per_user: int, overall: int):
+        self.kind = kind
+        self.per_user = per_user
+        self.overall = TokenBucket(overall) if overall else None
+        self._users = OrderedDict()   # user_id -> TokenBucket; порядок — LRU
+
+    def _user_bucket(self, user_id: int) -> TokenBucket | None:
+        if not self.per_user or user_id in ADMIN_IDS:
+            return None
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.per_user)
+            while len(self._users) > RATE_LIMIT_USERS:
+                self._users.popitem(last=False)
+        self._users.move_to_end(user_id)
+        return bucket
+
+    def admit(self, user_id: int) -> str | None:
+        """Списать токен; None — запрос принят, иначе текст отказа"""
+        now = time.monotonic()
+        user = self._user_bucket(user_id)
+        for bucket in (user, self.overall):
+            if bucket is not None:
+                bucket.refill(now)
+
+        if user is not None and user.tokens < 1:
+            metrics.inc("admission_total", kind=self.kind, result="user_limit")
+            return (
+                "⏳ Слишком много запросов подряд.\n\n"
+                f"Попробуй через {int(user.wait_time()) + 1} с."
+            )
+        if self.overall is not None and self.overall.tokens < 1:
+            metrics.inc("admission_total", kind=self.kind, result="global_limit")
+            return (
+                "⏳ Сейчас слишком много запросов к боту.\n\n"
+                f"Попробуй через {int(self.overall.wait_time()) + 1} с."
+            )
+
+        for bucket in (user, self.overall):
+            if bucket is not None:
+                bucket.tokens -= 1
+        metrics.inc("admission_total", kind=self.kind, result="ok")
+        return None
+
+    def budget(self, user_id: int, within: float) -> float:
+        """Сколько токенов пользователь получит за within секунд (inf — без лимита)"""
+        now = time.monotonic()
+        budget = float("inf")
+        for bucket in (self._user_bucket(user_id), self.overall):
+            if bucket is not None:
+                bucket.refill(now)
+                budget = min(budget, bucket.tokens + within * bucket.rate)
+        return budget
+
+    async def acquire(self, user_id: int, max_wait: float) -> str | None:
+        """Как admit, но пока токена нет — ждать его, не дольше max_wait секунд"""
+        deadline = time.monotonic() + max_wait
+        while True:
+            now = time.monotonic()
+            wait = 0.0
+            for bucket in (self._user_bucket(user_id), self.overall):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time())
+            if not wait or now + wait > deadline:
+                return self.admit(user_id)
+            await asyncio.sleep(wait)
+
+
+link_limiter = RateLimiter("links", USER_LINKS_PER_MINUTE, GLOBAL_LINKS_PER_MINUTE)
+download_limiter = RateLimiter("downloads", USER_DOWNLOADS_PER_MINUTE, GLOBAL_DOWNLOADS_PER_MINUTE)
+
+# Извлечений метаданных, запущенных или ждущих потока в info_executor
+info_pending = 0
+
+SHED_TEXT = (
+    "🔥 **Бот сейчас перегружен.**\n\n"
+    "Пакеты и видео 720p и выше временно не принимаются — "
+    "выбери 360p или аудио, или попробуй через несколько минут."
+)
+
+
+def current_load() -> int:
+    """Ожидающая работа: очередь загрузок + извлечения метаданных сверх пула"""
+    return download_scheduler.depth + max(0, info_pending - INFO_WORKERS)
+
+
+def should_shed(cheap: bool) -> bool:
+    """Отклонить ли низкоприоритетную (не «дешёвую») работу из-за нагрузки"""
+    if cheap or not SHED_QUEUE_DEPTH or current_load() < SHED_QUEUE_DEPTH:
+        return False
+    metrics.inc("admission_total", kind="load", result="shed")
+    return True
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ПРЕДЗАГРУЗКА
+# ═══════════════════════════════════════════════════════════════
+
+# Пока пользователь выбирает качество, начинаем скачивать самый вероятный
+# вариант в кэш потоков. Только при свободных слотах и только в режиме потоков
+# (отмена работает через progress hook в том же процессе).
+PREFETCH = os.environ.get("PREFETCH", "0") == "1"
+# Что предзагружать: auto — самый частый выбор пользователей, иначе 360/720/1080/best/audio
+PREFETCH_QUALITY = os.environ.get("PREFETCH_QUALITY", "auto")
+PREFETCH_DEFAULT = ("video", "720")   # для auto, пока нет истории выборов
+# Псевдопользователь планировщика для предзагрузок: они не занимают
+# места в очереди пользователя (MAX_QUEUE_PER_USER) и вместе получают одну
+# долю round-robin
+PREFETCH_USER_ID = 0
+
+
+class Prefetch:
+    """Выполняющаяся предзагрузка потоков одного видео"""
+
+    def __init__(self, key: tuple):
+        self.key = key                      # (source, format_type, quality)
+        self.cancelled = threading.Event()
+        self.messages = []                  # статусные сообщения задачи, которая её дождалась
+        self.future = None
+
+
+# source -> Prefetch
+prefetches = {}
+
+# Сколько раз выбирали (format_type, quality) — для PREFETCH_QUALITY=auto
+choice_history = {}
+
+
+def record_choice(format_type: str, quality: str):
+    key = (format_type, quality)
+    choice_history[key] = choice_history.get(key, 0) + 1
+
+
+def prefetch_choice() -> tuple:
+    """(format_type, quality), который вероятнее всего выберут"""
+    if PREFETCH_QUALITY == "audio":
+        return "audio", ""
+    if PREFETCH_QUALITY in FORMAT_MAP:
+        return "video", PREFETCH_QUALITY
+    if not choice_history:
+        return PREFETCH_DEFAULT
+    return max(choice_history, key=choice_history.get)
+
+
+def prefetch_streams(info: dict, format_type: str, quality: str, progress_hook, cancelled) -> list:
+    """Скачивание потоков для (format_type, quality) в кэш потоков (синхронная)
+
+    Встроенным загрузчиком: отмена через progress hook останавливает
+    скачивание на ближайшем блоке, а не после всего потока.
+    """
+    def hook(d):
+        if cancelled.is_set():
+            raise yt_dlp.utils.DownloadCancelled("предзагрузка отменена")
+        progress_hook(d)
+
+    # Аудиодорожка общая для всех вариантов — её первой
+    formats = sorted(select_formats(info, format_spec(format_type, quality)),
+                     key=lambda fmt: not _is_audio_only(fmt))
+    paths = []
+    for fmt in formats:
+        if cancelled.is_set():
+            raise yt_dlp.utils.DownloadCancelled("предзагрузка отменена")
+        paths.append(download_stream(info, fmt, hook, native=True))
+    return paths
+
+
+async def maybe_prefetch(source: str, info: dict, sizes: dict):
+    """Запустить предзагрузку, если она включена и есть свободные слоты"""
+    if not PREFETCH or BOT_ROLE == "frontend" or progress_relay is not None:
+        return
+    if source in prefetches or not info.get("id"):
+        return
+    # Последний слот всегда остаётся для настоящих задач (идущие предзагрузки
+    # уже учтены в running: очереди нет, и они сразу получают слот)
+    scheduler = download_scheduler
+    if scheduler.depth or scheduler.running >= scheduler.workers - 1:
+        return
+
+    format_type, quality = prefetch_choice()
+    if format_type == "video":
+        if fit_quality(sizes, quality) != quality or _use_streaming(info, format_type, quality):
+            return
+    elif sizes.get(audio_size_key(quality), 0) > TELEGRAM_FILE_LIMIT:
+        return
+    key = (source, format_type, quality)
+    if key in inflight_jobs or disk_cache.contains_key(key) \
+       or await shared_call(telegram_file_cache.contains, key):
+        return
+    if source in prefetches:
+        return      # пока шла проверка кэша, предзагрузку запустил другой запрос
+
+    loop = asyncio.get_running_loop()
+    prefetch = Prefetch(key)
+    hook = make_progress_hook(loop, prefetch.messages)
+    prefetch.future = asyncio.ensure_future(scheduler.submit(
+        PREFETCH_USER_ID, False, prefetch_streams, info, format_type, quality, hook, prefetch.cancelled,
+    ))
+    prefetches[source] = prefetch
+    metrics.inc("prefetch_total", result="started")
+    logger.info(f"Предзагрузка: {key}")
+
+    def done(future):
+        if prefetches.get(source) is prefetch:
+            del prefetches[source]
+        loop.run_in_executor(None, register_streams, source)
+        if not future.cancelled() and future.exception() is not None:
+            logger.info(f"Предзагрузка {key} остановлена: {future.exception()}")
+
+    prefetch.future.add_done_callback(done)
+
+
+def cancel_prefetch(source: str):
+    """Отменить предзагрузку видео (пользователь выбрал другое или отказался)"""
+    prefetch = prefetches.get(source)
+    if prefetch is not None and not prefetch.cancelled.is_set():
+        prefetch.cancelled.set()
+        metrics.inc("prefetch_total", result="cancelled")
+
+
+def preempt_prefetches(keep_source: str):
+    """Нет свободных слотов — отменить предзагрузки других видео"""
+    if download_scheduler.running < download_scheduler.workers:
+        return
+    for source in list(prefetches):
+        if source != keep_source:
+            cancel_prefetch(source)
+
+
+async def settle_prefetch(job: "InflightJob"):
+    """Перед скачиванием: дождаться своей предзагрузки или отменить чужую
+
+    Совпадающая предзагрузка «повышается»: задача показывает её прогресс и
+    дальше берёт готовые потоки из кэша. Несовпадающая отменяется без
+    ожидания: она останавливается на ближайшем блоке и отпускает блокировку
+    потока, а частично скачанные файлы докачаются (общая аудиодорожка не
+    качается дважды).
+    """
+    cache_source, _, _ = job.key
+    prefetch = prefetches.get(cache_source)
+    if prefetch is None:
+        return
+
+    if prefetch.key == job.key and not prefetch.cancelled.is_set():
+        logger.info(f"Предзагрузка пригодилась: {job.key}")
+        metrics.inc("prefetch_total", result="promoted")
+        prefetch.messages.extend(job.messages)
+        job.messages = prefetch.messages
+    else:
+        cancel_prefetch(cache_source)
+        return
+
+    try:
+        await asyncio.shield(prefetch.future)
+    except Exception:
+        pass
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ПОТОКОВАЯ ОТПРАВКА
+# ═══════════════════════════════════════════════════════════════
+
+# Потоковый режим: ffmpeg пишет фрагментированный MP4 прямо с YouTube,
+# а готовые части сразу уходят в Telegram — скачивание и загрузка
+# идут одновременно. Включается только для больших видео.
+STREAM_UPLOAD = os.environ.get("STREAM_UPLOAD", "0") == "1"
+STREAM_UPLOAD_MIN_BYTES = int(os.environ.get("STREAM_UPLOAD_MIN_BYTES", str(200 * 1024 * 1024)))
+
+STREAM_PART_SIZE = 512 * 1024             # размер части upload.saveBigFilePart
+STREAM_BIG_FILE_MIN = 10 * 1024 * 1024    # меньшие файлы Telegram принимает только целиком
+STREAM_POLL_INTERVAL = 0.5
+
+
+class StreamFallback(Exception):
+    """Потоковая отправка невозможна — нужно отправить файл обычным способом"""
+
+
+async def _upload_growing_file(client: Client, chat_id: int, path: str, producer: asyncio.Future,
+                               caption: str, duration: int, width: int, height: int,
+                               expected_size: int, status_messages: list) -> Message:
+    """Отправка файла, который ещё дописывается
+
+    Части уходят через upload.saveBigFilePart с file_total_parts=-1,
+    а последние — с реальным числом частей, когда producer завершился.
+    """
+    upload_id = client.rnd_id()
+    offset = 0
+    part = 0
+    f = None
+    try:
+        while True:
+            finished = producer.done()
+            if finished:
+                producer.result()   # пробрасываем ошибку ffmpeg
+
+            if f is None:
+                if not os.path.exists(path):
+                    await asyncio.sleep(STREAM_POLL_INTERVAL)
+                    continue
+                f = open(path, "rb")
+
+            size = os.path.getsize(path)
+            if size > TELEGRAM_FILE_LIMIT and SPLIT_UPLOAD:
+                raise StreamFallback("файл больше лимита — будет отправлен частями")
+            if size > TELEGRAM_FILE_LIMIT:
+                raise JobError(
+                    f"❌ Файл слишком большой: больше {format_size(TELEGRAM_FILE_LIMIT)}\n\n"
+                    "💡 Попробуй выбрать качество пониже (360p или 720p)."
+                )
+            if finished and size < STREAM_BIG_FILE_MIN:
+                raise StreamFallback("файл слишком мал для потоковой отправки")
+
+            total_parts = (size + STREAM_PART_SIZE - 1) // STREAM_PART_SIZE if finished else -1
+
+            # Пока файл растёт, отправляем только части, за которыми уже есть данные:
+            # последняя часть всегда уходит после завершения, с известным числом частей
+            sent_any = False
+            while (size - offset > STREAM_PART_SIZE) or (finished and offset < size):
+                f.seek(offset)
+                chunk = f.read(STREAM_PART_SIZE)
+                await client.invoke(raw.functions.upload.SaveBigFilePart(
+                    file_id=upload_id,
+                    file_part=part,
+                    file_total_parts=total_parts,
+                    bytes=chunk,
+                ))
+                offset += len(chunk)
+                part += 1
+                sent_any = True
+                await progress_callback(offset, max(expected_size, size), status_messages, "upload")
+
+            if finished:
+                break
+            if not sent_any:
+                await asyncio.sleep(STREAM_POLL_INTERVAL)
+    finally:
+        if f is not None:
+            f.close()
+
+    file_name = os.path.basename(path)
+    return await _send_uploaded_video(
+        client, chat_id, raw.types.InputFileBig(id=upload_id, parts=part, name=file_name),
+        file_name, caption, duration, width, height,
+    )
+
+
+async def _send_uploaded_video(client: Client, chat_id: int, input_file, file_name: str,
+                               caption: str, duration: int, width: int, height: int) -> Message:
+    """Сообщение с уже загруженным в Telegram видео (InputFile/InputFileBig)"""
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type="video/mp4",
+        file=input_file,
+        attributes=[
+            raw.types.DocumentAttributeVideo(
+                supports_streaming=True,
+                duration=duration,
+                w=width,
+                h=height,
+            ),
+            raw.types.DocumentAttributeFilename(file_name=file_name),
+        ],
+    )
+    r = await client.invoke(raw.functions.messages.SendMedia(
+        peer=await client.resolve_peer(chat_id),
+        media=media,
+        random_id=client.rnd_id(),
+        **await pyrogram_utils.parse_text_entities(client, caption, ParseMode.MARKDOWN, None),
+    ))
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await Message._parse(
+                client, update.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats},
+            )
+    raise RuntimeError("Telegram не вернул отправленное сообщение")
+
+
+def _use_streaming(info: dict | None, format_type: str, quality: str) -> bool:
+    """Включать ли потоковый режим для задачи"""
+    if not STREAM_UPLOAD or format_type != "video" or info is None:
+        return False
+    size = estimate_sizes(info).get(quality, 0)
+    if SPLIT_UPLOAD and size > TELEGRAM_FILE_LIMIT:
+        # Больше лимита — сразу частями, одним файлом отправить не выйдет
+        return False
+    return size >= STREAM_UPLOAD_MIN_BYTES
+
+
+async def _stop_stream(producer: asyncio.Future, output_file: str):
+    """Остановить ffmpeg потоковой задачи и дождаться его выхода
+
+    Отмена asyncio-future не останавливает ffmpeg в пуле: он держал бы слот
+    скачивания и писал в уже удалённый файл. Флаг-файл удаляется вместе
+    с остальными файлами задачи (cleanup_files).
+    """
+    open(output_file + STREAM_STOP_SUFFIX, "w").close()
+    await asyncio.shield(asyncio.wait([producer]))
+    if not producer.cancelled():
+        producer.exception()    # ошибка остановленного ffmpeg уже не нужна
+
+
+async def _stream_job(client: Client, job: "InflightJob", chat_id: int, user_id: int,
+                      info: dict, quality: str, title: str, output_file: str,
+                      on_position) -> tuple:
+    """Скачивание с одновременной отправкой; возвращает (file_id, готовый файл)
+
+    file_id = None — потоковая отправка не удалась, но если файл скачан,
+    его путь возвращается для обычной отправки.
+    """
+    info = yt_dlp.YoutubeDL.sanitize_info(info)
+    producer = asyncio.ensure_future(download_scheduler.submit(
+        user_id,
+        False,
+        stream_media,
+        info,
+        quality,
+        output_file,
+        on_position=on_position,
+    ))
+    expected_size = estimate_sizes(info).get(quality, 0)
+    started = time.monotonic()
+    try:
+        # Размер кадра — выбранного видеоформата (в info — лучшего формата ролика)
+        formats = await asyncio.get_running_loop().run_in_executor(
+            None, select_formats, info, FORMAT_MAP.get(quality, FORMAT_MAP["best"]))
+        video = next((fmt for fmt in formats if fmt.get("height")), info)
+        msg = await _upload_growing_file(
+            client, chat_id, output_file, producer,
+            caption=f"🎬 **{title}**",
+            duration=int(info.get("duration") or 0),
+            width=int(video.get("width") or 0),
+            height=int(video.get("height") or 0),
+            expected_size=expected_size,
+            status_messages=job.messages,
+        )
+    except (JobError, asyncio.CancelledError):
+        await _stop_stream(producer, output_file)
+        raise
+    except Exception as e:
+        logger.warning(f"Потоковая отправка не удалась, отправлю обычным способом: {e}")
+        try:
+            return None, await producer
+        except Exception as e:
+            logger.warning(f"Потоковое скачивание не удалось: {e}")
+            return None, None
+
+    metrics.observe("stage_seconds", time.monotonic() - started, stage="stream")
+    metrics.inc("bytes_total", os.path.getsize(output_file), direction="upload")
+
+    sent_file_id = msg.video.file_id if msg.video else (msg.document.file_id if msg.document else None)
+    if sent_file_id:
+        await shared_call(telegram_file_cache.put, job.key, sent_file_id, title)
+        logger.info(f"Telegram file_id закэширован (потоково): {job.key}")
+    return sent_file_id, output_file
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ОТПРАВКА ЧАСТЯМИ
+# ═══════════════════════════════════════════════════════════════
+
+# Видео больше 2 ГБ не отклоняется, а режется на части без перекодирования
+# (и качество не понижается заранее). Целевой размер части меньше лимита:
+# разрез попадает на ключевой кадр, а битрейт по ходу видео неравномерный.
+SPLIT_UPLOAD = os.environ.get("SPLIT_UPLOAD", "0") == "1"
+SPLIT_PART_SIZE = int(os.environ.get("SPLIT_PART_SIZE_MB", "1800")) * 1024 * 1024
+
+# file_id частей хранятся в кэше file_id одной строкой через этот разделитель
+PART_SEPARATOR = ","
+
+
+def part_caption(title: str, index: int, count: int) -> str:
+    if count == 1:
+        return f"🎬 **{title}**"
+    return f"🎬 **{title}**\n🧩 Часть {index}/{count}"
+
+
+def split_segment_time(total_bytes: int, duration: float, formats: list) -> float:
+    """Длительность части (секунды), при которой части около SPLIT_PART_SIZE"""
+    if not duration:
+        # Длительность не известна — оцениваем по суммарному битрейту форматов
+        kbps = sum(fmt.get("tbr") or 0 for fmt in formats)
+        duration = total_bytes * 8 / (kbps * 1000) if kbps else 0
+    if not duration:
+        raise JobError(
+            f"❌ Файл слишком большой: {format_size(total_bytes)}\n\n"
+            "Не удалось определить длительность, чтобы разделить его на части."
+        )
+    return duration * SPLIT_PART_SIZE / total_bytes
+
+
+def segment_media(inputs: list, pattern: str, list_path: str, segment_time: float):
+    """Нарезка на MP4-части без перекодирования (синхронная)
+
+    Разрез — на первом ключевом кадре после segment_time, каждая часть —
+    самостоятельный MP4 с moov в начале. Закрытые части дописываются
+    в list_path (CSV: имя, начало, конец), пока ffmpeg режет следующие.
+    """
+    args = []
+    for path in inputs:
+        args += ["-i", path]
+    if len(inputs) == 2:
+        args += ["-map", "0:v:0", "-map", "1:a:0"]
+    args += [
+        "-c", "copy",
+        "-f", "segment",
+        "-segment_time", f"{segment_time:.3f}",
+        "-reset_timestamps", "1",
+        "-segment_format", "mp4",
+        "-segment_format_options", "movflags=+faststart",
+        "-segment_list", list_path,
+        "-segment_list_type", "csv",
+        "-threads", str(TRANSCODE_THREADS),
+        pattern,
+    ]
+    run_ffmpeg(args)
+
+
+def read_segment_list(list_path: str) -> list:
+    """Закрытые части: [(путь, длительность)] в порядке следования"""
+    try:
+        with open(list_path, encoding="utf-8") as f:
+            lines = f.read().split("\n")[:-1]     # последняя строка может быть недописана
+    except FileNotFoundError:
+        return []
+    parts = []
+    for line in lines:
+        name, start, end = line.rsplit(",", 2)
+        parts.append((os.path.join(os.path.dirname(list_path), name), float(end) - float(start)))
+    return parts
+
+
+async def _send_parts(client: Client, job: "InflightJob", chat_id: int, inputs: list,
+                      output_file: str, segment_time: float, title: str,
+                      width: int, height: int) -> str | None:
+    """Нарезка и отправка частями; возвращает file_id частей через PART_SEPARATOR
+
+    Каждая часть начинает загружаться, как только ffmpeg её закрыл;
+    одновременно загружается до max_concurrent_transmissions частей.
+    Сообщения уходят по порядку, когда известно число частей.
+    """
+    loop = asyncio.get_running_loop()
+    base, ext = os.path.splitext(output_file)
+    list_path = f"{base}_parts.csv"
+    producer = asyncio.ensure_future(loop.run_in_executor(
+        transcode_executor,
+        timed_executor_call("transcode", segment_media),
+        inputs, f"{base}_part%03d{ext}", list_path, segment_time,
+    ))
+
+    total = sum(os.path.getsize(path) for path in inputs)
+    uploaded = {}
+    uploads = []    # по части ffmpeg: задача -> [(путь, длительность, задача save_file)]
+    saves = []      # все задачи save_file
+    ffmpeg_jobs = [producer]
+
+    async def on_progress(current: int, _total: int, path: str):
+        uploaded[path] = current
+        await progress_callback(sum(uploaded.values()), total, job.messages, "upload")
+
+    def save(path: str):
+        task = asyncio.ensure_future(client.save_file(path, progress=on_progress, progress_args=(path,)))
+        saves.append(task)
+        return task
+
+    async def upload_part(path: str, duration: float) -> list:
+        """Загрузка части; часть больше лимита (битрейт неравномерный) режется ещё раз"""
+        size = os.path.getsize(path)
+        if size <= TELEGRAM_FILE_LIMIT:
+            return [(path, duration, save(path))]
+
+        logger.info(f"Часть {os.path.basename(path)} больше лимита ({format_size(size)}), режу её мельче")
+        part_base = os.path.splitext(path)[0]
+        part_list = f"{part_base}_parts.csv"
+        resplit = asyncio.ensure_future(loop.run_in_executor(
+            transcode_executor,
+            timed_executor_call("transcode", segment_media),
+            [path], f"{part_base}_%03d{ext}", part_list, duration * SPLIT_PART_SIZE / size,
+        ))
+        ffmpeg_jobs.append(resplit)
+        await resplit
+        result = []
+        for sub_path, sub_duration in read_segment_list(part_list):
+            sub_size = os.path.getsize(sub_path)
+            if sub_size > TELEGRAM_FILE_LIMIT:
+                raise JobError(
+                    f"❌ Часть видео больше лимита: {format_size(sub_size)}\n\n"
+                    "💡 Попробуй выбрать качество пониже (360p или 720p)."
+                )
+            result.append((sub_path, sub_duration, save(sub_path)))
+        return result
+
+    def start_uploads():
+        for path, duration in read_segment_list(list_path)[len(uploads):]:
+            uploads.append(asyncio.ensure_future(upload_part(path, duration)))
+
+    started = time.monotonic()
+    parts = []
+    try:
+        while not producer.done():
+            start_uploads()
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+        producer.result()   # пробрасываем ошибку ffmpeg
+        start_uploads()
+        for task in uploads:
+            parts += await task
+        logger.info(f"Видео разделено на {len(parts)} частей: {job.key}")
+
+        file_ids = []
+        for index, (path, duration, task) in enumerate(parts, 1):
+            msg = await _send_uploaded_video(
+                client, chat_id, await task, os.path.basename(path),
+                part_caption(title, index, len(parts)), int(duration), width, height,
+            )
+            media = msg.video or msg.document
+            file_ids.append(media.file_id if media else "")
+    finally:
+        for task in uploads + saves:
+            task.cancel()
+        # ffmpeg в пуле не прервать — ждём, чтобы части не удалили из-под него
+        await asyncio.wait(ffmpeg_jobs)
+
+    metrics.observe("stage_seconds", time.monotonic() - started, stage="upload")
+    metrics.inc("bytes_total", sum(os.path.getsize(path) for path, _, _ in parts), direction="upload")
+    metrics.inc("split_parts_total", len(parts))
+
+    if not all(file_ids):
+        return None
+    joined = PART_SEPARATOR.join(file_ids)
+    await shared_call(telegram_file_cache.put, job.key, joined, title)
+    logger.info(f"Telegram file_id закэширован ({len(file_ids)} частей): {job.key}")
+    return joined
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ФРАГМЕНТЫ ВИДЕО
+# ═══════════════════════════════════════════════════════════════
+
+# Длина фрагмента, если в ссылке есть только начало (&t=), секунды
+CLIP_DEFAULT_LENGTH = int(os.environ.get("CLIP_DEFAULT_LENGTH", "60"))
+
+# «ссылка 1:00-1:30», «ссылка 90-120», «ссылка 1m-1m30s»
+CLIP_RANGE_RE = re.compile(r"(\d[\d:hms]*)\s*[-–—]\s*(\d[\d:hms]*)", re.IGNORECASE)
+
+
+def parse_timestamp(value: str) -> int | None:
+    """Секунды из «90», «1:30», «1:02:03», «1h2m3s», «90s»"""
+    value = value.strip().lower()
+    if re.fullmatch(r"\d+(?::\d{1,2}){0,2}", value):
+        seconds = 0
+        for part in value.split(":"):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    match = re.fullmatch(r"(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?", value)
+    if match and any(match.groups()):
+        hours, minutes, seconds = (int(group or 0) for group in match.groups())
+        return hours * 3600 + minutes * 60 + seconds
+    return None
+
+
+def parse_clip(text: str, link: str) -> tuple:
+    """(фрагмент (start, end) или None, включён ли он сразу)
+
+    Диапазон рядом со ссылкой — явная просьба, фрагмент включён; только
+    &t= в ссылке — фрагмент от этой отметки предлагается кнопкой.
+    """
+    match = CLIP_RANGE_RE.search(text.replace(link, " "))
+    if match:
+        start, end = parse_timestamp(match[1]), parse_timestamp(match[2])
+        if start is not None and end is not None and end > start:
+            return (start, end), True
+
+    query = parse_qs(urlparse(link if "://" in link else "https://" + link).query)
+    value = (query.get("t") or query.get("start") or [None])[0]
+    start = parse_timestamp(value) if value else None
+    if start:
+        return (start, start + CLIP_DEFAULT_LENGTH), False
+    return None, False
+
+
+def fit_clip(clip: tuple | None, duration: int) -> tuple | None:
+    """Фрагмент в пределах длительности видео (None — вне видео)"""
+    if clip is None or not duration:
+        return clip
+    start, end = clip[0], min(clip[1], duration)
+    return (start, end) if start < end else None
+
+
+def format_clip(clip: tuple) -> str:
+    return f"{format_duration(clip[0])}–{format_duration(clip[1])}"
+
+
+def clip_source(video_id: str, clip: tuple) -> str:
+    """Ключ кэшей для фрагмента: "ID#start-end" """
+    return f"{video_id}#{clip[0]}-{clip[1]}"
+
+
+def split_source(source: str) -> tuple:
+    """(ID видео, фрагмент или None) из ключа кэшей"""
+    video_id, sep, span = source.partition("#")
+    if not sep:
+        return source, None
+    start, _, end = span.partition("-")
+    return video_id, (int(start), int(end))
+
+
+def clip_sizes(sizes: dict, duration: int, clip: tuple) -> dict:
+    """Оценка размеров для фрагмента — пропорционально его длине"""
+    if not duration:
+        return sizes
+    share = (clip[1] - clip[0]) / duration
+    return {key: int(size * share) for key, size in sizes.items()}
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ОБРАБОТКА КНОПОК
+# ═══════════════════════════════════════════════════════════════
+
+class InflightJob:
+    """Выполняющаяся задача (скачивание + отправка) для одного ключа кэша
+
+    Одновременные запросы того же (source, format_type, quality) не запускают
+    своё скачивание, а присоединяются к этой задаче: их статусные сообщения
+    получают тот же прогресс, а по завершении им отправляется готовый file_id.
+    """
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.messages = []   # статусные сообщения всех ожидающих
+        self.future = asyncio.get_running_loop().create_future()  # -> file_id
+        self.journal_id = None   # запись ведущего запроса в job_journal
+
+    def release(self):
+        """Завершение ведущего запроса: ожидающие не должны зависнуть
+
+        Если future не разрешён (ведущего отменили — CancelledError не ловится
+        как Exception), присоединившиеся получают ошибку. Исключение забирается,
+        чтобы не было предупреждения о незабранном исключении.
+        """
+        if not self.future.done():
+            self.future.set_exception(JobError("❌ Загрузка прервана. Попробуй ещё раз."))
+        if not self.future.cancelled():
+            self.future.exception()
+
+
+# Реестр выполняющихся задач: (source, format_type, quality) -> InflightJob
+inflight_jobs = {}
+
+
+@app.on_callback_query()
+async def handle_callback(client: Client, callback: CallbackQuery):
+    """Обработка нажатия кнопок"""
+    await callback.answer()
+
+    user_id = callback.from_user.id
+    action = callback.data
+
+    # Отмена
+    if action == "cancel":
+        session = user_sessions.pop(user_id)
+        if session is not None:
+            cancel_prefetch(session.source)
+        batch_sessions.pop(user_id)
+        await callback.message.edit_text("❌ Загрузка отменена.")
+        return
+
+    # Пакет (плейлист, канал или несколько ссылок)
+    if action.startswith("batch_"):
+        await handle_batch_callback(client, callback, action.replace("batch_", "", 1))
+        return
+
+    # Проверяем данные
+    session = user_sessions.get(user_id)
+    if session is None:
+        await callback.message.edit_text(
+            "❌ Ссылка не найдена. Отправь её заново."
+        )
+        return
+
+    # Переключатель «только фрагмент / всё видео»
+    if action == "clip_toggle":
+        if session.clip is None:
+            return
+        session.clip_on = not session.clip_on
+        sizes = (clip_sizes(session.sizes, session.duration, session.clip)
+                 if session.clip_on else session.sizes)
+        try:
+            await callback.message.edit_reply_markup(
+                build_quality_keyboard(sizes, clip=session.clip, clip_on=session.clip_on)
+            )
+        except MessageNotModified:
+            pass
+        return
+
+    url = session.url
+    cache_source = session.source
+    title = session.title or "video"
+    chat_id = callback.message.chat.id
+    sizes = session.sizes
+    if session.clip_on:
+        # Фрагмент — отдельный ключ кэшей и своё (меньшее) ограничение размера
+        cache_source = clip_source(session.source, session.clip)
+        sizes = clip_sizes(sizes, session.duration, session.clip)
+        title = f"{title} ✂️ {format_clip(session.clip)}"
+
+    # Определяем тип и качество
+    if action.startswith("video_"):
+        format_type = "video"
+        quality = action.replace("video_", "")  # "360", "720", "1080", "best"
+        dl_text = f"Скачиваю видео ({QUALITY_LABELS.get(quality, quality)})..."
+
+        # Проверяем размер заранее — до того, как скачан хоть один байт
+        fitted = fit_quality(sizes, quality)
+        if fitted is None:
+            await callback.message.edit_text(
+                f"❌ Видео слишком большое: ~{format_size(sizes[quality])}\n\n"
+                "Лимит Telegram: 2 ГБ даже для 360p."
+            )
+            return
+        if fitted != quality:
+            logger.info(f"Понижение качества {quality} -> {fitted} ({cache_source}): оценка больше лимита")
+            dl_text = (
+                f"Скачиваю видео ({QUALITY_LABELS[fitted]} вместо {QUALITY_LABELS.get(quality, quality)}: "
+                f"~{format_size(sizes[quality])} больше лимита 2 ГБ)..."
+            )
+            quality = fitted
+    else:
+        format_type = "audio"
+        quality = parse_audio_action(action) or ""
+        dl_text = f"Извлекаю аудио ({AUDIO_FORMATS[quality][1]})..."
+        size = sizes.get(audio_size_key(quality), 0)
+        if size > TELEGRAM_FILE_LIMIT:
+            await callback.message.edit_text(
+                f"❌ Аудио слишком большое: ~{format_size(size)}\n\n"
+                "Лимит Telegram: 2 ГБ"
+            )
+            return
+
+    record_choice(format_type, quality)
+
+    # 1) Проверяем кэш Telegram file_id (мгновенная отправка)
+    tg_cache_key = (cache_source, format_type, quality)
+    with metrics.timer("cache_lookup_seconds", cache="file_id"):
+        cached_file_id = await shared_call(telegram_file_cache.get, tg_cache_key)
+    if cached_file_id:
+        stats = await shared_call(telegram_file_cache.stats)
+        logger.info(f"Telegram file_id кэш-хит: {tg_cache_key} ({stats})")
+        try:
+            await _send_cached(client, chat_id, cached_file_id, format_type, title)
+            metrics.inc("jobs_total", result="file_id")
+            await callback.message.delete()
+            user_sessions.pop(user_id)
+            return
+        except Exception as e:
+            logger.warning(f"Ошибка отправки по file_id: {e}")
+            await shared_call(telegram_file_cache.invalidate, tg_cache_key)
+
+    # Новая загрузка (не кэш и не присоединение к идущей задаче) — через допуск;
+    # клавиатура остаётся, чтобы можно было выбрать вариант полегче
+    if inflight_jobs.get(tg_cache_key) is None and not disk_cache.contains_key(tg_cache_key):
+        cheap = format_type == "audio" or quality == "360"
+        rejection = SHED_TEXT if should_shed(cheap) else download_limiter.admit(user_id)
+        if rejection:
+            try:
+                await callback.message.edit_text(rejection, reply_markup=callback.message.reply_markup,
+                                                 parse_mode=ParseMode.MARKDOWN)
+            except MessageNotModified:
+                pass
+            return
+
+    # Запрос выполняется на этом узле — в журнал, чтобы пережить перезапуск
+    journal_id = None
+    if BOT_ROLE != "frontend":
+        journal_id = job_journal.add(tg_cache_key, {
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "message_id": callback.message.id,
+            "url": url,
+            "title": title,
+            "dl_text": dl_text,
+        })
+
+    # 2) Такой же файл уже готовится для другого запроса — присоединяемся
+    job = inflight_jobs.get(tg_cache_key)
+    if job is not None:
+        logger.info(f"Присоединение к выполняющейся задаче: {tg_cache_key}")
+        job.messages.append(callback.message)
+        await _safe_edit(
+            callback.message,
+            f"⏳ **{dl_text}**\n\n"
+            "🤝 Это видео уже готовится по другому запросу — присоединяю тебя."
+        )
+        try:
+            file_id = await asyncio.shield(job.future)
+            if not file_id:
+                raise JobError("❌ Не удалось получить файл.")
+            await _send_cached(client, chat_id, file_id, format_type, title)
+            metrics.inc("jobs_total", result="joined")
+            job_journal.remove(journal_id)
             await callback.message.delete()
-            if user_id in user_data:
-                del user_data[user_id]
-            return
+            user_sessions.pop(user_id)
+        except JobError as e:
+            job_journal.remove(journal_id)
+            await _safe_edit(callback.message, str(e))
         except Exception as e:
-            logger.warning(f"Ошибка отправки по file_id: {e}")
-            telegram_file_cache.pop(tg_cache_key, None)
+            logger.error(f"Ошибка совместной задачи: {e}")
+            job_journal.remove(journal_id)
+            await callback.message.edit_text(
+                f"❌ **Ошибка при скачивании:**\n\n"
+                f"`{str(e)[:300]}`",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        return
+
+    # 3) Мы — ведущий запрос: скачиваем и отправляем, результат получат все
+    job = InflightJob(tg_cache_key)
+    job.messages.append(callback.message)
+    job.journal_id = journal_id
+    inflight_jobs[tg_cache_key] = job
+    started = time.monotonic()
+    try:
+        try:
+            if BOT_ROLE == "frontend":
+                # Скачивает и отправляет один из узлов-воркеров
+                file_id = await _remote_job(job, callback.message, chat_id, user_id, url,
+                                            format_type, quality, title, dl_text)
+            else:
+                file_id = await _run_job(client, job, chat_id, user_id, url,
+                                         format_type, quality, title, dl_text)
+        finally:
+            # Прогресс больше не нужен: дальше идут только итоговые правки
+            for message in job.messages:
+                edit_dispatcher.forget(message)
+        job.future.set_result(file_id)
+        metrics.observe("stage_seconds", time.monotonic() - started, stage="job")
+        metrics.inc("jobs_total", result="ok")
+        job_journal.remove(journal_id)
+        await callback.message.delete()
+        user_sessions.pop(user_id)
+    except JobError as e:
+        job.future.set_exception(e)
+        metrics.inc("jobs_total", result="rejected")
+        job_journal.remove(journal_id)
+        await _safe_edit(callback.message, str(e))
+    except Exception as e:
+        logger.error(f"Ошибка при скачивании: {e}")
+        metrics.inc("jobs_total", result="error")
+        job_journal.remove(journal_id)
+        job.future.set_exception(e)
+        await callback.message.edit_text(
+            f"❌ **Ошибка при скачивании:**\n\n"
+            f"`{str(e)[:300]}`",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    finally:
+        inflight_jobs.pop(tg_cache_key, None)
+        job.release()
+
 
-    # 2) Проверяем файловый кэш (файл на диске)
-    cached_path = cache_get(url, format_type, quality)
+async def _run_job(client: Client, job: InflightJob, chat_id: int, user_id: int,
+                   url: str, format_type: str, quality: str, title: str,
+                   dl_text: str) -> str:
+    """Получение файла (файловый кэш или скачивание) и отправка; возвращает file_id"""
+    cache_source, _, _ = job.key
+    video_id, clip = split_source(cache_source)
+
+    # Проверяем файловый кэш (файл на диске)
+    with metrics.timer("cache_lookup_seconds", cache="disk"):
+        cached_path = disk_cache.get(job.key)
     if cached_path:
         logger.info(f"Файловый кэш-хит: {cached_path}")
-        await callback.message.edit_text(
+        _edit_all(
+            job.messages,
             f"⚡ **Файл найден в кэше!**\n\n"
-            f"📤 Загружаю в Telegram...",
-            parse_mode=ParseMode.MARKDOWN
+            f"📤 Загружаю в Telegram..."
         )
         try:
             file_size = os.path.getsize(cached_path)
-            if file_size > 2 * 1024 * 1024 * 1024:
-                await callback.message.edit_text(
+            if file_size > TELEGRAM_FILE_LIMIT:
+                raise JobError(
                     f"❌ Файл слишком большой: {format_size(file_size)}\nЛимит Telegram: 2 ГБ"
                 )
-                return
-            await _send_file(client, callback, cached_path, format_type, title, tg_cache_key)
-            await callback.message.delete()
-            if user_id in user_data:
-                del user_data[user_id]
-            return
+            disk_cache.pin(cached_path)
+            job_journal.set_state(job.journal_id, "uploading", cached_path)
+            try:
+                return await _send_file(client, chat_id, cached_path, format_type, title,
+                                        job.key, job.messages)
+            finally:
+                disk_cache.unpin(cached_path)
+        except JobError:
+            raise
         except Exception as e:
             logger.warning(f"Ошибка отправки из кэша: {e}")
             # Продолжаем обычную загрузку
 
-    # Начинаем загрузку
-    await callback.message.edit_text(
-        f"⏳ **{dl_text}**\n\n"
-        "Это может занять несколько минут.",
-        parse_mode=ParseMode.MARKDOWN
-    )
+    started = []
+
+    def on_position(position: int):
+        if position == 0:
+            # Начинаем загрузку
+            started.append(time.monotonic())
+            job_journal.set_state(job.journal_id, "downloading")
+            _edit_all(
+                job.messages,
+                f"⏳ **{dl_text}**\n\n"
+                "Это может занять несколько минут."
+            )
+        else:
+            _edit_all(
+                job.messages,
+                f"🕐 **В очереди:** ты #{position}\n\n"
+                "Загрузка начнётся автоматически."
+            )
 
-    # Уникальное имя файла
-    file_id = f"{user_id}_{int(time.time())}"
+    # Уникальное имя файла (у одного пользователя может идти несколько задач сразу)
+    file_id = f"{user_id}_{int(time.time())}_{os.urandom(3).hex()}"
 
     if format_type == "video":
         output_file = os.path.join(DOWNLOAD_PATH, f"{file_id}.mp4")
     else:
-        output_file = os.path.join(DOWNLOAD_PATH, f"{file_id}.mp3")
+        output_file = os.path.join(DOWNLOAD_PATH, f"{file_id}.{audio_ext(quality)}")
+    job_journal.set_state(job.journal_id, "queued", output_file)
 
     try:
         loop = asyncio.get_event_loop()
+        info = info_cache.get(video_id)
 
-        # Создаём progress hook
-        hook = make_progress_hook(loop, callback.message)
+        # Предзагрузка этого видео: дождаться своей или отменить чужую
+        await settle_prefetch(job)
+        preempt_prefetches(video_id)
 
-        # Скачиваем в пуле для загрузок
-        final_file = await loop.run_in_executor(
-            download_executor,
-            download_media,
-            url,
-            output_file,
-            format_type,
-            quality,
-            hook,
-        )
+        final_file = None
+        if clip is not None:
+            # Фрагмент: ffmpeg читает из потоков только нужный диапазон
+            if info is not None and progress_relay is not None:
+                info = yt_dlp.YoutubeDL.sanitize_info(info)
+            final_file = await download_scheduler.submit(
+                user_id,
+                format_type == "audio" or quality == "360",
+                download_clip,
+                url, info, clip, output_file, format_type, quality,
+                on_position=on_position,
+            )
+            if started:
+                metrics.observe("stage_seconds", time.monotonic() - started[0], stage="download")
+
+        # Большое видео: скачиваем и сразу отправляем части
+        elif _use_streaming(info, format_type, quality):
+            sent_file_id, final_file = await _stream_job(
+                client, job, chat_id, user_id, info, quality, title, output_file, on_position
+            )
+            if sent_file_id:
+                disk_cache.put(job.key, output_file)
+                return sent_file_id
+
+        if final_file is None:
+            # Создаём progress hook (прогресс видят все присоединившиеся)
+            hook = make_progress_hook(loop, job.messages)
+
+            # Для аудио подойдёт уже скачанное видео этого ролика — без обращения к YouTube
+            # (кроме Opus: его дорожку выгоднее скачать, чем перекодировать AAC)
+            local_source = (disk_cache.find_any(cache_source, "video")
+                            if format_type == "audio" and quality != "opus" else None)
+            if local_source:
+                disk_cache.pin(local_source)
+
+            # Уже скачанные потоки видео не вытесняются, пока качаются остальные и идёт склейка
+            held_streams = disk_cache.pin_streams(video_id)
+
+            # Сеть — через планировщик (по закэшированному info, если есть)
+            func, args, token = download_call(hook, url, format_type, quality, info, local_source)
+            streams = []
+            try:
+                streams, formats, refreshed = await download_scheduler.submit(
+                    user_id,
+                    format_type == "audio" or quality == "360",
+                    func,
+                    *args,
+                    on_position=on_position,
+                )
+                if refreshed:
+                    # Ссылки в закэшированном info протухли (воркер извлёк его заново)
+                    info_cache.invalidate(video_id)
+                if started:
+                    metrics.observe("stage_seconds", time.monotonic() - started[0], stage="download")
+                # Ожидание слота транскодирования и отправка частей бывают долгими: потоки
+                # закреплены до конца, чтобы их не вытеснили после учёта другой задачей
+                for path in streams:
+                    disk_cache.pin(path)
+                held_streams += streams
+
+                # Больше лимита — режем прямо из потоков, без склейки в один файл
+                total = sum(os.path.getsize(path) for path in streams)
+                if SPLIT_UPLOAD and format_type == "video" and total > TELEGRAM_FILE_LIMIT:
+                    job_journal.set_state(job.journal_id, "uploading")
+                    video_format = next((f for f in formats if not _is_audio_only(f)), {})
+                    inputs = streams if not _is_audio_only(formats[0]) else streams[::-1]
+                    duration = (info or {}).get("duration") or 0
+                    return await _send_parts(
+                        client, job, chat_id, inputs, output_file,
+                        split_segment_time(total, duration, formats), title,
+                        int(video_format.get("width") or 0), int(video_format.get("height") or 0),
+                    )
+
+                # Процессор — отдельный ограниченный пул, слот скачивания уже свободен
+                job_journal.set_state(job.journal_id, "merging")
+                final_file = await loop.run_in_executor(
+                    transcode_executor,
+                    timed_executor_call("transcode", finish_media),
+                    streams, formats, output_file, format_type, quality,
+                )
+            finally:
+                if token is not None:
+                    progress_relay.unregister(token)
+                if local_source:
+                    disk_cache.unpin(local_source)
+                for path in held_streams:
+                    disk_cache.unpin(path)
+                # Новые элементарные потоки — в бюджет файлового кэша (манифест — вне event loop)
+                await loop.run_in_executor(None, register_streams, video_id, streams)
 
         # Проверяем файл
         if not os.path.exists(final_file):
-            await callback.message.edit_text("❌ Не удалось скачать файл.")
-            return
+            raise JobError("❌ Не удалось скачать файл.")
 
         file_size = os.path.getsize(final_file)
 
         # Проверяем размер (лимит Telegram 2 ГБ)
-        if file_size > 2 * 1024 * 1024 * 1024:
-            await callback.message.edit_text(
+        if file_size > TELEGRAM_FILE_LIMIT and SPLIT_UPLOAD and format_type == "video":
+            # Готовый файл (например, после неудачной потоковой отправки) — тоже частями
+            job_journal.set_state(job.journal_id, "uploading")
+            info = info or {}
+            return await _send_parts(
+                client, job, chat_id, [final_file], output_file,
+                split_segment_time(file_size, info.get("duration") or 0, []), title,
+                int(info.get("width") or 0), int(info.get("height") or 0),
+            )
+        if file_size > TELEGRAM_FILE_LIMIT:
+            raise JobError(
                 f"❌ Файл слишком большой: {format_size(file_size)}\n\n"
                 "Лимит Telegram: 2 ГБ\n\n"
                 "💡 Попробуй выбрать качество пониже (360p или 720p)."
             )
-            cleanup_files(file_id)
-            return
 
-        # Кэшируем файл
-        cache_put(url, format_type, quality, final_file)
+        # Кэшируем файл (и защищаем от вытеснения, пока отправляем)
+        disk_cache.put(job.key, final_file, pin=True)
+        job_journal.set_state(job.journal_id, "uploading", final_file)
 
         # Отправляем файл
-        await callback.message.edit_text(
+        _edit_all(
+            job.messages,
             f"📤 **Загружаю в Telegram...**\n\n"
-            f"📊 Размер: {format_size(file_size)}",
-            parse_mode=ParseMode.MARKDOWN
+            f"📊 Размер: {format_size(file_size)}"
         )
 
-        await _send_file(client, callback, final_file, format_type, title, tg_cache_key)
-
-        # Удаляем статусное сообщение
-        await callback.message.delete()
-
-        # Очищаем данные пользователя
-        if user_id in user_data:
-            del user_data[user_id]
-
-    except Exception as e:
-        logger.error(f"Ошибка при скачивании: {e}")
-        await callback.message.edit_text(
-            f"❌ **Ошибка при скачивании:**\n\n"
-            f"`{str(e)[:300]}`",
-            parse_mode=ParseMode.MARKDOWN
-        )
+        try:
+            return await _send_file(client, chat_id, final_file, format_type, title,
+                                    job.key, job.messages)
+        finally:
+            disk_cache.unpin(final_file)
 
     finally:
         # Удаляем временные файлы (кроме закэшированных)
-        cached = cache_get(url, format_type, quality)
-        if not cached:
+        if not disk_cache.contains_path(output_file):
             cleanup_files(file_id)
 
 
-async def _send_file(client: Client, callback: CallbackQuery,
+def _edit_all(messages: list, text: str):
+    """Редактирование всех статусных сообщений задачи (через edit_dispatcher)"""
+    for message in list(messages):
+        edit_dispatcher.submit(message, text)
+
+
+async def _send_cached(client: Client, chat_id: int, file_id: str,
+                       format_type: str, title: str):
+    """Мгновенная отправка уже загруженного в Telegram файла по file_id"""
+    if format_type == "video":
+        # Видео больше 2 ГБ — несколько file_id, по одному на часть
+        parts = file_id.split(PART_SEPARATOR)
+        for index, part in enumerate(parts, 1):
+            await client.send_video(
+                chat_id=chat_id,
+                video=part,
+                caption=part_caption(title, index, len(parts)),
+                parse_mode=ParseMode.MARKDOWN,
+                supports_streaming=True,
+            )
+    else:
+        # Не-MP3/M4A аудио Telegram может сохранить как документ —
+        # send_cached_media отправляет file_id любого типа
+        await client.send_cached_media(
+            chat_id=chat_id,
+            file_id=file_id,
+            caption=f"🎵 **{title}**",
+            parse_mode=ParseMode.MARKDOWN,
+        )
+
+
+async def _send_file(client: Client, chat_id: int,
                      file_path: str, format_type: str, title: str,
-                     tg_cache_key: tuple = None):
-    """Отправка файла в Telegram + кэширование file_id"""
+                     tg_cache_key: tuple = None, status_messages: list = None) -> str | None:
+    """Отправка файла в Telegram + кэширование file_id; возвращает file_id"""
+    status_messages = status_messages or []
+    started = time.monotonic()
     if format_type == "video":
         msg = await client.send_video(
-            chat_id=callback.message.chat.id,
+            chat_id=chat_id,
             video=file_path,
             caption=f"🎬 **{title}**",
             parse_mode=ParseMode.MARKDOWN,
             supports_streaming=True,
             progress=progress_callback,
-            progress_args=(callback.message, "upload")
+            progress_args=(status_messages, "upload")
         )
-        # Сохраняем file_id для мгновенной повторной отправки
-        if tg_cache_key and msg.video:
-            telegram_file_cache[tg_cache_key] = msg.video.file_id
-            logger.info(f"Telegram file_id закэширован: {tg_cache_key}")
+        sent_file_id = msg.video.file_id if msg.video else None
     else:
         msg = await client.send_audio(
-            chat_id=callback.message.chat.id,
+            chat_id=chat_id,
             audio=file_path,
             caption=f"🎵 **{title}**",
             parse_mode=ParseMode.MARKDOWN,
             title=title,
             progress=progress_callback,
-            progress_args=(callback.message, "upload")
+            progress_args=(status_messages, "upload")
+        )
+        media = msg.audio or msg.document
+        sent_file_id = media.file_id if media else None
+
+    metrics.observe("stage_seconds", time.monotonic() - started, stage="upload")
+    metrics.inc("bytes_total", os.path.getsize(file_path), direction="upload")
+
+    # Сохраняем file_id для мгновенной повторной отправки
+    if tg_cache_key and sent_file_id:
+        await shared_call(telegram_file_cache.put, tg_cache_key, sent_file_id, title)
+        logger.info(f"Telegram file_id закэширован: {tg_cache_key}")
+    return sent_file_id
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ПАКЕТНАЯ ЗАГРУЗКА
+# ═══════════════════════════════════════════════════════════════
+
+# Сколько видео берётся из плейлиста/канала/сообщения и сколько
+# из них одного пакета скачиваются одновременно
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "25"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "2"))
+# Сколько видео пакета ждёт токена лимита, прежде чем получить отказ, секунд
+BATCH_ADMIT_WAIT = float(os.environ.get("BATCH_ADMIT_WAIT", "600"))
+
+# Максимум файлов в одном альбоме Telegram
+MEDIA_GROUP_SIZE = 10
+
+
+async def handle_batch(client: Client, message: Message, links: list):
+    """Несколько ссылок, плейлист или канал: один список и одна клавиатура на всё"""
+    global info_pending
+    status_msg = await message.reply_text("🔍 Собираю список видео...")
+    loop = asyncio.get_event_loop()
+
+    try:
+        title = None
+        items = []
+        seen = set()
+        truncated = False
+        for link in links:
+            collection = collection_url(link)
+            if collection:
+                info_pending += 1
+                try:
+                    title, entries = await asyncio.wait_for(
+                        loop.run_in_executor(info_executor, timed_executor_call("info", get_playlist_entries),
+                                             collection, BATCH_MAX_ITEMS),
+                        timeout=60.0
+                    )
+                finally:
+                    info_pending -= 1
+            else:
+                video_id = extract_video_id(link)
+                entries = [(video_id, "")] if video_id else []
+
+            for video_id, entry_title in entries:
+                if video_id in seen:
+                    continue
+                if len(items) >= BATCH_MAX_ITEMS:
+                    truncated = True
+                    break
+                seen.add(video_id)
+                items.append((video_id, canonical_url(video_id), entry_title))
+
+        if not items:
+            await status_msg.edit_text("❌ Не нашёл в сообщении ни одного видео.")
+            return
+
+        if len(links) > 1 or not title:
+            title = "Несколько видео"
+        batch_sessions.put(message.from_user.id, BatchSession(title, items))
+
+        limit_note = f" (первые {BATCH_MAX_ITEMS})" if truncated else ""
+        await status_msg.edit_text(
+            f"📚 **{title}**\n\n"
+            f"🎞 Видео: {len(items)}{limit_note}\n\n"
+            "**Выбери качество для всех:**",
+            reply_markup=build_quality_keyboard({}, prefix="batch_"),
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+    except asyncio.TimeoutError:
+        logger.error("Таймаут при получении списка видео")
+        await status_msg.edit_text("❌ **Ошибка:** превышено время ожидания. Попробуй позже.",
+                                   parse_mode=ParseMode.MARKDOWN)
+    except Exception as e:
+        logger.error(f"Ошибка получения списка видео: {e}")
+        await status_msg.edit_text(
+            f"❌ **Ошибка:** не удалось получить список видео.\n\n"
+            f"`{str(e)[:200]}`",
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+
+class BatchProgress:
+    """Одно сводное статусное сообщение на весь пакет"""
+
+    def __init__(self, message, title: str, label: str, total: int):
+        self.message = message
+        self.title = title
+        self.label = label
+        self.total = total
+        self.sent = 0
+        self.cached = 0
+        self.failures = []      # (title, причина)
+        self.current = []       # названия видео, которые сейчас готовятся
+
+    @property
+    def finished(self) -> int:
+        return self.sent + len(self.failures)
+
+    def _text(self, final: bool = False) -> str:
+        percent = self.finished * 100 / self.total if self.total else 100
+        filled = int(percent / 5)
+        bar = "█" * filled + "░" * (20 - filled)
+        head = "✅ **Готово**" if final else "⏳ **Пакетная загрузка**"
+        lines = [
+            f"{head}: {self.title} ({self.label})",
+            "",
+            f"[{bar}] {self.finished}/{self.total}",
+            f"📤 Отправлено: {self.sent} (⚡ из кэша: {self.cached})",
+        ]
+        if self.failures:
+            lines.append(f"❌ Ошибок: {len(self.failures)}")
+        if final:
+            lines += [f"• {t[:40]}: {reason[:80]}" for t, reason in self.failures[:5]]
+        elif self.current:
+            lines.append("🔄 Сейчас: " + ", ".join(t[:30] for t in self.current))
+        return "\n".join(lines)
+
+    def update(self):
+        _edit_all([self.message], self._text())
+
+    def start(self, title: str):
+        self.current.append(title)
+        self.update()
+
+    def done(self, title: str, cached: bool = False):
+        self.sent += 1
+        self.cached += cached
+        if title in self.current:
+            self.current.remove(title)
+        self.update()
+
+    def fail(self, title: str, reason: str):
+        self.failures.append((title, reason.replace("❌", "").strip().split("\n")[0]))
+        if title in self.current:
+            self.current.remove(title)
+        self.update()
+
+    async def close(self):
+        edit_dispatcher.forget(self.message)
+        await _safe_edit(self.message, self._text(final=True))
+
+
+async def handle_batch_callback(client: Client, callback: CallbackQuery, action: str):
+    """Выбор качества для пакета: кэш-хиты — сразу альбомами, остальное — через очередь"""
+    user_id = callback.from_user.id
+    chat_id = callback.message.chat.id
+    batch = batch_sessions.get(user_id)
+    if batch is None:
+        await callback.message.edit_text("❌ Список не найден. Отправь ссылки заново.")
+        return
+
+    if action.startswith("video_"):
+        format_type, quality = "video", action.replace("video_", "")
+        label = QUALITY_LABELS.get(quality, quality)
+    else:
+        format_type, quality = "audio", parse_audio_action(action) or ""
+        label = AUDIO_FORMATS[quality][1]
+
+    # Одним заходом в пул: с Redis это по запросу на видео
+    keys = [(item[0], format_type, quality) for item in batch.items]
+    file_ids = await shared_call(lambda: [telegram_file_cache.get(key) for key in keys])
+    hits, misses = [], []
+    for item, file_id in zip(batch.items, file_ids):
+        (hits if file_id else misses).append((item, file_id))
+    misses = [item for item, _ in misses]
+
+    # Новые загрузки пакета: каждое видео — токен скачивания и (без info в кэше)
+    # токен ссылки. Видео ждут токенов не дольше BATCH_ADMIT_WAIT; если лимит
+    # за это время весь пакет не пропустит — отказ целиком, список и клавиатура
+    # остаются, чтобы можно было выбрать качество позже
+    rejection = SHED_TEXT if misses and should_shed(False) else None
+    if misses and not rejection:
+        links = sum(1 for item in misses if not info_cache.contains(item[0]))
+        allowed = download_limiter.budget(user_id, BATCH_ADMIT_WAIT)
+        if links:
+            allowed = min(allowed, link_limiter.budget(user_id, BATCH_ADMIT_WAIT) + len(misses) - links)
+        if allowed < len(misses):
+            rejection = (
+                "⏳ Слишком много новых загрузок для лимита.\n\n"
+                f"Сейчас в пакете можно скачать не больше {int(allowed)} из {len(misses)} — "
+                "попробуй позже."
+            )
+    if rejection:
+        try:
+            await callback.message.edit_text(rejection, reply_markup=callback.message.reply_markup,
+                                             parse_mode=ParseMode.MARKDOWN)
+        except MessageNotModified:
+            pass
+        return
+    # Повторное нажатие, пока шла проверка, — пакет уже выполняется
+    if batch_sessions.pop(user_id) is None:
+        return
+
+    progress = BatchProgress(callback.message, batch.title, label, len(batch.items))
+    progress.update()
+
+    # 1) Уже загруженные в Telegram — сразу, альбомами
+    if hits:
+        misses += await _send_cached_group(client, chat_id, format_type, quality, hits, progress)
+
+    # 2) Остальные — через общую очередь, не больше BATCH_CONCURRENCY одновременно
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    await asyncio.gather(*(
+        _batch_item(client, chat_id, user_id, item, format_type, quality, slots, progress)
+        for item in misses
+    ))
+    await progress.close()
+
+
+async def _send_cached_group(client: Client, chat_id: int, format_type: str, quality: str,
+                             hits: list, progress: BatchProgress) -> list:
+    """Отправка file_id альбомами; возвращает элементы, которые не удалось отправить"""
+    failed = []
+    # Видео из нескольких частей в альбом не входят — они в конце и по одному
+    hits = sorted(hits, key=lambda hit: PART_SEPARATOR in hit[1])
+    for i in range(0, len(hits), MEDIA_GROUP_SIZE):
+        chunk = hits[i:i + MEDIA_GROUP_SIZE]
+        if len(chunk) > 1 and not any(PART_SEPARATOR in file_id for _, file_id in chunk):
+            if format_type == "video":
+                media = [InputMediaVideo(file_id, caption=f"🎬 **{item[2] or item[0]}**",
+                                         parse_mode=ParseMode.MARKDOWN, supports_streaming=True)
+                         for item, file_id in chunk]
+            else:
+                media = [InputMediaAudio(file_id, caption=f"🎵 **{item[2] or item[0]}**",
+                                         parse_mode=ParseMode.MARKDOWN)
+                         for item, file_id in chunk]
+            try:
+                await client.send_media_group(chat_id, media)
+                for item, _ in chunk:
+                    metrics.inc("jobs_total", result="file_id")
+                    progress.done(item[2] or item[0], cached=True)
+                continue
+            except Exception as e:
+                logger.warning(f"Ошибка отправки альбома, отправляю по одному: {e}")
+
+        for item, file_id in chunk:
+            try:
+                await _send_cached(client, chat_id, file_id, format_type, item[2] or item[0])
+                metrics.inc("jobs_total", result="file_id")
+                progress.done(item[2] or item[0], cached=True)
+            except Exception as e:
+                logger.warning(f"Ошибка отправки по file_id: {e}")
+                await shared_call(telegram_file_cache.invalidate, (item[0], format_type, quality))
+                failed.append(item)
+    return failed
+
+
+async def _batch_item(client: Client, chat_id: int, user_id: int, item: tuple,
+                      format_type: str, quality: str, slots: asyncio.Semaphore,
+                      progress: BatchProgress):
+    """Одно видео пакета: метаданные, проверка размера, скачивание и отправка"""
+    global info_pending
+    source, url, title = item
+    title = title or source
+    async with slots:
+        # Токены — в порядке очереди пакета: нет токена — ждать пополнения
+        rejection = await download_limiter.acquire(user_id, BATCH_ADMIT_WAIT)
+        if not rejection and not info_cache.contains(source):
+            rejection = await link_limiter.acquire(user_id, BATCH_ADMIT_WAIT)
+        if rejection:
+            progress.fail(title, rejection.replace("*", ""))
+            return
+        progress.start(title)
+        try:
+            loop = asyncio.get_event_loop()
+            info_pending += 1
+            try:
+                info = await asyncio.wait_for(
+                    loop.run_in_executor(info_executor, timed_executor_call("info", get_video_info), url),
+                    timeout=60.0
+                )
+            finally:
+                info_pending -= 1
+            if info.get("title") and info["title"] != title:
+                progress.current.remove(title)
+                title = info["title"]
+                progress.current.append(title)
+            sizes = estimate_sizes(info)
+
+            item_quality = quality
+            if format_type == "video":
+                item_quality = fit_quality(sizes, quality)
+                if item_quality is None:
+                    raise JobError(f"❌ Слишком большое: ~{format_size(sizes[quality])}")
+            elif sizes.get(audio_size_key(quality), 0) > TELEGRAM_FILE_LIMIT:
+                raise JobError(f"❌ Слишком большое: ~{format_size(sizes[audio_size_key(quality)])}")
+
+            key = (source, format_type, item_quality)
+            cached_file_id = (await shared_call(telegram_file_cache.get, key)
+                              if item_quality != quality else None)
+            if cached_file_id:
+                await _send_cached(client, chat_id, cached_file_id, format_type, title)
+                metrics.inc("jobs_total", result="file_id")
+                progress.done(title, cached=True)
+                return
+
+            dl_text = f"Скачиваю {title}..."
+            await _obtain_file(client, chat_id, user_id, url, key, title, dl_text)
+            progress.done(title)
+        except JobError as e:
+            progress.fail(title, str(e))
+        except Exception as e:
+            logger.error(f"Ошибка в пакете ({source}): {e}")
+            progress.fail(title, str(e))
+
+
+async def _obtain_file(client: Client, chat_id: int, user_id: int, url: str,
+                       key: tuple, title: str, dl_text: str):
+    """Отправить файл в чат без своего статусного сообщения (пакетный режим)
+
+    Присоединяется к выполняющейся задаче того же ключа или выполняет свою.
+    """
+    format_type, quality = key[1], key[2]
+    job = inflight_jobs.get(key)
+    if job is not None:
+        file_id = await asyncio.shield(job.future)
+        if not file_id:
+            raise JobError("❌ Не удалось получить файл.")
+        await _send_cached(client, chat_id, file_id, format_type, title)
+        metrics.inc("jobs_total", result="joined")
+        return
+
+    job = InflightJob(key)
+    inflight_jobs[key] = job
+    try:
+        if BOT_ROLE == "frontend":
+            file_id = await _remote_job(job, None, chat_id, user_id, url,
+                                        format_type, quality, title, dl_text)
+        else:
+            file_id = await _run_job(client, job, chat_id, user_id, url,
+                                     format_type, quality, title, dl_text)
+        job.future.set_result(file_id)
+        metrics.inc("jobs_total", result="ok")
+    except Exception as e:
+        job.future.set_exception(e)
+        metrics.inc("jobs_total", result="rejected" if isinstance(e, JobError) else "error")
+        raise
+    finally:
+        inflight_jobs.pop(key, None)
+        job.release()
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ЗАДАЧИ НА УЗЛАХ-ВОРКЕРАХ
+# ═══════════════════════════════════════════════════════════════
+
+# Сколько задач воркер держит одновременно: скачивания ограничивает
+# download_scheduler, остальные в это время отправляются в Telegram
+WORKER_JOBS = int(os.environ.get("WORKER_JOBS", str(DOWNLOAD_WORKERS * 2)))
+
+# Задачи из общей очереди, выполняющиеся на этом воркере: ключ кэша -> InflightJob
+# (отдельно от inflight_jobs фронтенда, который ждёт результат от воркеров)
+worker_jobs = {}
+# ID задач общей очереди, за которые этот воркер отвечает (им нужны отметки жизни)
+shared_jobs_active = set()
+
+
+class RemoteMessage:
+    """Статусное сообщение фронтенда, которое воркер редактирует по chat_id и id"""
+
+    def __init__(self, client: Client, chat_id: int, message_id: int):
+        self._client = client
+        self.chat = SimpleNamespace(id=chat_id)
+        self.id = message_id
+
+    async def edit_text(self, text: str, **kwargs):
+        return await self._client.edit_message_text(self.chat.id, self.id, text, **kwargs)
+
+    async def delete(self):
+        return await self._client.delete_messages(self.chat.id, self.id)
+
+
+class SharedResults:
+    """Фронтенд: ожидание результатов общей очереди
+
+    Один цикл опрашивает результаты всех ожидающих задач одним запросом
+    раз в SHARED_POLL_INTERVAL, а не каждая задача по отдельности.
+    """
+
+    def __init__(self):
+        self._futures = {}   # job_id -> future результата
+        self._task = None
+
+    async def wait(self, job_id: str, timeout: float) -> dict | None:
+        """Результат задачи или None, если не дождались за timeout секунд"""
+        future = asyncio.get_running_loop().create_future()
+        self._futures[job_id] = future
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._futures.pop(job_id, None)
+
+    async def _poll(self):
+        while self._futures:
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+            try:
+                ready = await shared_call(job_queue.results, list(self._futures))
+            except Exception as e:
+                logger.warning(f"Общая очередь недоступна: {e}")
+                continue
+            for job_id, result in ready.items():
+                future = self._futures.get(job_id)
+                if future is not None and not future.done():
+                    future.set_result(result)
+
+
+shared_results = SharedResults()
+
+
+async def _remote_job(job: InflightJob, message: Message | None, chat_id: int, user_id: int,
+                      url: str, format_type: str, quality: str, title: str,
+                      dl_text: str) -> str:
+    """Фронтенд: поставить задачу в общую очередь и дождаться file_id от воркера"""
+    if await shared_call(job_queue.depth) >= MAX_QUEUE:
+        raise QueueFull(
+            "❌ Сейчас слишком много загрузок.\n\n"
+            "Попробуй через несколько минут."
+        )
+
+    # Правим до постановки в очередь, чтобы не перетереть прогресс воркера
+    if message is not None:
+        await _safe_edit(
+            message,
+            f"🕐 **{dl_text}**\n\n"
+            "Задача в очереди, загрузка начнётся автоматически."
+        )
+    job_id = os.urandom(8).hex()
+    cache_source, _, _ = job.key
+    await shared_call(job_queue.push, job_id, {
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "message_id": message.id if message is not None else None,   # None — пакет, без статуса
+        "url": url,
+        "source": cache_source,
+        "format_type": format_type,
+        "quality": quality,
+        "title": title,
+        "dl_text": dl_text,
+    })
+    logger.info(f"Задача {job_id} поставлена в общую очередь: {job.key}")
+
+    result = await shared_results.wait(job_id, SHARED_JOB_TIMEOUT)
+    if result is None:
+        raise JobError("❌ Загрузка не завершилась вовремя. Попробуй ещё раз.")
+    if result.get("file_id"):
+        return result["file_id"]
+    if result.get("user_error"):
+        raise JobError(result["error"])
+    raise RuntimeError(result.get("error") or "воркер не вернул file_id")
+
+
+async def _execute_shared_job(client: Client, job_id: str, payload: dict):
+    """Воркер: выполнить задачу из общей очереди и опубликовать результат"""
+    chat_id = payload["chat_id"]
+    key = (payload["source"], payload["format_type"], payload["quality"])
+    messages = [RemoteMessage(client, chat_id, payload["message_id"])] if payload["message_id"] else []
+    logger.info(f"Воркер {WORKER_ID}: задача {job_id} {key}")
+    # Задача уже забрана из общей очереди — после перезапуска её возобновит журнал
+    journal_id = job_journal.add(key, {**payload, "shared_job_id": job_id})
+    shared_jobs_active.add(job_id)
+
+    try:
+        # Пока задача ждала в очереди, файл мог отправить другой узел
+        cached_file_id = await shared_call(telegram_file_cache.get, key)
+        running = worker_jobs.get(key)
+        if cached_file_id:
+            file_id = cached_file_id
+            await _send_cached(client, chat_id, file_id, payload["format_type"], payload["title"])
+        elif running is not None:
+            running.messages.extend(messages)
+            file_id = await asyncio.shield(running.future)
+            if not file_id:
+                raise JobError("❌ Не удалось получить файл.")
+            await _send_cached(client, chat_id, file_id, payload["format_type"], payload["title"])
+        else:
+            job = InflightJob(key)
+            job.messages.extend(messages)
+            job.journal_id = journal_id
+            worker_jobs[key] = job
+            try:
+                try:
+                    file_id = await _run_job(client, job, chat_id, payload["user_id"], payload["url"],
+                                             payload["format_type"], payload["quality"],
+                                             payload["title"], payload["dl_text"])
+                finally:
+                    for status in job.messages:
+                        edit_dispatcher.forget(status)
+                job.future.set_result(file_id)
+            except Exception as e:
+                job.future.set_exception(e)
+                raise
+            finally:
+                worker_jobs.pop(key, None)
+                job.release()
+        result = {"file_id": file_id}
+        metrics.inc("jobs_total", result="ok")
+    except JobError as e:
+        result = {"error": str(e), "user_error": True}
+        metrics.inc("jobs_total", result="rejected")
+    except Exception as e:
+        logger.error(f"Воркер {WORKER_ID}: ошибка задачи {job_id}: {e}")
+        result = {"error": str(e)}
+        metrics.inc("jobs_total", result="error")
+
+    job_journal.remove(journal_id)
+    try:
+        await shared_call(job_queue.finish, job_id, result)
+    finally:
+        shared_jobs_active.discard(job_id)
+
+
+async def shared_heartbeat():
+    """Воркер: отметки жизни выполняющихся задач, чтобы очередь не выдала их другому"""
+    while True:
+        await asyncio.sleep(SHARED_HEARTBEAT_INTERVAL)
+        for job_id in list(shared_jobs_active):
+            try:
+                if not await shared_call(job_queue.touch, job_id, WORKER_ID):
+                    logger.warning(f"Воркер {WORKER_ID}: задача {job_id} уже возвращена в очередь")
+            except Exception as e:
+                logger.warning(f"Воркер {WORKER_ID}: общая очередь недоступна: {e}")
+
+
+async def worker_loop(client: Client):
+    """Воркер: забирать задачи из общей очереди, пока есть свободные слоты"""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(WORKER_JOBS)
+    claim_executor = ThreadPoolExecutor(max_workers=1)   # блокирующее ожидание задачи
+    logger.info(f"Воркер {WORKER_ID}: до {WORKER_JOBS} задач одновременно")
+
+    while True:
+        await slots.acquire()
+        try:
+            claimed = await loop.run_in_executor(claim_executor, job_queue.claim, WORKER_ID, 5)
+        except Exception as e:
+            slots.release()
+            logger.warning(f"Воркер {WORKER_ID}: общая очередь недоступна: {e}")
+            await asyncio.sleep(5)
+            continue
+        if claimed is None:
+            slots.release()
+            continue
+
+        job_id, payload = claimed
+        task = asyncio.create_task(_execute_shared_job(client, job_id, payload))
+        task.add_done_callback(lambda _: slots.release())
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ЖУРНАЛ ЗАДАЧ
+# ═══════════════════════════════════════════════════════════════
+
+# Задачи старше этого (секунды) после перезапуска не возобновляются
+JOURNAL_MAX_AGE = int(os.environ.get("JOURNAL_MAX_AGE", "86400"))
+
+
+class JobJournal:
+    """Журнал выполняющихся задач (SQLite) — переживает падение процесса
+
+    Каждый ожидающий файл запрос (ведущий или присоединившийся) — одна
+    запись со статусным сообщением; ведущий отмечает этап
+    (queued -> downloading -> merging -> uploading) и путь результата.
+    Запись удаляется, когда пользователь получил файл или ошибку; всё, что
+    осталось при старте, возобновляется (см. resume_journal).
+    """
+
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "  id TEXT PRIMARY KEY,"
+            "  source TEXT NOT NULL,"
+            "  format_type TEXT NOT NULL,"
+            "  quality TEXT NOT NULL,"
+            "  payload TEXT NOT NULL,"     # chat_id, user_id, message_id, url, title, dl_text
+            "  state TEXT NOT NULL,"       # waiting | queued | downloading | merging | uploading
+            "  output TEXT,"
+            "  created REAL NOT NULL"
+            ")"
         )
-        # Сохраняем file_id для мгновенной повторной отправки
-        if tg_cache_key and msg.audio:
-            telegram_file_cache[tg_cache_key] = msg.audio.file_id
-            logger.info(f"Telegram file_id закэширован: {tg_cache_key}")
+
+    def add(self, key: tuple, payload: dict) -> str:
+        job_id = os.urandom(8).hex()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO journal (id, source, format_type, quality, payload, state, created) "
+                "VALUES (?, ?, ?, ?, ?, 'waiting', ?)",
+                (job_id, *key, json.dumps(payload), time.time()),
+            )
+        return job_id
+
+    def set_state(self, job_id: str | None, state: str, output: str | None = None):
+        """Этап ведущей задачи (job_id None — задача без журнала)"""
+        if job_id is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "UPDATE journal SET state = ?, output = COALESCE(?, output) WHERE id = ?",
+                (state, output, job_id),
+            )
+
+    def remove(self, job_id: str | None):
+        if job_id is None:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM journal WHERE id = ?", (job_id,))
+
+    def pending(self) -> list:
+        """Незавершённые записи: сначала ведущие, затем по времени"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, source, format_type, quality, payload, state, output, created FROM journal "
+                "ORDER BY state = 'waiting', created"
+            ).fetchall()
+        return [
+            {
+                "id": row[0],
+                "key": (row[1], row[2], row[3]),
+                "payload": json.loads(row[4]),
+                "state": row[5],
+                "output": row[6],
+                "created": row[7],
+            }
+            for row in rows
+        ]
+
+
+# Журнал задач этого узла (DOWNLOAD_PATH у каждого узла свой)
+job_journal = JobJournal(os.path.join(STATE_PATH, "jobs.db"))
+
+
+def journal_protected_paths() -> tuple:
+    """(пути результатов, video_id) прерванных задач — их файлы не удаляются при старте"""
+    entries = job_journal.pending()
+    outputs = {entry["output"] for entry in entries if entry["output"]}
+    sources = {split_source(entry["key"][0])[0] for entry in entries}
+    return outputs, sources
+
+
+async def resume_journal(client: Client):
+    """Возобновить задачи, прерванные перезапуском"""
+    entries = job_journal.pending()
+    if entries:
+        logger.info(f"Журнал: возобновляю {len(entries)} прерванных задач")
+    for entry in entries:
+        asyncio.create_task(_resume_job(client, entry))
+
+
+async def _resume_job(client: Client, entry: dict):
+    """Одна запись журнала: докачать с частичных файлов (или присоединиться) и отправить"""
+    payload = entry["payload"]
+    key = entry["key"]
+    format_type, title = key[1], payload["title"]
+    chat_id = payload["chat_id"]
+    shared_job_id = payload.get("shared_job_id")
+    status = RemoteMessage(client, chat_id, payload["message_id"]) if payload.get("message_id") else None
+    messages = [status] if status else []
+    registry = worker_jobs if shared_job_id else inflight_jobs
+
+    if shared_job_id and job_queue is not None:
+        # Пока воркер лежал, задачу могли вернуть в очередь и выдать другому
+        try:
+            owned = await shared_call(job_queue.touch, shared_job_id, WORKER_ID)
+        except Exception as e:
+            logger.warning(f"Журнал: общая очередь недоступна, возобновляю {entry['id']}: {e}")
+            owned = True
+        if not owned:
+            logger.info(f"Журнал: задача {entry['id']} уже выдана другому воркеру")
+            job_journal.remove(entry["id"])
+            return
+        shared_jobs_active.add(shared_job_id)
+
+    # Поиск и регистрация — без await между ними, иначе два лидера на один ключ
+    running = registry.get(key)
+    try:
+        if time.time() - entry["created"] > JOURNAL_MAX_AGE:
+            raise JobError("❌ Загрузка прервалась при перезапуске бота. Отправь ссылку ещё раз.")
+        if running is not None:
+            running.messages.extend(messages)
+            file_id = await asyncio.shield(running.future)
+            if not file_id:
+                raise JobError("❌ Не удалось получить файл.")
+            await _send_cached(client, chat_id, file_id, format_type, title)
+        else:
+            job = InflightJob(key)
+            job.messages.extend(messages)
+            job.journal_id = entry["id"]
+            registry[key] = job
+            output = entry["output"]
+            if entry["state"] == "uploading" and output and os.path.exists(output) \
+               and not disk_cache.contains_path(output):
+                # Файл был готов, но манифест файлового кэша не успел сохраниться
+                disk_cache.put(key, output)
+            try:
+                _edit_all(
+                    messages,
+                    f"🔄 **{payload['dl_text']}**\n\n"
+                    "Бот перезапускался — продолжаю с того места, где остановился."
+                )
+                try:
+                    file_id = await _run_job(client, job, chat_id, payload["user_id"], payload["url"],
+                                             format_type, key[2], title, payload["dl_text"])
+                finally:
+                    for message in job.messages:
+                        edit_dispatcher.forget(message)
+                job.future.set_result(file_id)
+            except Exception as e:
+                job.future.set_exception(e)
+                raise
+            finally:
+                registry.pop(key, None)
+                job.release()
+        logger.info(f"Журнал: задача {entry['id']} {key} завершена после перезапуска")
+        metrics.inc("jobs_total", result="ok")
+        result = {"file_id": file_id}
+        if status:
+            try:
+                await status.delete()
+            except Exception:
+                pass
+    except JobError as e:
+        metrics.inc("jobs_total", result="rejected")
+        result = {"error": str(e), "user_error": True}
+        if status:
+            await _safe_edit(status, str(e))
+    except Exception as e:
+        logger.error(f"Журнал: ошибка задачи {entry['id']}: {e}")
+        metrics.inc("jobs_total", result="error")
+        result = {"error": str(e)}
+        if status:
+            await _safe_edit(status, f"❌ **Ошибка при скачивании:**\n\n`{str(e)[:300]}`")
+
+    job_journal.remove(entry["id"])
+    if shared_job_id and job_queue is not None:
+        try:
+            await shared_call(job_queue.finish, shared_job_id, result)
+        finally:
+            shared_jobs_active.discard(shared_job_id)
 
 
 # ═══════════════════════════════════════════════════════════════
 #                           ЗАПУСК
 # ═══════════════════════════════════════════════════════════════
 
-if __name__ == "__main__":
-    # Очистка старых файлов при старте
+async def main():
+    """Запуск бота вместе с фоновыми задачами"""
+    if DOWNLOAD_MODE == "process" and BOT_ROLE != "frontend":
+        start_download_processes()
+
+    # Экземпляры yt-dlp прогреваются в фоне, пока бот подключается
+    asyncio.get_running_loop().run_in_executor(info_executor, ydl_pool.warm, YDL_POOL_WARM)
+
+    async with app:
+        background = [
+            asyncio.create_task(cache_janitor()),
+            asyncio.create_task(edit_dispatcher.run()),
+        ]
+        if BOT_ROLE != "frontend":
+            await resume_journal(app)
+        if BOT_ROLE == "worker":
+            background.append(asyncio.create_task(worker_loop(app)))
+            background.append(asyncio.create_task(shared_heartbeat()))
+        metrics_server = await start_metrics_server()
+        await idle()
+        for task in background:
+            task.cancel()
+        if metrics_server:
+            metrics_server.close()
+    ydl_pool.close()
+    disk_cache.save()
+
+
+def run():
+    """Запуск бота (точка входа — main.py)"""
+    if BOT_ROLE not in ("all", "frontend", "worker"):
+        sys.exit(f"Неизвестная роль BOT_ROLE={BOT_ROLE}: ожидается all, frontend или worker")
+    if BOT_ROLE != "all" and job_queue is None:
+        sys.exit(f"Для BOT_ROLE={BOT_ROLE} нужен SHARED_BACKEND (sqlite:///... или redis://...)")
+
+    # Восстановление кэша и очистка старых файлов при старте
     cleanup_downloads_on_start()
 
     print("=" * 50)
@@ -695,11 +4498,19 @@ if __name__ == "__main__":
     print("=" * 50)
     print(f"📁 Папка загрузок: {os.path.abspath(DOWNLOAD_PATH)}")
     print("✨ Pyrogram MTProto - файлы до 2 ГБ")
-    print("🚀 aria2c — 16 соединений параллельно")
+    print(f"🚀 aria2c — до {SPLIT_MAX} соединений на поток, всего до {MAX_DOWNLOAD_CONNECTIONS}")
     print("📊 Прогресс-бар скачивания")
-    print("💾 Кэш файлов (10 мин) + Telegram file_id кэш")
+    print(f"⚙️ ffmpeg: до {TRANSCODE_WORKERS} задач по {TRANSCODE_THREADS} потока")
+    print(f"💾 Кэш файлов (до {format_size(CACHE_MAX_BYTES)}, LRU) + Telegram file_id кэш (SQLite)")
+    print(f"🗂 file_id в кэше: {len(telegram_file_cache)}")
+    if job_queue is not None:
+        print(f"🌐 Роль: {BOT_ROLE}, общее хранилище: {SHARED_BACKEND.split('://')[0]}")
     print("=" * 50)
     print("🚀 Бот запускается...")
     print()
 
-    app.run()
+    app.run(main())
+
+
+if __name__ == "__main__":
+    run()
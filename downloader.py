@@ -0,0 +1,655 @@
+"""Сетевая часть скачивания: yt-dlp, кэш элементарных потоков, бюджет соединений
+
+Модуль не создаёт клиент Telegram и не открывает хранилища — его
+импортируют процессы-воркеры DOWNLOAD_MODE=process (см. main.py).
+"""
+
+import os
+import copy
+import time
+import fcntl
+import logging
+import subprocess
+import threading
+from contextlib import contextmanager
+import yt_dlp
+
+# ═══════════════════════════════════════════════════════════════
+#                         НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════
+
+# Папка для временных файлов (у каждого узла-воркера — своя)
+DOWNLOAD_PATH = os.environ.get("DOWNLOAD_PATH", "./downloads")
+os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+
+# Кэш элементарных потоков (видео/аудиодорожки по format_id)
+STREAMS_PATH = os.path.join(DOWNLOAD_PATH, "streams")
+os.makedirs(STREAMS_PATH, exist_ok=True)
+
+# Кэш yt-dlp (расшифровка подписей из player JS) — на томе загрузок, переживает рестарты
+YDL_CACHE_DIR = os.environ.get("YDL_CACHE_DIR", os.path.join(DOWNLOAD_PATH, "yt-dlp-cache"))
+
+# Одновременных скачиваний и извлечений метаданных (см. JobScheduler в bot.py)
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "3"))
+INFO_WORKERS = int(os.environ.get("INFO_WORKERS", "4"))
+
+# Потоков на один ffmpeg (число одновременных ffmpeg — TRANSCODE_WORKERS в bot.py)
+TRANSCODE_THREADS = int(os.environ.get("TRANSCODE_THREADS", "2"))
+
+# ═══════════════════════════════════════════════════════════════
+#                         ЛОГИРОВАНИЕ
+# ═══════════════════════════════════════════════════════════════
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logger = logging.getLogger(__name__)
+
+# ═══════════════════════════════════════════════════════════════
+#                      ФОРМАТЫ
+# ═══════════════════════════════════════════════════════════════
+
+FORMAT_MAP = {
+    "360":  "bestvideo[height<=360][ext=mp4]+bestaudio[ext=m4a]/best[height<=360]/best",
+    "720":  "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]/best",
+    "1080": "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080]/best",
+    "best": "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
+}
+
+# Битрейт MP3 при извлечении аудио (кбит/с)
+MP3_BITRATE = 192
+
+# Битрейт Opus, если у ролика нет Opus-дорожки и её приходится кодировать (кбит/с)
+OPUS_BITRATE = 128
+
+# Битрейт AAC, если для M4A нашлась только не-AAC дорожка (Opus из webm) (кбит/с)
+AAC_BITRATE = 160
+
+# Формат исходного аудио для MP3
+AUDIO_SOURCE_FORMAT = "bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best"
+
+# Исходная дорожка для перепаковки без перекодирования
+AUDIO_SOURCE_FORMATS = {
+    "m4a": "bestaudio[ext=m4a]/bestaudio",
+    "opus": "bestaudio[acodec=opus]/bestaudio",
+}
+
+
+def format_size_estimate(fmt: dict, duration: float) -> int:
+    """Размер формата: точный, приблизительный или по битрейту × длительность"""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    tbr = fmt.get("tbr")
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return 0
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ПОЛОСА И СОЕДИНЕНИЯ СКАЧИВАНИЯ
+# ═══════════════════════════════════════════════════════════════
+
+# Общий бюджет на все одновременные скачивания: соединения к googlevideo
+# и полоса (Мбит/с, 0 — без ограничения), чтобы не упираться в троттлинг
+# YouTube и оставлять канал для загрузки в Telegram
+MAX_DOWNLOAD_CONNECTIONS = int(os.environ.get("MAX_DOWNLOAD_CONNECTIONS", "24"))
+MAX_DOWNLOAD_MBPS = float(os.environ.get("MAX_DOWNLOAD_MBPS", "0"))
+
+# Соединений aria2c на поток по размеру: (до скольких байт, соединений)
+SPLIT_BY_SIZE = (
+    (20 * 1024 * 1024, 2),      # аудио, короткие 360p
+    (100 * 1024 * 1024, 4),
+    (500 * 1024 * 1024, 8),
+)
+SPLIT_MAX = 16
+
+# Сглаживание оценки скорости одного соединения
+SPEED_EWMA_ALPHA = 0.3
+
+
+class DownloadLease:
+    """Доля бюджета, выданная одному скачиваемому потоку"""
+
+    __slots__ = ("connections", "started", "base_bytes", "speed")
+
+    def __init__(self, connections: int):
+        self.connections = connections
+        self.started = time.monotonic()
+        self.base_bytes = None     # downloaded_bytes в первом событии (докачка)
+        self.speed = 0.0           # последняя измеренная скорость, байт/с
+
+
+class DownloadGovernor:
+    """Распределение соединений и полосы между одновременными скачиваниями
+
+    - число соединений на поток зависит от размера: маленькому аудио
+      хватает пары соединений, большому видео — до SPLIT_MAX;
+    - если задан лимит полосы, соединений берётся столько, сколько нужно
+      для доли полосы при измеренной скорости одного соединения;
+    - сумма соединений всех потоков не превышает max_connections;
+    - полоса делится поровну между активными потоками: aria2c получает
+      --max-download-limit при старте, встроенный загрузчик yt-dlp
+      притормаживается в progress hook по текущей доле.
+    """
+
+    def __init__(self, max_connections: int, max_bytes_per_sec: float):
+        self.max_connections = max_connections
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.connection_speed = None    # байт/с на одно соединение (EWMA)
+        self._active = []
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    @property
+    def connections(self) -> int:
+        with self._lock:
+            return sum(lease.connections for lease in self._active)
+
+    @property
+    def speed(self) -> float:
+        with self._lock:
+            return sum(lease.speed for lease in self._active)
+
+    def share(self) -> float | None:
+        """Текущая доля полосы одного потока (байт/с) или None без лимита"""
+        if not self.max_bytes_per_sec:
+            return None
+        with self._lock:
+            return self.max_bytes_per_sec / max(1, len(self._active))
+
+    def lease(self, size: int, aria2c: bool = True, inputs: int = 1) -> DownloadLease:
+        """Выдать соединения потоку ожидаемого размера size
+
+        Если бюджет соединений исчерпан, ждёт освобождения (блокирует поток
+        скачивания). Встроенный загрузчик yt-dlp (aria2c=False) качает
+        в одно соединение, ffmpeg — в одно на каждый из inputs входов.
+        """
+        wanted = next((n for limit, n in SPLIT_BY_SIZE if size and size <= limit), SPLIT_MAX)
+        if not aria2c:
+            wanted = inputs
+        with self._released:
+            while self.max_connections - sum(lease.connections for lease in self._active) < 1:
+                self._released.wait()
+            if self.max_bytes_per_sec and self.connection_speed:
+                share = self.max_bytes_per_sec / (len(self._active) + 1)
+                needed = int(-(-share // self.connection_speed))   # округление вверх
+                wanted = min(wanted, max(1, needed))
+            free = self.max_connections - sum(lease.connections for lease in self._active)
+            lease = DownloadLease(min(wanted, free))
+            self._active.append(lease)
+            return lease
+
+    def release(self, lease: DownloadLease):
+        with self._released:
+            if lease in self._active:
+                self._active.remove(lease)
+                self._released.notify_all()
+
+    def aria2c_args(self, lease: DownloadLease) -> list:
+        args = [
+            "--min-split-size=1M",
+            f"--max-connection-per-server={lease.connections}",
+            f"--split={lease.connections}",
+        ]
+        share = self.share()
+        if share:
+            args.append(f"--max-download-limit={int(share)}")
+        return args
+
+    def observe(self, lease: DownloadLease, d: dict):
+        """Событие progress hook: замер скорости и притормаживание по доле полосы"""
+        status = d.get("status")
+        if status == "finished":
+            elapsed = d.get("elapsed") or (time.monotonic() - lease.started)
+            if d.get("total_bytes") and elapsed > 0:
+                self._update_speed(lease, d["total_bytes"] / elapsed)
+            return
+        if status != "downloading":
+            return
+
+        if d.get("speed"):
+            self._update_speed(lease, d["speed"])
+
+        share = self.share()
+        downloaded = d.get("downloaded_bytes") or 0
+        if lease.base_bytes is None:
+            lease.base_bytes = downloaded
+            lease.started = time.monotonic()
+        if share:
+            ahead = (downloaded - lease.base_bytes) / share - (time.monotonic() - lease.started)
+            if ahead > 0:
+                time.sleep(min(ahead, 5))
+
+    def _update_speed(self, lease: DownloadLease, speed: float):
+        lease.speed = speed
+        per_connection = speed / lease.connections
+        with self._lock:
+            if self.connection_speed is None:
+                self.connection_speed = per_connection
+            else:
+                self.connection_speed += SPEED_EWMA_ALPHA * (per_connection - self.connection_speed)
+
+
+# Бюджет скачиваний процесса (в DOWNLOAD_MODE=process делится между воркерами)
+download_governor = DownloadGovernor(MAX_DOWNLOAD_CONNECTIONS, MAX_DOWNLOAD_MBPS * 1024 * 1024 / 8)
+
+
+def get_ydl_opts():
+    """Базовые опции yt-dlp — ускорение + обход блокировок YouTube"""
+    return {
+        "quiet": True,
+        "no_warnings": True,
+        "noplaylist": True,
+        "socket_timeout": 60,
+        "retries": 10,
+        "fragment_retries": 10,
+        "file_access_retries": 5,
+        "extractor_retries": 5,
+        "http_chunk_size": 10485760,            # 10 MB
+        "external_downloader": "aria2c",
+        "external_downloader_args": {
+            # Для потоков число соединений и лимит задаёт download_governor
+            "aria2c": [
+                "--min-split-size=1M",
+                "--max-connection-per-server=16",
+                "--split=16",
+            ]
+        },
+        "throttledratelimit": 100000,           # переподключение при <100 KB/s
+        "continuedl": True,                     # докачка .part после перезапуска
+        "cachedir": YDL_CACHE_DIR,
+        "extractor_args": {
+            "youtube": {
+                "player_client": ["android", "web"],
+            }
+        },
+    }
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ПУЛ ЭКЗЕМПЛЯРОВ YT-DLP
+# ═══════════════════════════════════════════════════════════════
+
+# Сколько готовых экземпляров YoutubeDL держать (лишние закрываются)
+# и сколько прогреть при старте
+YDL_POOL_SIZE = int(os.environ.get("YDL_POOL_SIZE", str(INFO_WORKERS + DOWNLOAD_WORKERS)))
+YDL_POOL_WARM = int(os.environ.get("YDL_POOL_WARM", "2"))
+
+
+class YdlPool:
+    """Переиспользуемые экземпляры yt_dlp.YoutubeDL
+
+    Создание YoutubeDL инициализирует экстракторы и HTTP-сессии, а
+    экстрактор YouTube держит в памяти разобранный player JS — при
+    переиспользовании всё это не повторяется, соединения остаются
+    открытыми. Экземпляр не потокобезопасен, поэтому выдаётся одному
+    потоку; опции задачи (format, outtmpl, хуки) накладываются на время
+    использования и снимаются при возврате.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.created = 0
+        self.reused = 0
+
+    def _take(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Процесс-воркер унаследовал пул родителя — сокеты не делим
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.created += 1
+        return yt_dlp.YoutubeDL(get_ydl_opts())
+
+    def _put(self, ydl):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(ydl)
+                return
+        ydl.close()
+
+    @contextmanager
+    def acquire(self, overlay: dict | None = None, progress_hooks: list | None = None):
+        """Экземпляр с наложенными опциями; при ошибке он закрывается, а не возвращается"""
+        ydl = self._take()
+        overlay = dict(overlay or {})
+        if isinstance(overlay.get("outtmpl"), str):
+            overlay["outtmpl"] = {**ydl.params["outtmpl"], "default": overlay["outtmpl"]}
+        saved = {key: ydl.params[key] for key in overlay if key in ydl.params}
+        saved_selector = ydl.format_selector
+        ydl.params.update(overlay)
+        if "format" in overlay:
+            # Селектор компилируется в конструкторе — пересобираем под задачу
+            ydl.format_selector = ydl.build_format_selector(overlay["format"])
+        ydl._progress_hooks = list(progress_hooks or [])
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+        for key in overlay:
+            ydl.params.pop(key, None)
+        ydl.params.update(saved)
+        ydl.format_selector = saved_selector
+        ydl._progress_hooks = []
+        self._put(ydl)
+
+    def warm(self, count: int):
+        """Создать count экземпляров с уже инициализированным экстрактором YouTube"""
+        instances = [self._take() for _ in range(count)]
+        for ydl in instances:
+            ydl.get_info_extractor("Youtube")
+            self._put(ydl)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for ydl in idle:
+            ydl.close()
+
+
+ydl_pool = YdlPool(YDL_POOL_SIZE)
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      КЭШ ПОТОКОВ
+# ═══════════════════════════════════════════════════════════════
+
+def stream_path(video_id: str, fmt: dict) -> str:
+    """Путь к закэшированному элементарному потоку (video_id + format_id)"""
+    return os.path.join(STREAMS_PATH, f"{video_id}.{fmt['format_id']}.{fmt['ext']}")
+
+
+def format_spec(format_type: str, quality: str) -> str:
+    """Селектор форматов yt-dlp для выбора пользователя"""
+    if format_type == "video":
+        return FORMAT_MAP.get(quality, FORMAT_MAP["best"])
+    return AUDIO_SOURCE_FORMATS.get(quality, AUDIO_SOURCE_FORMAT)
+
+
+def drop_format_selection(info: dict) -> dict:
+    """Убрать из info выбор форматов, сделанный при извлечении (requested_*)
+
+    process_ie_result переносит requested_formats в результат одиночного
+    формата — без этого повторная обработка info скачала бы старую пару
+    bestvideo+bestaudio вместо выбранного формата.
+    """
+    for key in [key for key in info if key.startswith("requested_")]:
+        del info[key]
+    return info
+
+
+def select_formats(info: dict, spec: str) -> list:
+    """Форматы, которые yt-dlp выбрал бы для spec (без скачивания)"""
+    info = drop_format_selection(copy.deepcopy(info))
+    with ydl_pool.acquire({"format": spec}) as ydl:
+        resolved = ydl.process_ie_result(info, download=False)
+    return resolved.get("requested_formats") or [resolved]
+
+
+STREAM_LOCK_SUFFIX = ".lock"
+
+
+@contextmanager
+def stream_lock(path: str):
+    """Эксклюзивная блокировка потока на время скачивания (между потоками и процессами)
+
+    flock снимается ядром и при гибели процесса, поэтому оставшийся
+    .lock-файл ничего не блокирует (лишние удаляются очисткой при старте).
+    """
+    with open(path + STREAM_LOCK_SUFFIX, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def download_stream(info: dict, fmt: dict, progress_hook=None, native: bool = False) -> str:
+    """Скачивание одного элементарного потока в кэш потоков (или взять готовый)
+
+    Один поток качает одна задача: остальные ждут блокировку и берут
+    готовый файл (например, общую аудиодорожку для 720p и 1080p).
+    native — встроенный загрузчик yt-dlp вместо aria2c: он вызывает
+    progress_hook на каждом блоке, поэтому исключение из хука сразу
+    останавливает скачивание (aria2c сообщает только о завершении).
+    """
+    path = stream_path(info["id"], fmt)
+    if os.path.exists(path):
+        logger.info(f"Кэш потоков: хит {os.path.basename(path)}")
+        return path
+
+    with stream_lock(path):
+        if os.path.exists(path):
+            logger.info(f"Кэш потоков: хит после ожидания {os.path.basename(path)}")
+            return path
+        _download_stream(info, fmt, path, progress_hook, native)
+    return path
+
+
+def _download_stream(info: dict, fmt: dict, path: str, progress_hook=None, native: bool = False):
+    aria2c = not native and "external_downloader" in get_ydl_opts()
+    lease = download_governor.lease(format_size_estimate(fmt, info.get("duration") or 0), aria2c)
+
+    def hook(d):
+        download_governor.observe(lease, d)
+        if progress_hook:
+            progress_hook(d)
+
+    overlay = {"format": fmt["format_id"], "outtmpl": path}
+    if aria2c:
+        overlay["external_downloader_args"] = {"aria2c": download_governor.aria2c_args(lease)}
+    elif native:
+        overlay["external_downloader"] = "native"
+
+    # process_ie_result меняет info — работаем с копией, без выбора форматов
+    # извлечения (иначе скачается он, а не fmt)
+    try:
+        with ydl_pool.acquire(overlay, [hook]) as ydl:
+            ydl.process_ie_result(drop_format_selection(copy.deepcopy(info)), download=True)
+    finally:
+        download_governor.release(lease)
+
+
+def fetch_streams(url: str, format_type: str, quality: str = "best", progress_hook=None,
+                  info: dict | None = None, local_source: str | None = None) -> tuple:
+    """Сетевая часть: элементарные потоки в кэше потоков (синхронная)
+
+    Видео и аудио качаются как отдельные элементарные потоки
+    (video_id + format_id), поэтому аудиодорожка, скачанная для 720p,
+    переиспользуется для 1080p и для аудио. Если передан info из
+    get_video_info, повторное извлечение не делается. local_source — уже
+    скачанный MP4 этого видео, из которого можно получить аудио без
+    обращения к YouTube. Возвращает (пути потоков, форматы, refreshed);
+    refreshed — переданный info устарел и извлечён заново (вызывающий
+    сбрасывает его в кэше метаданных: в процессе-воркере кэша нет).
+    """
+    if info is None:
+        with ydl_pool.acquire() as ydl:
+            info = ydl.extract_info(url, download=False)
+
+    spec = format_spec(format_type, quality)
+
+    try:
+        formats = select_formats(info, spec)
+        if format_type == "audio" and local_source and os.path.exists(local_source) \
+           and not os.path.exists(stream_path(info["id"], formats[0])):
+            logger.info(f"Аудио из локального файла: {local_source}")
+            return [local_source], [{"acodec": "mp4a", "vcodec": "none"}], False
+        streams = [download_stream(info, fmt, progress_hook) for fmt in formats]
+    except yt_dlp.utils.DownloadError as e:
+        # Ссылки на потоки могли протухнуть — извлекаем заново
+        logger.warning(f"Скачивание по сохранённому info не удалось, повторяю: {e}")
+        with ydl_pool.acquire() as ydl:
+            info = ydl.extract_info(url, download=False)
+        formats = select_formats(info, spec)
+        streams = [download_stream(info, fmt, progress_hook) for fmt in formats]
+        return streams, formats, True
+    return streams, formats, False
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      FFMPEG ПО СЕТИ (ПОТОК, ФРАГМЕНТ)
+# ═══════════════════════════════════════════════════════════════
+
+FFMPEG_POLL_INTERVAL = 0.5
+
+
+def run_ffmpeg(args: list, stop_path: str | None = None):
+    """Запуск ffmpeg (синхронный); при ошибке — RuntimeError с хвостом stderr
+
+    stop_path — файл-флаг остановки: как только он появился, ffmpeg
+    завершается (флаг виден и из процесса-воркера DOWNLOAD_MODE=process).
+    При любом выходе процесс ffmpeg завершается и дожидается.
+    """
+    if stop_path and os.path.exists(stop_path):
+        raise yt_dlp.utils.DownloadCancelled("ffmpeg остановлен до запуска")
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args]
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    try:
+        while True:
+            try:
+                _, stderr = proc.communicate(timeout=FFMPEG_POLL_INTERVAL if stop_path else None)
+                break
+            except subprocess.TimeoutExpired:
+                if os.path.exists(stop_path):
+                    raise yt_dlp.utils.DownloadCancelled("ffmpeg остановлен")
+    finally:
+        if proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg: {stderr.strip()[-300:]}")
+
+
+def _run_ffmpeg_leased(formats: list, duration: float, args: list, stop_path: str | None = None):
+    """run_ffmpeg, читающий formats по сети, — с арендой соединений у губернатора
+
+    Полосу ffmpeg не ограничивает, но как активный поток уменьшает долю
+    остальных скачиваний при MAX_DOWNLOAD_MBPS.
+    """
+    size = sum(format_size_estimate(fmt, duration) for fmt in formats)
+    lease = download_governor.lease(size, aria2c=False, inputs=len(formats))
+    try:
+        run_ffmpeg(args, stop_path=stop_path)
+    finally:
+        download_governor.release(lease)
+
+
+def audio_codec_args(quality: str, acodec: str) -> list:
+    """Аргументы ffmpeg для аудиоформата (quality) из дорожки с кодеком acodec"""
+    if quality == "m4a" and acodec.startswith(("mp4a", "aac")):
+        # Перепаковка без перекодирования
+        return ["-c:a", "copy", "-movflags", "+faststart"]
+    if quality == "m4a":
+        # m4a-дорожки нет (выбран webm/Opus) — копия в .m4a не проигрывается, кодируем AAC
+        return ["-c:a", "aac", "-b:a", f"{AAC_BITRATE}k", "-movflags", "+faststart"]
+    if quality == "opus" and acodec.startswith("opus"):
+        return ["-c:a", "copy", "-f", "ogg"]
+    if quality == "opus":
+        # Opus-дорожки нет — единственный случай, когда Opus кодируется
+        return ["-c:a", "libopus", "-b:a", f"{OPUS_BITRATE}k", "-f", "ogg"]
+    return ["-c:a", "libmp3lame", "-b:a", f"{MP3_BITRATE}k"]
+
+
+STREAM_STOP_SUFFIX = ".stop"              # флаг остановки ffmpeg (см. run_ffmpeg)
+
+
+def stream_media(info: dict, quality: str, output_path: str) -> str:
+    """Скачивание и склейка в фрагментированный MP4 одним проходом ffmpeg (синхронная)
+
+    Файл только дописывается (moov в начале, фрагменты по ключевым кадрам),
+    поэтому его можно отправлять частями, пока ffmpeg ещё работает.
+    """
+    formats = select_formats(info, FORMAT_MAP.get(quality, FORMAT_MAP["best"]))
+
+    args = []
+    for fmt in formats:
+        headers = "".join(f"{k}: {v}\r\n" for k, v in (fmt.get("http_headers") or {}).items())
+        if headers:
+            args += ["-headers", headers]
+        args += ["-i", fmt["url"]]
+    if len(formats) == 2:
+        args += ["-map", "0:v:0", "-map", "1:a:0"]
+    args += [
+        "-c", "copy",
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+        "-f", "mp4", output_path,
+    ]
+    _run_ffmpeg_leased(formats, info.get("duration") or 0, args,
+                       stop_path=output_path + STREAM_STOP_SUFFIX)
+    return output_path
+
+
+def download_clip(url: str, info: dict | None, clip: tuple, output_path: str,
+                  format_type: str, quality: str) -> str:
+    """Фрагмент одним проходом ffmpeg (синхронная)
+
+    -ss перед -i — поиск по индексу контейнера: ffmpeg запрашивает по HTTP
+    Range только нужный участок DASH-потока, а не всё видео. Потоки
+    копируются, поэтому начало попадает на ближайший ключевой кадр до start.
+    """
+    if info is None:
+        with ydl_pool.acquire() as ydl:
+            info = ydl.extract_info(url, download=False)
+
+    start, end = clip
+    formats = select_formats(info, format_spec(format_type, quality))
+    args = []
+    for fmt in formats:
+        headers = "".join(f"{k}: {v}\r\n" for k, v in (fmt.get("http_headers") or {}).items())
+        if headers:
+            args += ["-headers", headers]
+        args += ["-ss", str(start), "-t", str(end - start), "-i", fmt["url"]]
+
+    if format_type == "audio":
+        args += ["-vn", *audio_codec_args(quality, formats[0].get("acodec") or "")]
+    else:
+        if len(formats) == 2:
+            args += ["-map", "0:v:0", "-map", "1:a:0"]
+        args += ["-c", "copy", "-movflags", "+faststart"]
+    args += ["-threads", str(TRANSCODE_THREADS), output_path]
+    _run_ffmpeg_leased(formats, end - start, args)
+    return output_path
+
+
+# ═══════════════════════════════════════════════════════════════
+#                      ПРОЦЕССЫ-ВОРКЕРЫ
+# ═══════════════════════════════════════════════════════════════
+
+# Поля события progress_hook, которые пересылаются из воркера
+PROGRESS_FIELDS = ("status", "total_bytes", "total_bytes_estimate",
+                   "downloaded_bytes", "speed", "eta", "filename")
+
+# Очередь прогресса в процессе-воркере (задаётся инициализатором пула)
+_worker_progress_queue = None
+
+
+def init_download_worker(queue):
+    """Инициализация процесса-воркера (импортирует только этот модуль)"""
+    global _worker_progress_queue
+    _worker_progress_queue = queue
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    # У каждого процесса свой губернатор — делим общий бюджет поровну
+    download_governor.max_connections = max(1, MAX_DOWNLOAD_CONNECTIONS // DOWNLOAD_WORKERS)
+    download_governor.max_bytes_per_sec /= DOWNLOAD_WORKERS
+    ydl_pool.warm(1)
+
+
+def fetch_streams_relayed(token: int, url: str, format_type: str, quality: str,
+                          info: dict | None, local_source: str | None) -> tuple:
+    """fetch_streams в процессе-воркере: прогресс уходит в родителя через очередь"""
+    def hook(d):
+        _worker_progress_queue.put((token, {k: d.get(k) for k in PROGRESS_FIELDS}))
+
+    return fetch_streams(url, format_type, quality, hook, info, local_source)
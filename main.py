@@ -0,0 +1,10 @@
+"""Точка входа YouTube Downloader Bot
+
+Процессы-воркеры DOWNLOAD_MODE=process (spawn) заново импортируют главный
+модуль, поэтому он должен быть лёгким: бот импортируется только здесь, а
+воркеры загружают лишь downloader.py — без клиента Telegram и хранилищ.
+"""
+
+if __name__ == "__main__":
+    import bot
+    bot.run()